@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import sys
+import time
+
+from assemblyline.al.common import forge
+from assemblyline.al.common.classification import Classification, CLASSIFICATION_DEFINITION_TEMPLATE
+
+ITERATIONS = 20000
+SEED = "assemblyline.al.install.seeds.assemblyline_appliance.seed"
+
+
+class UncachedClassification(Classification):
+    CACHE_SIZE = 0
+
+
+def sample_classifications(c):
+    out = [c.UNRESTRICTED, c.RESTRICTED]
+    for req in [''] + sorted(c.access_req_map_stl.keys()):
+        for grp in [''] + sorted(c.groups_map_stl.keys()):
+            for sub in [''] + sorted(c.subgroups_map_stl.keys()):
+                c12n = c.RESTRICTED
+                if req:
+                    c12n += '//' + req
+                if grp:
+                    c12n += '//REL TO ' + grp
+                if sub:
+                    c12n += ('/' if grp else '//') + sub
+                out.append(c12n)
+    return out
+
+
+def run(c, pairs, iterations):
+    start = time.time()
+    results = []
+    for i in xrange(iterations):
+        a, b = pairs[i % len(pairs)]
+        results.append((c.max_classification(a, b),
+                        c.min_classification(a, b),
+                        c.normalize_classification(a, long_format=False),
+                        c.is_accessible(a, b)))
+    return results, time.time() - start
+
+
+def bench(name, definition, iterations):
+    compiled = Classification(definition)
+    uncached = UncachedClassification(definition)
+    samples = sample_classifications(compiled)
+    pairs = [(a, b) for a in samples for b in samples]
+
+    print "%s: %d distinct classifications, %d iterations" % (name, len(samples), iterations)
+    expected, base = run(uncached, pairs, iterations)
+    results, elapsed = run(compiled, pairs, iterations)
+    print "\tparsed   %8.3fs" % base
+    print "\tcompiled %8.3fs  (%.1fx)%s" % (elapsed, base / (elapsed or 1e-9),
+                                             '' if results == expected else '  OUTPUT MISMATCH')
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    bench('seed', forge.get_config(static_seed=SEED).system.classification.definition, count)
+    bench('template', CLASSIFICATION_DEFINITION_TEMPLATE, count)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+import mmap
+import os
+import sys
+import time
+
+from assemblyline.common import entropy
+
+BLOCKSIZE = 65536
+DEFAULT_SIZE_MB = 16
+
+
+def time_it(func, *args):
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def buffered(backend, data):
+    bc = entropy.BufferedCalculator(backend)
+    for offset in xrange(0, len(data), BLOCKSIZE):
+        bc.update(data[offset:offset + BLOCKSIZE])
+    return bc.entropy()
+
+
+def bench(name, data):
+    print "%s (%d bytes)" % (name, len(data))
+    reference = {}
+    for backend in sorted(entropy.backends):
+        for label, func in (('calculate_entropy', entropy.calculate_entropy), ('BufferedCalculator', buffered)):
+            try:
+                if func is buffered:
+                    result, elapsed = time_it(func, backend, data)
+                else:
+                    result, elapsed = time_it(func, data, backend)
+            except Exception as e:  # pylint: disable=W0703
+                print "\t%-8s %-20s unavailable: %s" % (backend, label, e)
+                continue
+
+            expected = reference.setdefault(label, result)
+            print "\t%-8s %-20s %8.3fs %8.1f MB/s  %r%s" % (
+                backend, label, elapsed, len(data) / (elapsed or 1e-9) / 1024 / 1024, result,
+                '' if result == expected else ' MISMATCH')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as fh:
+                if os.fstat(fh.fileno()).st_size:
+                    mapped = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        bench(path, mapped)
+                    finally:
+                        mapped.close()
+    else:
+        size = DEFAULT_SIZE_MB * 1024 * 1024
+        bench('random', os.urandom(size))
+        bench('text', ('The quick brown fox jumps over the lazy dog. ' * (size / 45 + 1))[:size])
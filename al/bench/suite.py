@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+"""
+Scripted benchmarks of the core pipelines.
+
+Runs without Riak: the configuration comes from the static appliance seed,
+the datastore is replaced by an in-memory stand-in (with --latency added to
+every round trip where riak would be hit) and the queues use the
+redis given with --redis (a throwaway local instance, never production, the
+queues used are deleted). Every benchmark is run --repeat times and the best
+run is kept. Results are written as JSON:
+
+    {"results": {"queues": {"named_push": {"count": 20000, "seconds": 0.41,
+                                           "per_second": 48780.5}, ...},
+                 ...}, ...}
+
+Usage: suite.py [-o results.json] [-b queues,dispatcher] [--corpus DIR]
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+
+from collections import defaultdict, deque
+from optparse import OptionParser
+
+from assemblyline.al.common import forge
+
+SEED = "assemblyline.al.install.seeds.assemblyline_appliance.seed"
+BENCHMARKS = ['queues', 'dispatcher', 'middleman', 'freshen', 'identify', 'classification']
+
+
+def configure(options):
+    """ Loads the static seed and points every redis at options.redis. """
+    config = forge.get_config(static_seed=SEED)
+    host, _, port = options.redis.partition(':')
+    for redis in (config.core.redis.nonpersistent, config.core.redis.persistent):
+        redis.host = host
+        redis.port = int(port or 6379)
+    config.logging.log_to_file = False
+    config.logging.log_to_console = False
+    return config
+
+
+def measure(repeat, setup, run):
+    """ Best of repeat runs. setup() returns the arguments of run(*args)
+    which returns the number of operations it did. """
+    best = None
+    for _ in xrange(repeat):
+        args = setup()
+        start = time.time()
+        count = run(*args)
+        elapsed = time.time() - start
+        if best is None or elapsed < best[1]:
+            best = count, elapsed
+    count, elapsed = best
+    return {
+        'count': count,
+        'seconds': round(elapsed, 6),
+        'per_second': round(count / (elapsed or 1e-9), 1),
+    }
+
+
+def sha256_of(*parts):
+    return hashlib.sha256('/'.join(str(p) for p in parts)).hexdigest()
+
+
+# Queues ######################################################################
+
+def make_message(i):
+    return {
+        'sid': str(uuid.UUID(int=random.getrandbits(128))),
+        'srl': sha256_of('message', i),
+        'priority': i % 1000,
+        'submission': {'description': 'bench %d' % i, 'ignore_cache': False},
+        'state': 'submitted',
+    }
+
+
+def bench_queues(options, _):
+    from assemblyline.al.common.queue import NamedQueue, PriorityQueue
+
+    n = options.messages
+    messages = [make_message(i) for i in xrange(n)]
+    nq = NamedQueue('bench-named')
+    pq = PriorityQueue('bench-priority')
+
+    def fresh():
+        nq.delete()
+        pq.delete()
+        return ()
+
+    def filled_named():
+        fresh()
+        nq.push_many(messages)
+        return ()
+
+    def filled_priority():
+        fresh()
+        pq.push_many([(m['priority'], m) for m in messages])
+        return ()
+
+    def named_push():
+        for m in messages:
+            nq.push(m)
+        return n
+
+    def named_push_many():
+        for i in xrange(0, n, options.batch):
+            nq.push_many(messages[i:i + options.batch])
+        return n
+
+    def named_pop():
+        count = 0
+        while nq.pop(blocking=False):
+            count += 1
+        return count
+
+    def named_pop_many():
+        count = 0
+        batch = nq.pop_many(options.batch)
+        while batch:
+            count += len(batch)
+            batch = nq.pop_many(options.batch)
+        return count
+
+    def priority_push():
+        for m in messages:
+            pq.push(m['priority'], m)
+        return n
+
+    def priority_push_many():
+        pq.push_many([(m['priority'], m) for m in messages])
+        return n
+
+    def priority_pop():
+        count = 0
+        while pq.pop():
+            count += 1
+        return count
+
+    def priority_pop_many():
+        count = 0
+        batch = pq.pop(options.batch)
+        while batch:
+            count += len(batch)
+            batch = pq.pop(options.batch)
+        return count
+
+    try:
+        return {
+            'named_push': measure(options.repeat, fresh, named_push),
+            'named_push_many': measure(options.repeat, fresh, named_push_many),
+            'named_pop': measure(options.repeat, filled_named, named_pop),
+            'named_pop_many': measure(options.repeat, filled_named, named_pop_many),
+            'priority_push': measure(options.repeat, fresh, priority_push),
+            'priority_push_many': measure(options.repeat, fresh, priority_push_many),
+            'priority_pop': measure(options.repeat, filled_priority, priority_pop),
+            'priority_pop_many': measure(options.repeat, filled_priority, priority_pop_many),
+        }
+    finally:
+        fresh()
+
+
+# Dispatcher ##################################################################
+
+class MemoryQueues(object):
+    """ In-memory stand-in for the dispatch queues (Dispatcher's pop). """
+
+    def __init__(self):
+        self.queues = defaultdict(deque)
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.itervalues())
+
+    def pop(self, name, num=1):
+        q = self.queues[name]
+        return [q.popleft() for _ in xrange(min(num, len(q)))]
+
+    def push(self, name, *raws):
+        self.queues[name].extend(raws)
+
+
+class BenchProxy(object):
+    def __init__(self, name, requests):
+        self.name = name
+        self.requests = requests
+
+    def execute(self, _, srequest):
+        self.requests.append((self.name, srequest))
+
+
+def _never_skip(_):
+    return False
+
+
+def create_service_manager(count):
+    """ A ServiceProxyManager with count services spread across the stages
+    whose proxies collect the service requests instead of sending them. """
+    from assemblyline.al.core.servicing import ORDER, ServiceEntry, ServiceProxyManager
+
+    class BenchServiceManager(ServiceProxyManager):
+        # noinspection PyMissingConstructor
+        def __init__(self, stages):
+            self.lock = threading.Lock()
+            self.requests = []
+            self.service_list = ['Bench%02d' % i for i in xrange(count)]
+            self.stages = stages
+            self._init_categories_and_services()
+
+        def _init_categories_and_services(self):
+            self.categories = {'Bench': list(self.service_list)}  # pylint:disable=W0201
+            self.services = {}  # pylint:disable=W0201
+            for i, name in enumerate(self.service_list):
+                stage = ORDER[self.stages[i % len(self.stages)]]
+                # Services never look down (no heartbeats in the benchmark).
+                metadata = {'last_heartbeat_at': float('inf'), 'last_result_at': 0}
+                self.services[name] = ServiceEntry(
+                    name, '.*', 'Bench', BenchProxy(name, self.requests),
+                    'empty', _never_skip, stage, 60, metadata)
+
+    return BenchServiceManager(forge.get_config().services.stages)
+
+
+def respond(dispatcher, queues, extractor, name, raw, fanout, depth):
+    """ What a service would send back: its children, an ack and a response. """
+    from assemblyline.al.common.task import Task
+
+    task = Task(raw)
+    if name == extractor and task.depth < depth:
+        hdr = task.submission.copy()
+        hdr['psrl'] = task.srl
+        hdr['depth'] = task.depth
+        hdr['excluded'] = task.excluded
+        hdr['selected'] = task.selected
+        hdr['service_name'] = name
+        extracted = []
+        for i in xrange(fanout):
+            srl = sha256_of(task.srl, i)
+            child = Task.create(srl=srl, sha256=srl, **hdr)
+            child.classification = task.classification
+            queues.push(dispatcher.response_queue, child.raw)
+            extracted.append(('child_%d' % i, srl, '', task.classification))
+        task.extracted = extracted
+
+    task.watermark(name, '1.0')
+    task.success()
+    task.cache_key = '.'.join((task.srl, name, 'v1_0', 'c0'))
+    queues.push(dispatcher.response_queue,
+                task.as_dispatcher_ack(), task.as_dispatcher_response())
+
+
+def bench_dispatcher(options, config):
+    from assemblyline.al.common import counter
+    from assemblyline.al.common.task import Task
+    from assemblyline.al.core import dispatch
+    from assemblyline.al.core.servicing import ORDER
+
+    # Created when a dispatcher starts. It is never started (exported) here.
+    dispatch.counts = counter.AutoExportingCounters(
+        name='bench', host=socket.gethostname(), export_interval_secs=60,
+        channel=forge.get_metrics_sink())
+
+    extract = ORDER['EXTRACT']
+    files_per_submission = sum(options.fanout ** d for d in xrange(options.depth + 1))
+
+    # Every UpdateEntry call (not the ones it makes itself) is timed.
+    update_entry = dispatch.UpdateEntry
+    update_stats = {'calls': 0, 'seconds': 0.0, 'nested': 0}
+    update_runs = []
+
+    def timed_update_entry(entry, now):
+        update_stats['nested'] += 1
+        start = time.time()
+        try:
+            return update_entry(entry, now)
+        finally:
+            update_stats['nested'] -= 1
+            if not update_stats['nested']:
+                update_stats['calls'] += 1
+                update_stats['seconds'] += time.time() - start
+
+    def setup():
+        from assemblyline.al.common.queue import LocalQueue
+
+        service_manager = create_service_manager(options.services)
+        extractors = sorted(n for n, s in service_manager.services.iteritems() if s.stage == extract)
+        extractor = extractors[0] if extractors else None
+        queues = MemoryQueues()
+        dispatcher = dispatch.Dispatcher(service_manager, control_queue=LocalQueue(),
+                                         high=options.inflight, pop=queues.pop)
+        for i in xrange(options.submissions):
+            srl = sha256_of('root', i)
+            task = Task.create(srl=srl, sha256=srl, priority=500,
+                               classification=dispatch.Classification.UNRESTRICTED,
+                               selected=['Bench'], submitter='bench', groups=['USERS'])
+            task.sid = str(uuid.UUID(int=random.getrandbits(128)))
+            task.dispatch_queue = dispatcher.ingest_queue
+            queues.push(dispatcher.ingest_queue, task.raw)
+        update_stats.update(calls=0, seconds=0.0)
+        return dispatcher, service_manager, queues, extractor
+
+    def run(dispatcher, service_manager, queues, extractor):
+        while dispatcher.entries or len(queues):
+            processed = dispatcher.poll(len(dispatcher.entries))
+            requests = service_manager.requests[:]
+            del service_manager.requests[:]
+            if not processed and not requests:
+                raise Exception("Dispatcher stalled with %d submissions outstanding." %
+                                len(dispatcher.entries))
+            for name, raw in requests:
+                respond(dispatcher, queues, extractor, name, raw,
+                        options.fanout, options.depth)
+        update_runs.append((update_stats['seconds'], update_stats['calls']))
+        return options.submissions * files_per_submission
+
+    dispatch.UpdateEntry = timed_update_entry
+    try:
+        result = {'files': measure(options.repeat, setup, run)}
+    finally:
+        dispatch.UpdateEntry = update_entry
+
+    seconds, calls = min(update_runs)
+    result['update_entry'] = {
+        'count': calls,
+        'seconds': round(seconds, 6),
+        'per_second': round(calls / (seconds or 1e-9), 1),
+    }
+    result['tree'] = {
+        'submissions': options.submissions,
+        'files_per_submission': files_per_submission,
+        'services': options.services,
+    }
+    return result
+
+
+# Middleman ###################################################################
+
+class BenchDatastore(object):
+    """ The part of the datastore used by middleman's ingest path. """
+
+    def __init__(self):
+        self.filescores = {}
+
+    def delete_filescore(self, key):
+        self.filescores.pop(key, None)
+
+    def get_filescore(self, key):
+        return self.filescores.get(key, None)
+
+    def get_filescores_dict(self, keys):
+        return {k: self.filescores[k] for k in keys if k in self.filescores}
+
+    @staticmethod
+    def get_user(user):
+        return {'uname': user, 'groups': ['USERS']}
+
+
+def bench_middleman(options, config):
+    from copy import deepcopy
+
+    # Middleman parses its command line on import.
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        from assemblyline.al.core import middleman
+    finally:
+        sys.argv = argv
+
+    logging.getLogger('assemblyline').setLevel(logging.WARNING)
+    queues = (middleman.uniqueq, middleman.dropq, middleman.alertq)
+    datastore = BenchDatastore()
+    now = middleman.now()
+
+    def setup():
+        # New files every run so the local cache starts cold.
+        datastore.filescores.clear()
+        raws = []
+        for _ in xrange(options.notices):
+            sha256 = '%064x' % random.getrandbits(256)
+            raw = {
+                'sha256': sha256,
+                'size': random.randint(1, 1024 * 1024),
+                'classification': config.core.middleman.classification,
+                'metadata': {'source': 'bench', 'filename': sha256[:8] + '.bin'},
+                'submitter': 'bench',
+            }
+            if random.random() < options.hit_ratio:
+                notice = middleman.prepare(datastore, {}, deepcopy(raw))
+                datastore.filescores[middleman.stamp_filescore_key(notice)] = {
+                    'psid': None,
+                    'sid': str(uuid.UUID(int=random.getrandbits(128))),
+                    'score': random.choice((0, 0, 10, 100, 500)),
+                    'time': now,
+                    'errors': 0,
+                }
+            raws.append(raw)
+        for q in queues:
+            q.delete()
+        return raws,
+
+    def ingest(raws):
+        user_groups = {}
+        for raw in raws:
+            middleman.ingest(datastore, user_groups, raw)
+        return len(raws)
+
+    def ingest_many(raws):
+        user_groups = {}
+        for i in xrange(0, len(raws), middleman.ingest_batch_size):
+            middleman.ingest_many(datastore, user_groups, raws[i:i + middleman.ingest_batch_size])
+        return len(raws)
+
+    try:
+        return {
+            'ingest': measure(options.repeat, setup, ingest),
+            'ingest_many': measure(options.repeat, setup, ingest_many),
+            'hit_ratio': options.hit_ratio,
+        }
+    finally:
+        for q in queues:
+            q.delete()
+
+
+# Freshen #####################################################################
+
+class LatencyObject(object):
+    """ A riak object of a LatencyBucket. """
+
+    def __init__(self, bucket, key, data=None):
+        self.bucket = bucket
+        self.key = key
+        self.data = data
+
+    @property
+    def exists(self):
+        return self.data is not None
+
+    @property
+    def encoded_data(self):
+        return json.dumps(self.data) if self.data is not None else None
+
+    def store(self):
+        self.bucket.wait()
+        self.bucket.items[self.key] = json.loads(json.dumps(self.data))
+
+
+class LatencyBucket(object):
+    """ In-memory riak bucket paying latency seconds per round trip. """
+
+    def __init__(self, name, latency):
+        self.name = name
+        self.latency = latency
+        self.items = {}
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get(self, key):
+        self.wait()
+        return LatencyObject(self, key, json.loads(json.dumps(self.items.get(key, None))))
+
+    def multiget(self, keys):
+        self.wait()
+        return [LatencyObject(self, k, json.loads(json.dumps(self.items.get(k, None)))) for k in keys]
+
+    def new(self, key, data, content_type=None):
+        return LatencyObject(self, key, data)
+
+
+class LatencyClient(object):
+    def __init__(self, latency):
+        self.latency = latency
+
+    def multiput(self, objects, return_body=False):
+        if self.latency:
+            time.sleep(self.latency)
+        for obj in objects:
+            obj.bucket.items[obj.key] = json.loads(json.dumps(obj.data))
+        return objects
+
+
+def bench_freshen(options, config):
+    from assemblyline.al.core.datastore import RiakStore
+
+    latency = options.latency / 1000.0
+    # Only the buckets and client are used by the freshen path.
+    ds = RiakStore.__new__(RiakStore)
+    ds._files = LatencyBucket('file', latency)
+    ds.client = LatencyClient(latency)
+    c12n = config.core.middleman.classification
+
+    def setup():
+        # Half of the files were seen before, as for middleman's dropper.
+        ds.files.items.clear()
+        files = []
+        for i in xrange(options.freshens):
+            sha256 = '%064x' % random.getrandbits(256)
+            if i % 2:
+                ds.files.items[sha256] = ds._freshen_fileinfo(
+                    {}, {'sha256': sha256}, '2000-01-01T00:00:00.000000Z', c12n, '2000-01-01T00:00:00.000000Z')
+            files.append(sha256)
+        return files,
+
+    def expiry():
+        return time.strftime('%Y-%m-%dT%H:%M:%S.000000Z', time.gmtime(time.time() + 86400))
+
+    def serial(files):
+        when = expiry()
+        for sha256 in files:
+            ds.save_or_freshen_file(sha256, {'sha256': sha256}, when, c12n)
+        return len(files)
+
+    def batched(files):
+        when = expiry()
+        for i in xrange(0, len(files), options.batch):
+            ds.save_or_freshen_files([(sha256, {'sha256': sha256}, when, c12n)
+                                      for sha256 in files[i:i + options.batch]])
+        return len(files)
+
+    return {
+        'serial': measure(options.repeat, setup, serial),
+        'batched': measure(options.repeat, setup, batched),
+        'latency_ms': options.latency,
+    }
+
+
+# Identify ####################################################################
+
+def create_corpus(directory, count):
+    """ A mix of the kinds of files identify has to tell apart. """
+    for i in xrange(count):
+        path = os.path.join(directory, 'file_%05d' % i)
+        kind = i % 6
+        size = random.randint(4 * 1024, 64 * 1024)
+        if kind == 0:
+            data = os.urandom(size)
+        elif kind == 1:
+            data = '\n'.join('line %d of a plain text file' % n for n in xrange(size / 32))
+        elif kind == 2:
+            data = '#!/bin/sh\n' + ''.join('echo "%d"\n' % n for n in xrange(size / 16))
+        elif kind == 3:
+            data = 'MZ' + '\x90' * 58 + '\x40\x00\x00\x00' + 'PE\x00\x00' + os.urandom(size)
+        elif kind == 4:
+            data = '<html><body>%s</body></html>' % ('<p>paragraph</p>' * (size / 16))
+        else:
+            archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+            archive.writestr('inner.txt', 'zipped ' * (size / 7))
+            archive.close()
+            continue
+        with open(path, 'wb') as fh:
+            fh.write(data)
+
+
+def bench_identify(options, _):
+    from assemblyline.common import identify
+
+    directory = options.corpus
+    if not directory:
+        directory = tempfile.mkdtemp(prefix='al_bench_corpus_')
+        create_corpus(directory, options.files)
+
+    try:
+        paths = sorted(os.path.join(directory, f) for f in os.listdir(directory))
+        paths = [p for p in paths if os.path.isfile(p)]
+
+        def setup():
+            return paths,
+
+        def fileinfo(files):
+            for path in files:
+                identify.fileinfo(path)
+            return len(files)
+
+        def fileinfo_many(files):
+            return len(identify.fileinfo_many(files))
+
+        return {
+            'fileinfo': measure(options.repeat, setup, fileinfo),
+            'fileinfo_many': measure(options.repeat, setup, fileinfo_many),
+            'bytes': sum(os.path.getsize(p) for p in paths),
+        }
+    finally:
+        if not options.corpus:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+# Classification ##############################################################
+
+def bench_classification(options, config):
+    from assemblyline.al.common.classification import Classification
+    from classification_bench import sample_classifications, run
+
+    c = Classification(config.system.classification.definition)
+    samples = sample_classifications(c)
+    pairs = [(a, b) for a in samples for b in samples]
+
+    def setup():
+        return c, pairs, options.classifications
+
+    def operations(*args):
+        run(*args)
+        return options.classifications * 4
+
+    return {
+        'operations': measure(options.repeat, setup, operations),
+        'distinct': len(samples),
+    }
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-b", "--benchmarks", dest="benchmarks", default=','.join(BENCHMARKS),
+                      help="Comma separated benchmarks to run [%default]")
+    parser.add_option("-o", "--outfile", dest="outfile", help="Write the results to this file")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Runs of each benchmark, the best is kept [%default]")
+    parser.add_option("--redis", dest="redis", default="127.0.0.1:6379",
+                      help="Throwaway redis to run against [%default]")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="Random seed [%default]")
+    parser.add_option("--messages", dest="messages", type="int", default=20000,
+                      help="Queue messages [%default]")
+    parser.add_option("--batch", dest="batch", type="int", default=500,
+                      help="Queue batch size [%default]")
+    parser.add_option("--submissions", dest="submissions", type="int", default=200,
+                      help="Dispatcher submissions [%default]")
+    parser.add_option("--fanout", dest="fanout", type="int", default=2,
+                      help="Children extracted per file [%default]")
+    parser.add_option("--depth", dest="depth", type="int", default=2,
+                      help="Depth of the submission trees [%default]")
+    parser.add_option("--services", dest="services", type="int", default=14,
+                      help="Services, spread across the stages [%default]")
+    parser.add_option("--inflight", dest="inflight", type="int", default=100,
+                      help="Dispatcher high water mark [%default]")
+    parser.add_option("--notices", dest="notices", type="int", default=5000,
+                      help="Middleman notices [%default]")
+    parser.add_option("--hit-ratio", dest="hit_ratio", type="float", default=0.5,
+                      help="Fraction of notices already in the filescore cache [%default]")
+    parser.add_option("--freshens", dest="freshens", type="int", default=5000,
+                      help="Files freshened by the freshen benchmark [%default]")
+    parser.add_option("--latency", dest="latency", type="float", default=1.0,
+                      help="Simulated datastore round trip in milliseconds [%default]")
+    parser.add_option("--corpus", dest="corpus",
+                      help="Directory of files to identify (generated if not given)")
+    parser.add_option("--files", dest="files", type="int", default=300,
+                      help="Files in the generated corpus [%default]")
+    parser.add_option("--classifications", dest="classifications", type="int", default=20000,
+                      help="Classification operations [%default]")
+    options, _ = parser.parse_args()
+
+    names = [b.strip() for b in options.benchmarks.split(',') if b.strip()]
+    unknown = [b for b in names if b not in BENCHMARKS]
+    if unknown:
+        parser.error("Unknown benchmark(s): %s" % ', '.join(unknown))
+
+    config = configure(options)
+    report = {
+        'host': socket.gethostname(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'options': vars(options),
+        'results': {},
+    }
+    for name in names:
+        random.seed(options.seed)
+        report['results'][name] = globals()['bench_' + name](options, config)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.outfile:
+        with open(options.outfile, 'w') as fh:
+            fh.write(output + '\n')
+    print output
+
+
+if __name__ == "__main__":
+    main()
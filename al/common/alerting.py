@@ -1,5 +1,4 @@
 import hashlib
-import time
 
 from assemblyline.common.caching import TimeExpiredCache
 from assemblyline.common.isotime import now_as_iso
@@ -22,6 +21,15 @@ CACHE_EXPIRY_RATE = 60
 cache = TimeExpiredCache(CACHE_LEN, CACHE_EXPIRY_RATE)
 EXTENDED_SCAN_QUEUE_PRIORITY = 0
 
+# Submission records and result tags fetched in bulk for a batch of alerts.
+prefetched_records = {}
+prefetched_tags = {}
+
+
+class AlertNotReadyException(Exception):
+    """ The submission of the alert isn't available or finalized yet. """
+    pass
+
 
 def alert_action(msg):
     global action_queue  # pylint: disable=W0603
@@ -31,21 +39,63 @@ def alert_action(msg):
     action_queue.push(EXTENDED_SCAN_QUEUE_PRIORITY, msg)
 
 
+def alert_key(raw):
+    """ Alerts with the same key are created in order, by the same worker. """
+    notice = _notice(raw)
+    return notice.get('psid', None) or notice.get('sid', None)
+
+
+def clear_prefetched():
+    prefetched_records.clear()
+    prefetched_tags.clear()
+
+
+def prefetch(datastore, raws):
+    """ Fetch, in bulk, the submission records and the result tags needed to
+    create the alerts for raws. """
+    sids = set()
+    for raw in raws:
+        sid = _notice(raw).get('sid', None)
+        if sid and cache.get(sid, None) is None:
+            sids.add(sid)
+    if not sids:
+        return
+
+    records = datastore.get_submissions_dict(list(sids))
+    keys = set()
+    for sid, srecord in records.iteritems():
+        if srecord and srecord.get('state', 'unknown') == 'completed':
+            prefetched_records[sid] = srecord
+            keys.update(srecord.get('results', []))
+    if not keys:
+        return
+
+    tags = {}
+    for t in datastore.get_tag_list_from_keys(list(keys)):
+        tags.setdefault(t['key'], []).append(t)
+    for key in keys:
+        prefetched_tags[key] = tags.get(key, [])
+
+
 def get_submission_record(counter, datastore, sid):
-    srecord = datastore.get_submission(sid)
+    srecord = prefetched_records.get(sid, None) or datastore.get_submission(sid)
 
     if not srecord:
         counter.increment('alert.err_no_submission')
-        time.sleep(1.0)
-        raise Exception("Couldn't find submission: %s" % sid)
+        raise AlertNotReadyException("Couldn't find submission: %s" % sid)
 
     if srecord.get('state', 'unknown') != 'completed':
-        time.sleep(1.0)
-        raise Exception("Submission not finalized: %s" % sid)
+        raise AlertNotReadyException("Submission not finalized: %s" % sid)
 
     return srecord
 
 
+def get_tag_list(datastore, keys):
+    if all(k in prefetched_tags for k in keys):
+        return [t for k in keys for t in prefetched_tags[k]]
+    return datastore.get_tag_list_from_keys(keys)
+
+
 def get_summary(datastore, srecord):
     global Classification
     if Classification is None:
@@ -73,7 +123,7 @@ def get_summary(datastore, srecord):
         'THREAT_ACTOR': set(),
     }
 
-    for t in datastore.get_tag_list_from_keys(srecord.get('results', [])):
+    for t in get_tag_list(datastore, srecord.get('results', [])):
         tag_value = t['value']
         if tag_value == '':
             continue
@@ -133,14 +183,18 @@ def get_summary(datastore, srecord):
     return max_classification, summary
 
 
-def init_notice(raw, logger):
+def _notice(raw):
     global Notice  # pylint: disable=W0603
     if Notice is None:
         from assemblyline.al.common.notice import Notice
 
+    return Notice(raw)
+
+
+def init_notice(raw, logger):
     logger.info('Sending alert: %s', str(raw))
 
-    return Notice(raw)
+    return _notice(raw)
 
 
 def init_alert_parts(notice, extra_fields=None, extra_key_data=None):
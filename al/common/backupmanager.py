@@ -1,4 +1,17 @@
-
+"""
+Backups are directories of chunks. A chunk holds up to CHUNK_SIZE items of a
+single bucket, one json encoded (bucket_name, key, data) per line, optionally
+gzip compressed. Chunks are written under a temporary name and renamed once
+complete. The manifest (manifest.json) lists the chunks of a backup.
+
+Restores go through the chunks in batches of RESTORE_BATCH_SIZE items and
+append the name of every chunk they complete to the restored file of the
+backup so an interrupted restore resumes with the chunks that are left.
+
+Backups made before chunking (backup.part<N> files without a manifest, or a
+single json document for SystemBackup) can still be restored.
+"""
+import gzip
 import json
 import time
 import os
@@ -6,6 +19,8 @@ import subprocess
 import threading
 import uuid
 
+from assemblyline.common.isotime import now_as_iso
+from assemblyline.common.riakreconnect import RiakReconnect
 from assemblyline.al.common import forge, queue, remote_datatypes
 from assemblyline.al.common.error_template import ERROR_MAP
 
@@ -18,10 +33,175 @@ COUNT_INCREMENT = 1000
 LOW_THRESHOLD = 10000
 HIGH_THRESHOLD = 50000
 
+BACKUP_VERSION = 2
+CHUNK_SIZE = 10000
+CHUNK_EXTENSION = '.ndjson'
+MANIFEST = 'manifest.json'
+RESTORED = 'restored'
+RESTORE_BATCH_SIZE = 500
+
+
+def _open_chunk(path, mode, compress=None):
+    if compress is None:
+        compress = path.endswith('.gz')
+    if compress:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def read_chunk(path):
+    """ Yields the (bucket_name, key, data) items of a chunk. """
+    with _open_chunk(path, 'rb') as chunk:
+        for line in chunk:
+            if line.strip():
+                yield json.loads(line)
+
+
+class ChunkWriter(object):
+    """ Writes items to per bucket chunks of up to chunk_size items named
+    <bucket>.<prefix>.<n>.ndjson[.gz]. Completed chunks are passed to
+    on_chunk and listed in chunks. """
+
+    def __init__(self, directory, prefix, compress=False, chunk_size=CHUNK_SIZE, on_chunk=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.compress = compress
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+        self.chunks = []
+        self.open_chunks = {}
+        self.sequence = 0
+
+    def _close(self, bucket_name):
+        name, fh, count = self.open_chunks.pop(bucket_name)
+        fh.close()
+        os.rename(os.path.join(self.directory, name + '.tmp'), os.path.join(self.directory, name))
+        chunk = {'name': name, 'bucket': bucket_name, 'count': count}
+        self.chunks.append(chunk)
+        if self.on_chunk:
+            self.on_chunk(chunk)
+
+    def write(self, bucket_name, key, data):
+        if bucket_name not in self.open_chunks:
+            name = '%s.%s.%d%s' % (bucket_name, self.prefix, self.sequence, CHUNK_EXTENSION)
+            if self.compress:
+                name += '.gz'
+            self.sequence += 1
+            fh = _open_chunk(os.path.join(self.directory, name + '.tmp'), 'wb', self.compress)
+            self.open_chunks[bucket_name] = [name, fh, 0]
+
+        current = self.open_chunks[bucket_name]
+        current[1].write(json.dumps((bucket_name, key, data)) + "\n")
+        current[2] += 1
+        if current[2] >= self.chunk_size:
+            self._close(bucket_name)
+
+    def close(self):
+        for bucket_name in self.open_chunks.keys():
+            self._close(bucket_name)
+        return self.chunks
+
+
+def write_manifest(directory, chunks, compress=False):
+    buckets = {}
+    for chunk in chunks:
+        buckets[chunk['bucket']] = buckets.get(chunk['bucket'], 0) + chunk['count']
+
+    manifest = {
+        'version': BACKUP_VERSION,
+        'created': now_as_iso(),
+        'compressed': compress,
+        'buckets': buckets,
+        'chunks': sorted(chunks, key=lambda c: c['name']),
+    }
+    with open(os.path.join(directory, MANIFEST + '.tmp'), 'wb') as fh:
+        fh.write(json.dumps(manifest, indent=2))
+    os.rename(os.path.join(directory, MANIFEST + '.tmp'), os.path.join(directory, MANIFEST))
+    return manifest
+
+
+def load_manifest(directory):
+    """ The manifest of the backup in directory. The chunks of a backup
+    without manifest are its backup.part<N> files (of unknown bucket). """
+    path = os.path.join(directory, MANIFEST)
+    if os.path.exists(path):
+        with open(path, 'rb') as fh:
+            return json.loads(fh.read())
+
+    return {
+        'version': 1,
+        'chunks': [{'name': name, 'bucket': None, 'count': None}
+                   for name in sorted(os.listdir(directory)) if name.startswith('backup.part')],
+    }
+
+
+def restored_chunks(directory):
+    path = os.path.join(directory, RESTORED)
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb') as fh:
+        return set(line.strip() for line in fh if line.strip())
+
+
+def mark_restored(directory, name):
+    with open(os.path.join(directory, RESTORED), 'ab') as fh:
+        fh.write(name + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def pending_chunks(directory, bucket_list=None, restart=False):
+    """ Chunks of the backup in directory that are left to restore. """
+    if restart and os.path.exists(os.path.join(directory, RESTORED)):
+        os.unlink(os.path.join(directory, RESTORED))
+
+    done = restored_chunks(directory)
+    return [chunk for chunk in load_manifest(directory)['chunks']
+            if chunk['name'] not in done and
+            (bucket_list is None or chunk['bucket'] is None or chunk['bucket'] in bucket_list)]
+
+
+# noinspection PyProtectedMember
+def restore_chunk(ds, path, bucket_list=None, on_batch=None, flushed=None):
+    """ Saves the items of a chunk with one batched write per
+    RESTORE_BATCH_SIZE items. Returns the number of items that failed.
+
+    The (bucket_name, key) of the items written are added to flushed. Items
+    already in flushed are skipped so a chunk can be retried where it left. """
+    failed = [0]
+    if flushed is None:
+        flushed = set()
+
+    def flush(bucket_name, items):
+        errors = ds._save_bucket_items(ds.get_bucket(bucket_name), items)
+        flushed.update((bucket_name, key) for key, _ in items)
+        failed[0] += len(errors)
+        if on_batch:
+            on_batch(bucket_name, len(items) - len(errors), len(errors))
+
+    batches = {}
+    for bucket_name, key, data in read_chunk(path):
+        if bucket_list is not None and bucket_name not in bucket_list:
+            continue
+        if (bucket_name, key) in flushed:
+            continue
+        batch = batches.setdefault(bucket_name, [])
+        batch.append((key, ds.sanitize(bucket_name, data, key)))
+        if len(batch) >= RESTORE_BATCH_SIZE:
+            flush(bucket_name, batch)
+            batches[bucket_name] = []
+
+    for bucket_name, batch in batches.iteritems():
+        if batch:
+            flush(bucket_name, batch)
+
+    return failed[0]
+
 
 class SystemBackup(object):
-    def __init__(self, backup_file_path):
-        self.backup_file_path = backup_file_path
+    def __init__(self, backup_path, compress=False):
+        self.backup_path = backup_path
+        self.compress = compress
         self.ds = forge.get_datastore()
 
         # Static maps
@@ -37,48 +217,41 @@ class SystemBackup(object):
     def list_valid_buckets(self):
         return self.VALID_BUCKETS
 
+    def _check_buckets(self, bucket_list):
+        for bucket in bucket_list:
+            if bucket not in self.VALID_BUCKETS:
+                print "ERROR: '%s' is not a valid bucket.\n\nChoose one of the following:\n\t%s\n" \
+                      % (bucket, "\n\t".join(self.VALID_BUCKETS))
+                return False
+        return True
+
     # noinspection PyProtectedMember
     def backup(self, bucket_list=None):
         if bucket_list is None:
             bucket_list = self.VALID_BUCKETS
 
-        for bucket in bucket_list:
-            if bucket not in self.VALID_BUCKETS:
-                print "ERROR: '%s' is not a valid bucket.\n\nChoose one of the following:\n\t%s\n" \
-                      % (bucket, "\n\t".join(self.VALID_BUCKETS))
-                return
+        if not self._check_buckets(bucket_list):
+            return
 
-        with open(self.backup_file_path, "wb") as out_file:
-            print "Starting system backup... [%s bucket(s)]" % ", ".join(bucket_list)
-            output = {}
-            for bucket in bucket_list:
-                data = {k: self.ds._get_bucket_item(self.BUCKET_MAP[bucket], k)
-                        for k in self.ds._stream_bucket_debug_keys(self.BUCKET_MAP[bucket])}
-                output[bucket] = data
-                print "\t[x] %s" % bucket.upper()
+        if not os.path.exists(self.backup_path):
+            os.makedirs(self.backup_path)
 
-            print "Saving backup to file %s..." % self.backup_file_path
-            out_file.write(json.dumps(output))
+        print "Starting system backup to %s... [%s bucket(s)]" % (self.backup_path, ", ".join(bucket_list))
+        writer = ChunkWriter(self.backup_path, 'system', self.compress)
+        for bucket in bucket_list:
+            for k in self.ds._stream_bucket_debug_keys(self.BUCKET_MAP[bucket]):
+                writer.write(bucket, k, self.ds._get_bucket_item(self.BUCKET_MAP[bucket], k))
+            print "\t[x] %s" % bucket.upper()
 
+        write_manifest(self.backup_path, writer.close(), self.compress)
         print "Backup completed!\n"
 
     # noinspection PyProtectedMember
-    def restore(self, bucket_list=None):
-        print "Loading backup file %s ..." % self.backup_file_path
-
-        with open(self.backup_file_path, "rb") as bck_file:
+    def _restore_document(self, bucket_list):
+        """ Restores a backup made before backups were chunked. """
+        with open(self.backup_path, "rb") as bck_file:
             restore = json.loads(bck_file.read())
 
-        if bucket_list is None:
-            bucket_list = self.VALID_BUCKETS
-
-        for bucket in bucket_list:
-            if bucket not in self.VALID_BUCKETS:
-                print "ERROR: '%s' is not a valid bucket.\n\nChoose one of the following:\n\t%s\n" \
-                      % (bucket, "\n\t".join(self.VALID_BUCKETS))
-                return
-
-        print "Restoring data in buckets... [%s]" % ", ".join(bucket_list)
         errors = []
         for bucket in bucket_list:
             if bucket not in restore:
@@ -90,6 +263,36 @@ class SystemBackup(object):
                     self.ds._save_bucket_item(self.BUCKET_MAP[bucket], k, v)
 
                 print "\t[x] %s" % bucket.upper()
+        return errors
+
+    def restore(self, bucket_list=None, restart=False):
+        if bucket_list is None:
+            bucket_list = self.VALID_BUCKETS
+
+        if not self._check_buckets(bucket_list):
+            return
+
+        print "Restoring data in buckets from %s... [%s]" % (self.backup_path, ", ".join(bucket_list))
+        if os.path.isfile(self.backup_path):
+            errors = self._restore_document(bucket_list)
+        else:
+            manifest = load_manifest(self.backup_path)
+            chunks = pending_chunks(self.backup_path, bucket_list, restart)
+            failed = 0
+            for chunk in chunks:
+                chunk_failed = restore_chunk(self.ds, os.path.join(self.backup_path, chunk['name']), bucket_list)
+                if chunk_failed:
+                    # Not marked as restored so it is retried when the restore is resumed.
+                    failed += chunk_failed
+                    print "\t[ ] %s (%s items failed)" % (chunk['name'], chunk_failed)
+                    continue
+                mark_restored(self.backup_path, chunk['name'])
+                print "\t[x] %s (%s)" % (chunk['name'], chunk['count'])
+            if failed:
+                print "%s items could not be saved. Run the restore again to retry them." % failed
+
+            backed_up = manifest.get('buckets', None)
+            errors = [b for b in bucket_list if backed_up is not None and b not in backed_up]
 
         if len(errors) > 0:
             print "Backup restore complete with missing data.\nThe following buckets don't have any data " \
@@ -99,7 +302,7 @@ class SystemBackup(object):
 
 
 class DistributedBackup(object):
-    def __init__(self, working_dir, worker_count=50, spawn_workers=True):
+    def __init__(self, working_dir, worker_count=50, spawn_workers=True, compress=False):
         self.working_dir = working_dir
         self.ds = forge.get_datastore()
         self.plist = []
@@ -108,8 +311,11 @@ class DistributedBackup(object):
         self.hash_queue = remote_datatypes.Hash("r-hash_%s" % self.instance_id, db=DATABASE_NUM)
         self.backup_queue = queue.NamedQueue('r-backup_%s' % self.instance_id, db=DATABASE_NUM, ttl=1800)
         self.backup_done_queue = queue.NamedQueue("r-backup-done_%s" % self.instance_id, db=DATABASE_NUM, ttl=1800)
+        self.restore_queue = queue.NamedQueue("r-restore_%s" % self.instance_id, db=DATABASE_NUM, ttl=1800)
         self.restore_done_queue = queue.NamedQueue("r-restore-done_%s" % self.instance_id, db=DATABASE_NUM, ttl=1800)
         self.bucket_error = []
+        self.chunks = []
+        self.failed_chunks = []
 
         self.BUCKET_MAP = {
             "alert": self.ds.alerts,
@@ -128,6 +334,7 @@ class DistributedBackup(object):
         self.VALID_BUCKETS = sorted(self.BUCKET_MAP.keys())
         self.worker_count = worker_count
         self.spawn_workers = spawn_workers
+        self.compress = compress
         self.current_type = None
 
     def terminate(self):
@@ -144,6 +351,7 @@ class DistributedBackup(object):
             self.backup_done_queue.delete()
         else:
             print "\nCleaning up restore queues for ID: %s..." % self.instance_id
+            self.restore_queue.delete()
             self.restore_done_queue.delete()
 
         self.follow_queue.delete()
@@ -157,6 +365,7 @@ class DistributedBackup(object):
         e_count = 0
         t0 = time.time()
         t_last = t0
+        t_last_count = 0
         done_count = 0
 
         # Initialise by type
@@ -175,9 +384,20 @@ class DistributedBackup(object):
             _, data = msg
             if data.get("is_done", False):
                 done_count += 1
+            elif 'chunk' in data:
+                self.chunks.append(data['chunk'])
+            elif 'restored_chunk' in data:
+                # Only this thread writes the restore progress of the backup.
+                mark_restored(self.working_dir, data['restored_chunk'])
+            elif 'failed_chunk' in data:
+                self.failed_chunks.append(data['failed_chunk'])
+                e_count += data.get('errors', 0)
             else:
+                # Restore workers report a batch of keys at a time.
+                count = data.get('count', 1)
+                e_count += data.get('errors', 0)
                 if data.get('success', False):
-                    t_count += 1
+                    t_count += count
 
                     bucket_name = data['bucket_name']
 
@@ -185,22 +405,23 @@ class DistributedBackup(object):
                         if bucket_name not in missing_map_count:
                             missing_map_count[bucket_name] = 0
 
-                        missing_map_count[bucket_name] += 1
+                        missing_map_count[bucket_name] += count
                     else:
                         if bucket_name not in map_count:
                             map_count[bucket_name] = 0
 
-                        map_count[bucket_name] += 1
+                        map_count[bucket_name] += count
 
-                    if t_count % COUNT_INCREMENT == 0:
+                    if t_count - t_last_count >= COUNT_INCREMENT:
                         new_t = time.time()
                         print "%s (%s at %s keys/sec) ==> %s" % (t_count,
                                                                  new_t - t_last,
-                                                                 int(COUNT_INCREMENT / (new_t - t_last)),
+                                                                 int((t_count - t_last_count) / (new_t - t_last)),
                                                                  map_count)
                         t_last = new_t
+                        t_last_count = t_count
                 else:
-                    e_count += 1
+                    e_count += count
 
             if done_count == self.worker_count:
                 break
@@ -225,15 +446,35 @@ class DistributedBackup(object):
 
         if len(self.bucket_error) > 0:
             summary += "\nThese buckets failed to %s completely: %s\n" % (title.lower(), self.bucket_error)
+
+        if len(self.failed_chunks) > 0:
+            summary += "\nThese chunks failed to restore, run the restore again to retry them:\n\t%s\n" % \
+                       "\n\t".join(sorted(self.failed_chunks))
         print summary
 
+    def _spawn_workers(self, worker_type):
+        devnull = open(os.devnull, 'w')
+        for x in xrange(self.worker_count):
+            run_dir = __file__[:__file__.index("common/")]
+            p = subprocess.Popen([os.path.join(run_dir, "run", "invoke.sh"),
+                                  os.path.join(run_dir, "run", "distributed_worker.py"),
+                                  str(worker_type),
+                                  str(x),
+                                  self.working_dir,
+                                  self.instance_id,
+                                  "compress" if self.compress else ""],
+                                 stderr=devnull,
+                                 stdout=devnull)
+            self.plist.append(p)
+
     # noinspection PyProtectedMember
     def _key_streamer(self, bucket_name, _):
         for x in self.ds._stream_bucket_debug_keys(self.BUCKET_MAP[bucket_name]):
             yield x
 
     def _search_streamer(self, bucket_name, query):
-        for x in self.ds.stream_search(bucket_name, query, fl="_yz_rk", item_buffer_size=500):
+        for x in self.ds.stream_search(bucket_name, query, fl="_yz_rk", item_buffer_size=500,
+                                       partitions=self.ds.STREAM_KEY_PARTITIONS):
             yield x['_yz_rk']
 
     # noinspection PyBroadException,PyProtectedMember
@@ -251,22 +492,13 @@ class DistributedBackup(object):
         try:
             # Cleaning queues
             self.current_type = TYPE_BACKUP
+            if not os.path.exists(self.working_dir):
+                os.makedirs(self.working_dir)
 
             # Spawning workers
             if self.spawn_workers:
                 print "Spawning %s backup workers ..." % self.worker_count
-                devnull = open(os.devnull, 'w')
-                for x in xrange(self.worker_count):
-                    run_dir = __file__[:__file__.index("common/")]
-                    p = subprocess.Popen([os.path.join(run_dir, "run", "invoke.sh"),
-                                          os.path.join(run_dir, "run", "distributed_worker.py"),
-                                          str(TYPE_BACKUP),
-                                          str(x),
-                                          self.working_dir,
-                                          self.instance_id],
-                                         stderr=devnull,
-                                         stdout=devnull)
-                    self.plist.append(p)
+                self._spawn_workers(TYPE_BACKUP)
                 print "All backup workers started!"
             else:
                 print "No spawning any workers. You need to manually spawn %s workers..." % self.worker_count
@@ -313,29 +545,33 @@ class DistributedBackup(object):
 
             # Wait for workers to finish
             t.join()
+
+            write_manifest(self.working_dir, self.chunks, self.compress)
         except Exception, e:
             print e
         finally:
             print "Backup of %s terminated.\n" % ", ".join(bucket_list)
 
-    def restore(self):
+    def restore(self, restart=False):
         try:
             self.current_type = TYPE_RESTORE
 
+            chunks = pending_chunks(self.working_dir, restart=restart)
+            done = len(load_manifest(self.working_dir)['chunks']) - len(chunks)
+            if done:
+                print "Resuming restore, %s chunks were already restored." % done
+            if not chunks:
+                print "Nothing left to restore."
+                return
+
+            # Workers take the chunks from the restore queue.
+            self.worker_count = max(1, min(self.worker_count, len(chunks)))
+            self.restore_queue.push_many([{"name": chunk['name'], "count": chunk['count']} for chunk in chunks] +
+                                         [{"is_done": True}] * self.worker_count)
+
             # Spawning workers
-            print "Spawning %s restore workers ..." % self.worker_count
-            devnull = open(os.devnull, 'w')
-            for x in xrange(self.worker_count):
-                run_dir = __file__[:__file__.index("common/")]
-                p = subprocess.Popen([os.path.join(run_dir, "run", "invoke.sh"),
-                                      os.path.join(run_dir, "run", "distributed_worker.py"),
-                                      str(TYPE_RESTORE),
-                                      str(x),
-                                      self.working_dir,
-                                      self.instance_id],
-                                     stderr=devnull,
-                                     stdout=devnull)
-                self.plist.append(p)
+            print "Spawning %s restore workers for %s chunks..." % (self.worker_count, len(chunks))
+            self._spawn_workers(TYPE_RESTORE)
             print "All restore workers started, waiting for them to import all the data..."
 
             # Start done thread
@@ -348,6 +584,7 @@ class DistributedBackup(object):
         except Exception, e:
             print e
         finally:
+            self.restore_queue.delete()
             print "Restore of backup in %s terminated.\n" % self.working_dir
 
 
@@ -420,12 +657,13 @@ FOLLOW_KEYS = {
 
 # noinspection PyProtectedMember,PyBroadException
 class BackupWorker(object):
-    def __init__(self, wid, worker_type, working_dir, instance_id):
+    def __init__(self, wid, worker_type, working_dir, instance_id, compress=False):
         self.working_dir = working_dir
         self.worker_id = wid
         self.ds = forge.get_datastore()
         self.worker_type = worker_type
         self.instance_id = instance_id
+        self.compress = compress
 
         if worker_type == TYPE_BACKUP:
             self.hash_queue = remote_datatypes.Hash("r-hash_%s" % self.instance_id, db=DATABASE_NUM)
@@ -435,77 +673,97 @@ class BackupWorker(object):
         else:
             self.hash_queue = None
             self.follow_queue = None
-            self.queue = None
+            self.queue = queue.NamedQueue("r-restore_%s" % self.instance_id, db=DATABASE_NUM, ttl=1800)
             self.done_queue = queue.NamedQueue("r-restore-done_%s" % self.instance_id, db=DATABASE_NUM, ttl=1800)
 
     def _backup(self):
         done = False
         current_queue = self.queue
-        with open(os.path.join(self.working_dir, "backup.part%s" % self.worker_id), "wb") as backup_file:
-            while True:
-                data = current_queue.pop(timeout=1)
-                if not data and done:
-                    break
-                elif not data:
-                    continue
+        writer = ChunkWriter(self.working_dir, "w%s" % self.worker_id, self.compress,
+                             on_chunk=lambda chunk: self.done_queue.push({"is_done": False, "chunk": chunk}))
+        while True:
+            data = current_queue.pop(timeout=1)
+            if not data and done:
+                break
+            elif not data:
+                continue
 
-                if isinstance(data, list):
-                    data = data[0]
+            if isinstance(data, list):
+                data = data[0]
 
-                if data.get('is_done', False) and not done:
-                    current_queue = self.follow_queue
-                    done = True
-                    continue
-                elif data.get('is_done', False) and done:
-                    # Go someone else done message. Push it back on the queue and sleep...
-                    self.queue.push({"is_done": True})
-                    time.sleep(1)
-                    continue
+            if data.get('is_done', False) and not done:
+                current_queue = self.follow_queue
+                done = True
+                continue
+            elif data.get('is_done', False) and done:
+                # Go someone else done message. Push it back on the queue and sleep...
+                self.queue.push({"is_done": True})
+                time.sleep(1)
+                continue
 
-                missing = False
-                success = True
-                try:
-                    to_write = self.ds._get_bucket_item(self.ds.get_bucket(data['bucket_name']), data['key'])
-                    if to_write:
-                        if data.get('follow_keys', False):
-                            for bucket, bucket_key, getter in FOLLOW_KEYS.get(data['bucket_name'], []):
-                                for key in getter(to_write.get(bucket_key, None)):
-                                    hash_key = "%s_%s" % (bucket, key)
-                                    if not self.hash_queue.exists(hash_key):
-                                        self.hash_queue.add(hash_key, "True")
-                                        self.follow_queue.push({"bucket_name": bucket, "key": key, "follow_keys": True})
-
-                        backup_file.write(json.dumps((data['bucket_name'], data['key'], to_write)) + "\n")
-                    else:
-                        missing = True
+            missing = False
+            success = True
+            try:
+                to_write = self.ds._get_bucket_item(self.ds.get_bucket(data['bucket_name']), data['key'])
+                if to_write:
+                    if data.get('follow_keys', False):
+                        for bucket, bucket_key, getter in FOLLOW_KEYS.get(data['bucket_name'], []):
+                            for key in getter(to_write.get(bucket_key, None)):
+                                hash_key = "%s_%s" % (bucket, key)
+                                if not self.hash_queue.exists(hash_key):
+                                    self.hash_queue.add(hash_key, "True")
+                                    self.follow_queue.push({"bucket_name": bucket, "key": key, "follow_keys": True})
+
+                    writer.write(data['bucket_name'], data['key'], to_write)
+                else:
+                    missing = True
 
-                except:
-                    success = False
+            except:
+                success = False
 
-                self.done_queue.push({"is_done": False,
-                                      "success": success,
-                                      "missing": missing,
-                                      "bucket_name": data['bucket_name'],
-                                      "key": data['key']})
+            self.done_queue.push({"is_done": False,
+                                  "success": success,
+                                  "missing": missing,
+                                  "bucket_name": data['bucket_name'],
+                                  "key": data['key']})
+
+        writer.close()
 
-    # noinspection PyUnresolvedReferences
     def _restore(self):
-        with open(os.path.join(self.working_dir, "backup.part%s" % self.worker_id), "rb") as input_file:
-            for l in input_file.xreadlines():
-                bucket_name, key, data = json.loads(l)
+        def on_batch(bucket_name, saved, errors):
+            self.done_queue.push({"is_done": False,
+                                  "success": True,
+                                  "missing": False,
+                                  "bucket_name": bucket_name,
+                                  "count": saved,
+                                  "errors": errors})
 
-                success = True
-                try:
-                    v = self.ds.sanitize(bucket_name, data, key)
-                    self.ds._save_bucket_item(self.ds.get_bucket(bucket_name), key, v)
-                except:
-                    success = False
+        while True:
+            data = self.queue.pop(timeout=1)
+            if not data:
+                continue
+            if data.get('is_done', False):
+                break
 
+            name = data['name']
+            flushed = set()
+            try:
+                failed = self._restore_chunk(name, on_batch, flushed)
+            except Exception:  # pylint: disable=W0703
+                # The items that were not written are lost until the restore is resumed.
+                count = data.get('count', None)
                 self.done_queue.push({"is_done": False,
-                                      "success": success,
-                                      "missing": False,
-                                      "bucket_name": bucket_name,
-                                      "key": key})
+                                      "failed_chunk": name,
+                                      "errors": max(0, (count or 0) - len(flushed))})
+                continue
+
+            # A chunk with failures is restored again when the restore is resumed.
+            if not failed:
+                self.done_queue.push({"is_done": False, "restored_chunk": name})
+
+    @RiakReconnect(lambda worker: worker.ds.wake_up_riak())
+    def _restore_chunk(self, name, on_batch, flushed):
+        return restore_chunk(self.ds, os.path.join(self.working_dir, name), on_batch=on_batch, flushed=flushed)
 
     def run(self):
         if self.worker_type == TYPE_BACKUP:
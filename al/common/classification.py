@@ -141,9 +141,34 @@ class InvalidDefinition(Exception):
     pass
 
 
+class CompiledClassification(object):
+    """ A normalized classification reduced to its level and bitsets of its
+    required, groups and subgroups parts. """
+    __slots__ = ('lvl', 'req', 'groups', 'subgroups')
+
+    def __init__(self, lvl, req, groups, subgroups):
+        self.lvl = lvl
+        self.req = req
+        self.groups = groups
+        self.subgroups = subgroups
+
+    def can_be_seen_by(self, user):
+        if user.lvl < self.lvl:
+            return False
+        if self.req & ~user.req:
+            return False
+        if self.groups and not self.groups & user.groups:
+            return False
+        if self.subgroups and not self.subgroups & user.subgroups:
+            return False
+        return True
+
+
 class Classification(object):
     MAX_LVL = 10000
     INVALID_LVL = 10001
+    # Maximum number of memoized results. 0 disables memoization.
+    CACHE_SIZE = 10000
 
     def __init__(self, classification_definition=None):
         """
@@ -154,6 +179,8 @@ class Classification(object):
                                         see DEFAULT_CLASSIFICATION_DEFINITION for an example.
         """
         banned_params_keys = ['name', 'short_name', 'lvl', 'aliases', 'auto_select', 'css', 'description']
+        self._cache = {}
+        self._bits = ({}, {}, {})
         self.levels_map = {}
         self.levels_map_stl = {}
         self.levels_map_lts = {}
@@ -250,6 +277,12 @@ class Classification(object):
                 self.description[short_name] = x.get('description', "N/A")
                 self.description[name] = self.description[short_name]
 
+            # Every required, group and subgroup short name gets a bit.
+            for bits, names in zip(self._bits, (self.access_req_map_stl, self.groups_map_stl,
+                                                self.subgroups_map_stl)):
+                for i, name in enumerate(sorted(names)):
+                    bits[name] = 1 << i
+
             if not self.is_valid(classification_definition['unrestricted']):
                 raise Exception("Classification definition's unrestricted classification is invalid.")
 
@@ -271,6 +304,37 @@ class Classification(object):
     ############################
     # Private functions
     ############################
+    def _memoized(self, key, func, *args):
+        # Results are pure functions of the arguments so they are cached per
+        # distinct call. The cache is simply reset when it gets full.
+        cache = self._cache
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable arguments.
+            return func(*args)
+
+        value = func(*args)
+        if self.CACHE_SIZE:
+            if len(cache) >= self.CACHE_SIZE:
+                cache.clear()
+            cache[key] = value
+        return value
+
+    def _compile(self, c12n):
+        c12n = self.normalize_classification(c12n, skip_auto_select=True)
+        lvl_idx, req, groups, subgroups = self._get_classification_parts(c12n, long_format=False)
+        req_bits, group_bits, subgroup_bits = self._bits
+        return CompiledClassification(lvl_idx,
+                                      sum(req_bits[x] for x in req),
+                                      sum(group_bits[x] for x in groups),
+                                      sum(subgroup_bits[x] for x in subgroups))
+
+    def _compiled(self, c12n):
+        return self._memoized(('compiled', c12n), self._compile, c12n)
+
     def _get_c12n_level_index(self, c12n):
         # Parse classifications in uppercase mode only
         c12n = c12n.upper()
@@ -435,12 +499,18 @@ class Classification(object):
 
         return out
 
-    def _get_classification_parts(self, c12n, long_format=True):
+    def _parse_classification_parts(self, c12n, long_format=True):
         lvl_idx = self._get_c12n_level_index(c12n)
         req = self._get_c12n_required(c12n, long_format=long_format)
         groups, subgroups = self._get_c12n_groups(c12n, long_format=long_format)
 
-        return lvl_idx, req, groups, subgroups
+        return lvl_idx, tuple(req), tuple(groups), tuple(subgroups)
+
+    def _get_classification_parts(self, c12n, long_format=True):
+        lvl_idx, req, groups, subgroups = self._memoized(('parts', c12n, long_format),
+                                                         self._parse_classification_parts, c12n, long_format)
+        # Callers are free to modify the lists they get.
+        return lvl_idx, list(req), list(groups), list(subgroups)
 
     @staticmethod
     def _max_groups(groups_1, groups_2):
@@ -479,7 +549,7 @@ class Classification(object):
         to enforce classification throughout the system.
         """
         from copy import deepcopy
-        out = deepcopy(self.__dict__)
+        out = deepcopy({k: v for k, v in self.__dict__.iteritems() if not k.startswith('_')})
         del out['levels_map']["INV"]
         del out['levels_map'][self.INVALID_LVL]
         del out['levels_map_stl']["INV"]
@@ -595,24 +665,9 @@ class Classification(object):
         if c12n is None:
             return True
 
-        # Normalize classifications before comparing them
-        user_c12n = self.normalize_classification(user_c12n, skip_auto_select=True)
-        c12n = self.normalize_classification(c12n, skip_auto_select=True)
-
-        user_req = self._get_c12n_required(user_c12n)
-        user_groups, user_subgroups = self._get_c12n_groups(user_c12n)
-        req = self._get_c12n_required(c12n)
-        groups, subgroups = self._get_c12n_groups(c12n)
-
-        if self._get_c12n_level_index(user_c12n) >= self._get_c12n_level_index(c12n):
-            if not self._can_see_required(user_req, req):
-                return False
-            if not self._can_see_groups(user_groups, groups):
-                return False
-            if not self._can_see_groups(user_subgroups, subgroups):
-                return False
-            return True
-        return False
+        # Both classifications are normalized and compiled once, the check
+        # itself is a few bitwise operations.
+        return self._compiled(c12n).can_be_seen_by(self._compiled(user_c12n))
 
     def is_valid(self, c12n, skip_auto_select=False):
         """
@@ -624,6 +679,9 @@ class Classification(object):
         Returns:
             True if the classification is valid
         """
+        return self._memoized(('is_valid', c12n, skip_auto_select), self._is_valid, c12n, skip_auto_select)
+
+    def _is_valid(self, c12n, skip_auto_select=False):
         if not self.enforce:
             return True
 
@@ -709,6 +767,10 @@ class Classification(object):
         Returns:
             The most restrictive classification that we could create out of the two
         """
+        return self._memoized(('max_classification', c12n_1, c12n_2, long_format),
+                              self._max_classification, c12n_1, c12n_2, long_format)
+
+    def _max_classification(self, c12n_1, c12n_2, long_format=True):
         if not self.enforce:
             return self.UNRESTRICTED
 
@@ -751,6 +813,10 @@ class Classification(object):
         Returns:
             The least restrictive classification that we could create out of the two
         """
+        return self._memoized(('min_classification', c12n_1, c12n_2, long_format),
+                              self._min_classification, c12n_1, c12n_2, long_format)
+
+    def _min_classification(self, c12n_1, c12n_2, long_format=True):
         if not self.enforce:
             return self.UNRESTRICTED
 
@@ -799,6 +865,10 @@ class Classification(object):
         Returns:
             A normalized version of the original classification
         """
+        return self._memoized(('normalize_classification', c12n, long_format, skip_auto_select),
+                              self._normalize_classification, c12n, long_format, skip_auto_select)
+
+    def _normalize_classification(self, c12n, long_format=True, skip_auto_select=False):
         if not self.enforce:
             return self.UNRESTRICTED
 
@@ -11,6 +11,9 @@ SEED_KEY = os.environ.get('AL_SEED_KEY', '') or 'seed'
 SEED_RIAK_NODE = os.environ.get('AL_DATASTORE', None) or '127.0.0.1'
 
 seed = None
+stale = False
+# Called with the new seed every time it is (re)loaded.
+refresh_hooks = []
 
 
 def _get_bucket(bucket_name=SEED_BUCKET):
@@ -20,15 +23,24 @@ def _get_bucket(bucket_name=SEED_BUCKET):
 
 
 def get_config(force_refresh=False, static_seed=os.getenv("AL_SEED_STATIC", None)):
-    global seed  # pylint: disable=W0603
-    if force_refresh or not seed:
+    global seed, stale  # pylint: disable=W0603
+    if force_refresh or stale or not seed:
+        stale = False
         if static_seed:
             seed = easydict.EasyDict(module_attribute_by_name(static_seed))
         else:
             seed = easydict.EasyDict(load_seed())
+        for hook in refresh_hooks:
+            hook(seed)
     return seed
 
 
+def invalidate():
+    """ Have the next get_config reload the seed. """
+    global stale  # pylint: disable=W0603
+    stale = True
+
+
 def load_profile(name):
     attempt = 0
     while True:
@@ -1,10 +1,35 @@
 import importlib
+import logging
+import threading
 
 from easydict import EasyDict
 
 from assemblyline.common.importing import module_attribute_by_name
+from assemblyline.al.common import config_riak, sharding
 from assemblyline.al.common.config_riak import get_config
 
+CONFIG_CHANGES_CHANNEL = 'config-changes'
+
+log = logging.getLogger('assemblyline.forge')
+
+# Process wide instances. Rebuilt when the config is reloaded.
+_classification = None
+_overrides = None
+_routers = {}
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def _on_config_refresh(_):
+    global _classification  # pylint: disable=W0603
+    _classification = None
+    _routers.clear()
+    if _overrides:
+        apply_overrides(_overrides)
+
+
+config_riak.refresh_hooks.append(_on_config_refresh)
+
 
 def _dynamic_import(path):
     if not path:
@@ -13,11 +38,15 @@ def _dynamic_import(path):
 
 
 def apply_overrides(overrides):
+    global _overrides  # pylint: disable=W0603
     config = get_config()
     msgs = []
     if not overrides:
         return msgs
 
+    # Kept so they can be applied again if the config is reloaded.
+    _overrides = overrides
+
     parent_ip = overrides.get('parent_ip', None)
     if parent_ip and config.workers.virtualmachines.use_parent_as_datastore:
         config.datastore.hosts = [parent_ip]
@@ -29,26 +58,57 @@ def apply_overrides(overrides):
     return msgs
 
 
+# Hex digits of the key the xor router combines, per component.
+_ROUTER_KEYS = {
+    'dispatcher': slice(-12, None),
+    'middleman': slice(None, 4),
+}
+
+
+def get_shard_router(component, shards=None):
+    """ Returns the router of component ('dispatcher' or 'middleman').
+
+    Passing a number of shards different from the configured one returns a
+    router for that number of shards, without migration. """
+    component_config = get_config().core[component]
+    if shards and int(shards) != int(component_config.shards):
+        return sharding.create_router(component_config.get('router', None), shards, _ROUTER_KEYS[component])
+
+    router = _routers.get(component, None)
+    if router is None:
+        router = _routers[component] = sharding.create_router(
+            component_config.get('router', None),
+            component_config.shards,
+            _ROUTER_KEYS[component],
+            component_config.get('router_migration', None),
+        )
+    return router
+
+
 # noinspection PyShadowingNames
-def determine_dispatcher(sid, shards=None):
-    if not shards:
-        shards = get_config().core.dispatcher.shards
-    n = reduce(lambda x, y: x ^ y, [int(y, 16) for y in sid[-12:]])
-    return n % shards
+def determine_dispatcher(sid, shards=None, previous=False):
+    router = get_shard_router('dispatcher', shards)
+    if previous:
+        return router.previous_route(sid)
+    return router.route(sid)
 
 
 # noinspection PyShadowingNames
-def determine_ingest_queue(sha256, shards=None):
-    if not shards:
-        shards = get_config().core.middleman.shards
-    n = reduce(lambda x, y: x ^ y, [int(y, 16) for y in sha256[:4]])
-    return 'm-ingest-' + str(n % shards)
+def determine_ingest_queue(sha256, shards=None, previous=False):
+    router = get_shard_router('middleman', shards)
+    if previous:
+        return 'm-ingest-' + str(router.previous_route(sha256))
+    return 'm-ingest-' + str(router.route(sha256))
 
 
-def get_classification():
-    config = get_config()
-    classification = _dynamic_import(config.system.classification.engine)
-    return classification(config.system.classification.definition)
+def get_classification(force_refresh=False):
+    global _classification  # pylint: disable=W0603
+    config = get_config(force_refresh=force_refresh)
+    classification = _classification
+    if classification is None:
+        engine = _dynamic_import(config.system.classification.engine)
+        classification = _classification = engine(config.system.classification.definition)
+    return classification
 
 
 def get_constants():
@@ -68,7 +128,7 @@ def get_create_alert():
 
 def get_control_queue(name):
     from assemblyline.al.common.queue import NamedQueue
-    return NamedQueue(name)
+    return NamedQueue(name, strip=True)
 
 
 def get_country_code_map():
@@ -122,7 +182,7 @@ def get_metrics_sink():
 
 def get_service_queue(service_name):
     from assemblyline.al.common.queue import PriorityQueue
-    return PriorityQueue(name='Service-%s' % service_name)
+    return PriorityQueue(name='Service-%s' % service_name, strip=True)
 
 
 def get_site_specific_apikey_handler():
@@ -174,3 +234,35 @@ def get_yara_importer():
 def get_yara_parser():
     config = get_config()
     return _dynamic_import(config.system.yara.parser)
+
+
+def invalidate_config():
+    """ Have the next get_config and get_classification reload them. """
+    config_riak.invalidate()
+
+
+def notify_config_changed():
+    """ Tell every watching process that the seed has changed. """
+    from assemblyline.al.common.queue import CommsQueue
+    CommsQueue(CONFIG_CHANGES_CHANNEL).publish({'changed': True})
+
+
+def watch_config_changes():
+    """ Start, once per process, a thread invalidating the config and the
+    classification when a change is published on CONFIG_CHANGES_CHANNEL. """
+    global _watcher  # pylint: disable=W0603
+    with _watcher_lock:
+        if _watcher:
+            return _watcher
+
+        def listen():
+            from assemblyline.al.common.queue import CommsQueue
+            for msg in CommsQueue(CONFIG_CHANGES_CHANNEL).listen():
+                if msg.get('type', None) == 'message':
+                    log.info('Config change notification received.')
+                    invalidate_config()
+
+        _watcher = threading.Thread(target=listen, name='config-watcher')
+        _watcher.daemon = True
+        _watcher.start()
+        return _watcher
@@ -0,0 +1,170 @@
+""" Day journals of datastore keys.
+
+The journalist appends keys to one file per day (<day><suffix>) and expiry
+loads the files once they are past their ttl. Closed journals of previous
+days can be gzip compressed. Late keys for a day that was already compressed
+go to a new plain file so a day can have several journal files.
+"""
+import Queue
+import gzip
+import io
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+from assemblyline.common.isotime import now_as_iso
+
+COMPRESSING = '.compressing'
+log = logging.getLogger('assemblyline.journal')
+
+
+def is_journal(filename, name):
+    """ Whether filename is a complete (plain or compressed) journal of name. """
+    return filename.endswith('.' + name) or filename.endswith('.' + name + '.gz') or \
+        ('.' + name + '.' in filename and filename.endswith('.gz'))
+
+
+def read_journal(path, chunk_size=1000):
+    """ Yields the keys of a plain or compressed journal in lists of up to
+    chunk_size keys. """
+    if path.endswith('.gz'):
+        fh = io.BufferedReader(gzip.open(path, 'rb'))
+    else:
+        fh = io.open(path, 'rb')
+
+    with fh:
+        chunk = []
+        for line in fh:
+            line = line.strip()
+            if line:
+                chunk.append(line)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+
+def compress_journal(path):
+    """ Compresses path (a journal renamed with the COMPRESSING suffix). """
+    journal = path[:-len(COMPRESSING)]
+    target = journal + '.gz'
+    if os.path.exists(target):
+        target = '%s.%d.gz' % (journal, int(time.time() * 1000))
+
+    partial = target + '.part'
+    with io.open(path, 'rb') as src:
+        dst = gzip.open(partial, 'wb')
+        try:
+            while True:
+                block = src.read(1024 * 1024)
+                if not block:
+                    break
+                dst.write(block)
+        finally:
+            dst.close()
+
+    os.rename(partial, target)
+    os.unlink(path)
+    log.info("Compressed %s to %s", journal, target)
+
+
+class JournalWriter(object):
+    """ Appends keys to day journals.
+
+    Writes are buffered and flushed every flush_interval seconds or when
+    flush_bytes have been written. The max_open_files most recently used
+    journals are kept open. Journals are fsynced when they are closed and,
+    with compress, journals of previous days are compressed in the
+    background once closed.
+    """
+
+    def __init__(self, directory, suffix, max_open_files=8, flush_interval=1.0,
+                 flush_bytes=1024 * 1024, compress=False):
+        self.directory = directory
+        self.suffix = suffix
+        self.max_open_files = max_open_files
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+        self.compress = compress
+        self.handles = OrderedDict()
+        self.last_flush = time.time()
+        self.pending_bytes = 0
+        self.to_compress = Queue.Queue()
+        self.compressor = None
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if compress:
+            self.compressor = threading.Thread(target=self._compress, name='journal_compressor')
+            self.compressor.daemon = True
+            self.compressor.start()
+            # Journals that were being compressed when we last went down.
+            for filename in os.listdir(directory):
+                if filename.endswith(self.suffix + COMPRESSING):
+                    self.to_compress.put(os.path.join(directory, filename))
+
+    def _compress(self):
+        while True:
+            path = self.to_compress.get()
+            if path is None:
+                break
+            # noinspection PyBroadException
+            try:
+                compress_journal(path)
+            except:  # pylint: disable=W0702
+                log.exception("Problem compressing %s:", path)
+
+    def _get_filehandle(self, day):
+        path = os.path.join(self.directory, day) + self.suffix
+        fh = self.handles.pop(path, None)
+        if fh is None:
+            fh = open(path, 'ab', 64 * 1024)
+            while len(self.handles) >= self.max_open_files:
+                self._close(*self.handles.popitem(last=False))
+
+        # Most recently used last.
+        self.handles[path] = fh
+        return fh
+
+    def _close(self, path, fh):
+        log.info("Closing file %s", path)
+        fh.flush()
+        os.fsync(fh.fileno())
+        fh.close()
+
+        day = os.path.basename(path)[:10]
+        if self.compress and day < now_as_iso()[:10]:
+            # Renamed right away so a late key for this day starts a new file.
+            os.rename(path, path + COMPRESSING)
+            self.to_compress.put(path + COMPRESSING)
+
+    def write(self, day, keys):
+        data = ''.join(k + '\n' for k in keys)
+        self._get_filehandle(day).write(data)
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.flush_bytes:
+            self.flush()
+
+    def flush(self, force=False):
+        if not force and not self.pending_bytes:
+            return
+        if not force and self.pending_bytes < self.flush_bytes and \
+                time.time() - self.last_flush < self.flush_interval:
+            return
+
+        for fh in self.handles.itervalues():
+            fh.flush()
+        self.pending_bytes = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        while self.handles:
+            self._close(*self.handles.popitem(last=False))
+        if self.compressor:
+            self.to_compress.put(None)
+            self.compressor.join()
@@ -3,15 +3,141 @@
 import json
 import time
 import uuid
+import zlib
 
 from Queue import Empty, Queue
 
 from assemblyline.common.exceptions import get_stacktrace_info
 from assemblyline.common.isotime import now_as_iso
-from assemblyline.al.common import forge
-from assemblyline.al.common.task import Task
+from assemblyline.al.common import config_riak, forge
+from assemblyline.al.common.task import Task, parent as task_fields
 from assemblyline.al.common.remote_datatypes import get_client, log, redis, retry_call
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Queue payloads are either JSON text or, for the binary formats, a two byte
+# header (CODEC_MAGIC and the format) followed by the body. JSON never starts
+# with a NUL byte so readers can always tell them apart and nodes writing
+# different formats can share queues. Upgrade every node before switching
+# writers to msgpack.
+CODEC_MAGIC = '\x00'
+FORMAT_MSGPACK = '\x01'
+FORMAT_MSGPACK_ZLIB = '\x02'
+
+_codec = None
+
+
+class Codec(object):
+    def __init__(self, name='json', compress_threshold=0):
+        if name == 'msgpack' and msgpack is None:
+            log.warning('msgpack is not installed. Queue messages will be sent as JSON.')
+            name = 'json'
+        if name not in ('json', 'msgpack'):
+            raise ValueError("Unknown queue codec: %s" % name)
+        self.name = name
+        self.compress_threshold = compress_threshold
+
+    def dumps(self, message):
+        if self.name == 'json':
+            return json.dumps(message)
+
+        body = msgpack.packb(message, use_bin_type=False)
+        if self.compress_threshold and len(body) >= self.compress_threshold:
+            return CODEC_MAGIC + FORMAT_MSGPACK_ZLIB + zlib.compress(body)
+        return CODEC_MAGIC + FORMAT_MSGPACK + body
+
+
+def _unpack(body):
+    # Strings are returned as unicode, as they are with JSON.
+    if msgpack.version >= (0, 5, 2):
+        return msgpack.unpackb(body, raw=False)
+    return msgpack.unpackb(body, encoding='utf-8')
+
+
+def _reset_codec(_):
+    global _codec  # pylint: disable=W0603
+    _codec = None
+
+
+config_riak.refresh_hooks.append(_reset_codec)
+
+
+def get_codec():
+    global _codec  # pylint: disable=W0603
+    if _codec is None:
+        redis_config = forge.get_config().core.redis
+        _codec = Codec(redis_config.get('queue_codec', 'json'),
+                       redis_config.get('queue_compress_threshold', 0))
+    return _codec
+
+
+def strip_none(message):
+    """Drop the None Task fields of a task's raw (top level fields and the
+    fields of its sections). Task reads them back as None anyway. Other keys,
+    and the content of opaque sections like result, are left alone."""
+    if not isinstance(message, dict):
+        return message
+    stripped = {}
+    for k, v in message.iteritems():
+        if task_fields.get(k, None) is False:
+            if v is None:
+                continue
+            if isinstance(v, dict):
+                v = dict((ik, iv) for ik, iv in v.iteritems()
+                         if iv is not None or task_fields.get(ik, None) != k)
+        stripped[k] = v
+    return stripped
+
+
+def dumps(message, strip=False):
+    if strip:
+        message = strip_none(message)
+    return get_codec().dumps(message)
+
+
+def loads(data):
+    if data[:1] != CODEC_MAGIC:
+        return json.loads(data)
+
+    fmt, body = data[1:2], data[2:]
+    if msgpack is None:
+        raise ValueError("Can't decode msgpack queue message: msgpack is not installed")
+    if fmt == FORMAT_MSGPACK_ZLIB:
+        return _unpack(zlib.decompress(body))
+    if fmt == FORMAT_MSGPACK:
+        return _unpack(body)
+    raise ValueError("Unknown queue message format: %r" % fmt)
+
+
+def pipelined(c, *commands):
+    """Issue commands, (method name, args...) tuples, in one round trip."""
+    def execute():
+        pipe = c.pipeline(transaction=False)
+        for command in commands:
+            getattr(pipe, command[0])(*command[1:])
+        return pipe.execute()
+
+    return retry_call(execute)
+
+
+def push_all(items):
+    """Push (NamedQueue, message) pairs using one pipeline per Redis pool."""
+    commands = {}
+    clients = {}
+    for q, message in items:
+        pool = q.c.connection_pool
+        clients[pool] = q.c
+        cmds = commands.setdefault(pool, [])
+        cmds.append(('rpush', q.name, dumps(message, q.strip)))
+        if q.ttl:
+            cmds.append(('expire', q.name, q.ttl))
+
+    for pool, cmds in commands.iteritems():
+        pipelined(clients[pool], *cmds)
+
 
 def reply_queue_name(suffix=None):
     components = [now_as_iso(), str(uuid.uuid4())]
@@ -64,6 +190,17 @@ class LocalQueue(Queue):
             result = None
         return result
 
+    def pop_many(self, num, timeout=None):
+        """Block for the first message then take up to num without waiting."""
+        result = []
+        message = self.pop(timeout=timeout)
+        while message is not None:
+            result.append(message)
+            if len(result) >= num:
+                break
+            message = self.pop(blocking=False)
+        return result
+
     def push(self, *messages):
         for message in messages:
             self.put(message)
@@ -72,6 +209,7 @@ class LocalQueue(Queue):
 class MultiQueue(object):
     def __init__(self, host=None, port=None, db=None, private=False):
         self.c = get_client(host, port, db, private)
+        self.r = self.c.register_script(nq_pop_script)
 
     def delete(self, name):
         retry_call(self.c.delete, name)
@@ -95,13 +233,30 @@ class MultiQueue(object):
             return response
 
         if blocking:
-            return json.loads(response[1])
+            return loads(response[1])
         else:
-            return json.loads(response)
+            return loads(response)
+
+    def pop_many(self, name, num):
+        """Pop up to num messages off the head of the named queue at once."""
+        if num < 1:
+            return []
+        try:
+            response = retry_call(self.r, args=[name, num - 1])
+        except redis.ConnectionError as ex:
+            trace = get_stacktrace_info(ex)
+            log.warning('Redis connection error (7): %s', trace)
+            return []
+
+        return [loads(s) for s in response or []]
 
     def push(self, name, *messages):
-        for message in messages:
-            retry_call(self.c.rpush, name, json.dumps(message))
+        self.push_many(name, messages)
+
+    def push_many(self, name, messages):
+        if not messages:
+            return
+        retry_call(self.c.rpush, name, *[dumps(m) for m in messages])
 
     def length(self, name):
         return retry_call(self.c.llen, name)
@@ -109,10 +264,14 @@ class MultiQueue(object):
 
 class NamedQueue(object):
     def __init__(
-        self, name, host=None, port=None, db=None, private=False, ttl=0
+        self, name, host=None, port=None, db=None, private=False, ttl=0,
+        strip=False
     ):
         self.c = get_client(host, port, db, private)
+        self.r = self.c.register_script(nq_pop_script)
         self.name = name
+        # Strip None fields from (Task) messages before they are sent.
+        self.strip = strip
         self.ttl = ttl
 
     def delete(self):
@@ -127,7 +286,7 @@ class NamedQueue(object):
         if not response:
             return None
         else:
-            return json.loads(response[0])
+            return loads(response[0])
 
     def pop(self, blocking=True, timeout=0):
         if blocking:
@@ -148,22 +307,43 @@ class NamedQueue(object):
             return response
 
         if blocking:
-            return json.loads(response[1])
+            return loads(response[1])
         else:
-            return json.loads(response)
+            return loads(response)
+
+    def pop_many(self, num):
+        """Pop up to num messages off the head of the FIFO queue at once."""
+        if num < 1:
+            return []
+        try:
+            response = retry_call(self.r, args=[self.name, num - 1])
+        except redis.ConnectionError as ex:
+            trace = get_stacktrace_info(ex)
+            log.warning('Redis connection error (8): %s', trace)
+            return []
+
+        return [loads(s) for s in response or []]
 
     def push(self, *messages):
-        for message in messages:
-            retry_call(self.c.rpush, self.name, json.dumps(message))
-        if self.ttl:
-            retry_call(self.c.expire, self.name, self.ttl)
+        self.push_many(messages)
+
+    def push_many(self, messages):
+        """Append all messages with one rpush and a single TTL refresh."""
+        self._add_many('rpush', messages)
 
     def unpop(self, *messages):
         """Put all messages passed back at the head of the FIFO queue."""
-        for message in messages:
-            retry_call(self.c.lpush, self.name, json.dumps(message))
+        self._add_many('lpush', messages)
+
+    def _add_many(self, command, messages):
+        if not messages:
+            return
+        values = [dumps(m, self.strip) for m in messages]
         if self.ttl:
-            retry_call(self.c.expire, self.name, self.ttl)
+            pipelined(self.c, (command, self.name) + tuple(values),
+                      ('expire', self.name, self.ttl))
+        else:
+            retry_call(getattr(self.c, command), self.name, *values)
 
 
 def select(*queues, **kw):
@@ -193,7 +373,14 @@ def select(*queues, **kw):
     if not response:
         return response
 
-    return response[0], json.loads(response[1])
+    return response[0], loads(response[1])
+
+# ARGV[1]: <queue name>, ARGV[2]: <max items to pop minus one>.
+nq_pop_script = """
+local result = redis.call('lrange', ARGV[1], 0, ARGV[2])
+if result then redis.call('ltrim', ARGV[1], ARGV[2] + 1, -1) end
+return result
+"""
 
 # ARGV[1]: <queue name>, ARGV[2]: <max items to pop minus one>.
 pq_pop_script = """
@@ -210,6 +397,22 @@ local vip = string.format('%1d', ARGV[3])
 redis.call('zadd', ARGV[1], 0 - ARGV[2], vip..seq..ARGV[4])
 """
 
+# ARGV[1]: <queue name>, ARGV[2..]: <priority>, <vip>, <item (string) to
+# push> repeated for each item. Sequence numbers are reserved in one incrby.
+pq_push_many_script = """
+local count = (#ARGV - 1) / 3
+local last = redis.call('incrby', 'global-sequence', count)
+local args = {}
+for i = 0, count - 1 do
+    local seq = string.format('%020d', last - count + 1 + i)
+    local vip = string.format('%1d', ARGV[3 + i * 3])
+    args[#args + 1] = 0 - ARGV[2 + i * 3]
+    args[#args + 1] = vip..seq..ARGV[4 + i * 3]
+end
+redis.call('zadd', ARGV[1], unpack(args))
+return count
+"""
+
 # ARGV[1]: <queue name>, ARGV[2]: <max items to unpush>.
 pq_unpush_script = """
 local result = redis.call('zrange', ARGV[1], 0 - ARGV[2], 0 - 1)
@@ -218,22 +421,53 @@ return result
 """
 
 
+# ARGV[1]: <queue name>, ARGV[2..]: <time due>, <item (string) to push>
+# repeated for each item.
+dq_push_script = """
+local count = (#ARGV - 1) / 2
+local seq = redis.call('incrby', 'global-sequence', count) - count
+local args = {}
+for i = 0, count - 1 do
+    args[#args + 1] = ARGV[2 + i * 2]
+    args[#args + 1] = string.format('%020d', seq + 1 + i)..ARGV[3 + i * 2]
+end
+redis.call('zadd', ARGV[1], unpack(args))
+return count
+"""
+
+# ARGV[1]: <queue name>, ARGV[2]: <now>, ARGV[3]: <max items to pop>.
+dq_pop_script = """
+local result = redis.call('zrangebyscore', ARGV[1], '-inf', ARGV[2], 'LIMIT', 0, ARGV[3])
+if #result > 0 then redis.call('zrem', ARGV[1], unpack(result)) end
+return result
+"""
+
+
+# Bound the number of items sent to a single push_many script call (the
+# arguments are unpacked onto the Lua stack).
+push_batch_size = 1000
+
+
 # noinspection PyBroadException
 def decode(data):
     try:
-        return json.loads(data)
+        return loads(data)
     except:  # pylint: disable=W0702
         log.warning("Invalid data on queue: %s", str(data))
         return None
 
 
 class PriorityQueue(object):
-    def __init__(self, name, host=None, port=None, db=None, private=False):
+    def __init__(self, name, host=None, port=None, db=None, private=False,
+                 strip=False):
         self.c = get_client(host, port, db, private)
         self.r = self.c.register_script(pq_pop_script)
         self.s = self.c.register_script(pq_push_script)
         self.t = self.c.register_script(pq_unpush_script)
+        self.u = self.c.register_script(pq_push_many_script)
         self.name = name
+        # Strip None fields from (Task) messages before they are sent.
+        self.strip = strip
 
     def count(self, lowest, highest):
         return retry_call(self.c.zcount, self.name, -highest, -lowest)
@@ -257,13 +491,25 @@ class PriorityQueue(object):
 
     def push(self, priority, data, vip=None):
         vip = 0 if vip else 9
-        retry_call(self.s, args=[self.name, priority, vip, json.dumps(data)])
+        retry_call(self.s, args=[self.name, priority, vip, dumps(data, self.strip)])
+
+    def push_many(self, items):
+        """Push (priority, data) or (priority, data, vip) tuples in batches."""
+        args = []
+        for item in items:
+            vip = 0 if len(item) > 2 and item[2] else 9
+            args.extend((item[0], vip, dumps(item[1], self.strip)))
+            if len(args) >= 3 * push_batch_size:
+                retry_call(self.u, args=[self.name] + args)
+                args = []
+        if args:
+            retry_call(self.u, args=[self.name] + args)
 
     def unpush(self, num=1):
         if num < 0:
             return []
         try:
-            return [json.loads(s[21:])
+            return [loads(s[21:])
                     for s in retry_call(self.t, args=[self.name, num])]
         except redis.ConnectionError as ex:
             trace = get_stacktrace_info(ex)
@@ -271,6 +517,48 @@ class PriorityQueue(object):
             return []
 
 
+class DelayQueue(object):
+    """Messages only become available to pop once their delay has elapsed."""
+    def __init__(self, name, host=None, port=None, db=None, private=False):
+        self.c = get_client(host, port, db, private)
+        self.r = self.c.register_script(dq_pop_script)
+        self.s = self.c.register_script(dq_push_script)
+        self.name = name
+
+    def delete(self):
+        retry_call(self.c.delete, self.name)
+
+    def length(self):
+        return retry_call(self.c.zcard, self.name)
+
+    def pop_ready(self, num=1):
+        """Pop up to num messages whose delay has elapsed, oldest first."""
+        if num < 1:
+            return []
+        try:
+            response = retry_call(self.r, args=[self.name, time.time(), num])
+        except redis.ConnectionError as ex:
+            trace = get_stacktrace_info(ex)
+            log.warning('Redis connection error (9): %s', trace)
+            return []
+
+        return [decode(s[20:]) for s in response or []]
+
+    def push(self, delay, *messages):
+        """Push messages to be popped in delay seconds."""
+        if not messages:
+            return
+        due = time.time() + delay
+        args = []
+        for m in messages:
+            args.extend((due, dumps(m)))
+            if len(args) >= 2 * push_batch_size:
+                retry_call(self.s, args=[self.name] + args)
+                args = []
+        if args:
+            retry_call(self.s, args=[self.name] + args)
+
+
 class DispatchQueue(object):
     def __init__(self, host=None, port=None, db=None):
         config = forge.get_config()
@@ -282,7 +570,7 @@ class DispatchQueue(object):
     def _get_queue(self, n):
         q = self.q.get(n, None)
         if not q:
-            self.q[n] = q = PriorityQueue(n, self.host, self.port, self.db)
+            self.q[n] = q = PriorityQueue(n, self.host, self.port, self.db, strip=True)
         return q
 
     def length(self, name):
@@ -292,6 +580,9 @@ class DispatchQueue(object):
         return self._get_queue(name).pop(num)
 
     def send(self, task, shards=None, queue_name=None):
+        self.send_many([task], shards, queue_name)
+
+    def send_many(self, tasks, shards=None, queue_name=None):
         if queue_name is None:
             queue_name = {}
 
@@ -299,15 +590,24 @@ class DispatchQueue(object):
             config = forge.get_config()
             shards = config.core.dispatcher.shards
 
-        if not task.dispatch_queue:
-            n = forge.determine_dispatcher(task.sid, shards)
-            name = queue_name.get(n, None)
-            if not name:
-                queue_name[n] = name = 'ingest-queue-' + str(n)
-            task.dispatch_queue = name
-        if not task.priority:
-            task.priority = 0
-        self._get_queue(task.dispatch_queue).push(task.priority, task.raw)
+        router = forge.get_shard_router('dispatcher', shards)
+
+        batches = {}
+        for task in tasks:
+            if not task.dispatch_queue:
+                n = router.route(task.sid)
+                name = queue_name.get(n, None)
+                if not name:
+                    queue_name[n] = name = 'ingest-queue-' + str(n)
+                task.dispatch_queue = name
+            if not task.priority:
+                task.priority = 0
+            batches.setdefault(task.dispatch_queue, []).append(
+                (task.priority, task.raw)
+            )
+
+        for name, items in batches.iteritems():
+            self._get_queue(name).push_many(items)
 
     def send_raw(self, raw, shards=None):
         if not shards:
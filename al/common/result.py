@@ -83,6 +83,71 @@ FILE_SUMMARY = StringTable('FILE_SUMMARY', constants.FILE_SUMMARY)
 
 log = logging.getLogger('assemblyline.svc.common.result')
 
+# Validation results memoized per distinct tag type, classification and
+# (tag type, context) so services emitting thousands of tags only pay for
+# each check once.
+_valid_tag_types = {}
+_valid_classifications = {}
+_valid_contexts = {}
+
+
+def _memoized(cache, key, check, *args):
+    try:
+        return cache[key]
+    except KeyError:
+        valid = cache[key] = check(*args)
+        return valid
+    except TypeError:
+        # Unhashable value.
+        return check(*args)
+
+
+def is_valid_tag_type(tag_type):
+    return _memoized(_valid_tag_types, tag_type, TAG_TYPE.contains_value, tag_type)
+
+
+def is_valid_classification(classification):
+    return _memoized(_valid_classifications, classification, Classification.is_valid, classification)
+
+
+def is_valid_context(tag_type, context):
+    return _memoized(_valid_contexts, (tag_type, context), Context.verify_context, tag_type, context)
+
+
+class TagList(list):
+    """ A list of tag dicts indexed on (type, value).
+
+    It serializes like the plain list it used to be but membership checks
+    are constant time. The index is rebuilt if the list is modified
+    directly.
+    """
+
+    def __init__(self, tags=()):
+        super(TagList, self).__init__(tags)
+        self._index = None
+        self._indexed_len = -1
+
+    def _sync(self):
+        if self._indexed_len != len(self):
+            self._index = set((t['type'], t['value']) for t in self)
+            self._indexed_len = len(self)
+        return self._index
+
+    def add(self, tag):
+        """ Appends tag unless one with the same type and value is present.
+        Returns whether it was added. """
+        key = (tag['type'], tag['value'])
+        index = self._sync()
+        if key in index:
+            return False
+        index.add(key)
+        self.append(tag)
+        self._indexed_len += 1
+        return True
+
+    def has(self, tag_type, value):
+        return (tag_type, value) in self._sync()
+
 
 class Tag(object):
 
@@ -149,7 +214,7 @@ class ResultSection(dict):
         self.body_format = body_format
         self.links = []
         self.subsections = []
-        self.tags = tags or []
+        self.tags = TagList(tags or [])
         self.depth = 0
         self.finalized = False
         self.truncated = False
@@ -165,7 +230,7 @@ class ResultSection(dict):
     def _warn_on_validation_errors(self):
         if not (isinstance(self.score, int) and 2000 >= self.score >= -1000):
             log.warn("invalid score: %s", str(self.score))
-        if not Classification.is_valid(self.classification):
+        if not is_valid_classification(self.classification):
             tb = traceback.format_stack(limit=4)
             log.warn("invalid classification:%s.\n%s", str(self.classification), str(tb))
         if not isinstance(self.title_text, basestring):
@@ -205,13 +270,10 @@ class ResultSection(dict):
         tag = {'type': tag_type, 'value': safe_str(value), 'weight': weight, 'usage': usage,
                'classification': classification, 'context': context}
 
-        for existing_tag in self.tags:
-            if existing_tag['type'] == tag['type'] and \
-               existing_tag['value'] == tag['value']:
-                return
-        self.tags.append(tag)
+        if not self.tags.add(tag):
+            return
 
-        if not TAG_TYPE.contains_value(tag_type):
+        if not is_valid_tag_type(tag_type):
             log.warn("Invalid tag_type: %s", tag_type)
         if len(value) <= 0 or len(value) >= 2048:
             log.warn("invalid tag_value: %s:'%s'", tag_type, safe_str(value))
@@ -219,13 +281,17 @@ class ResultSection(dict):
             log.warn("invalid weight: %s", weight)
         if usage and not TAG_USAGE.contains_value(usage):
             log.warn("invalid tag usage: %s", usage)
-        if not Classification.is_valid(classification):
+        if not is_valid_classification(classification):
             tb = traceback.format_stack(limit=4)
             log.warn("invalid classification:%s.\n%s", str(self.classification), str(tb))
         if context:
-            if not Context.verify_context(tag_type, context):
+            if not is_valid_context(tag_type, context):
                 log.warn("Invalid tag_type: %s and context: %s combination" % (tag_type, context))
 
+    def merge_tag(self, tag):
+        """ Adds a tag that was already validated by a subsection. """
+        self.tags.add(tag)
+
     def change_score(self, new_score):
         self.score = new_score
 
@@ -257,8 +323,7 @@ class ResultSection(dict):
                 Classification.max_classification(self.classification, self.parent.classification)
             self.parent.score += self.score
             for tag in self.tags:
-                self.parent.add_tag(tag['type'], tag['value'], tag['weight'], usage=tag['usage'],
-                                    classification=tag['classification'], context=tag['context'])
+                self.parent.merge_tag(tag)
         self.pop('tags')
         self.pop('parent')
         return keep_me
@@ -272,6 +337,8 @@ class ResultSection(dict):
     def __setattr__(self, attr, val):
         if attr not in self.allowed:
             raise Exception('This field is not valid in a ResultSection: %s' % attr)
+        if attr == 'tags' and not isinstance(val, TagList):
+            val = TagList(val or [])
         self[attr] = val
 
 
@@ -310,7 +377,7 @@ class Result(dict):
                  default_usage=None
                  ):
         super(Result, self).__init__()
-        self.tags = tags or []
+        self.tags = TagList(tags or [])
         self.tags_score = 0
         self.classification = classification
         self.score = score
@@ -333,13 +400,10 @@ class Result(dict):
         tag = {'type': tag_type, 'value': safe_str(value), 'weight': weight, 'usage': usage or self.default_usage,
                'classification': classification, 'context': context}
 
-        for existing_tag in self.tags:
-            if existing_tag['type'] == tag['type'] and \
-               existing_tag['value'] == tag['value']:
-                return
-        self.tags.append(tag)
+        if not self.tags.add(tag):
+            return
 
-        if not TAG_TYPE.contains_value(tag_type):
+        if not is_valid_tag_type(tag_type):
             tb = traceback.format_stack(limit=4)
             log.warn("Invalid tag_type: %s -- %s", tag_type, tb)
         if len(value) <= 0 or len(value) >= 2048:
@@ -349,13 +413,19 @@ class Result(dict):
             log.warn("invalid weight: %s", weight)
         if usage and not TAG_USAGE.contains_value(usage):
             log.warn("invalid tag usage: %s", usage)
-        if not Classification.is_valid(classification):
+        if not is_valid_classification(classification):
             tb = traceback.format_stack(limit=4)
             log.warn("invalid classification:%s.\n%s", str(self.classification), str(tb))
         if context:
-            if not Context.verify_context(tag_type, context):
+            if not is_valid_context(tag_type, context):
                 log.warn("Invalid tag_type: %s and context: %s combination" % (tag_type, context))
 
+    def merge_tag(self, tag):
+        """ Adds a tag that was already validated by a subsection. """
+        if not tag['usage'] and self.default_usage:
+            tag = dict(tag, usage=self.default_usage)
+        self.tags.add(tag)
+
     # for legacy use only
     def add_result(self, section, on_top=False):
         self.add_section(section)
@@ -410,4 +480,6 @@ class Result(dict):
     def __setattr__(self, attr, val):
         if attr not in self.allowed:
             raise Exception('This field is not valid in a Result: %s' % attr)
+        if attr == 'tags' and not isinstance(val, TagList):
+            val = TagList(val or [])
         self[attr] = val
@@ -0,0 +1,110 @@
+""" Routing of submissions (sid) and ingested files (sha256) to shards.
+
+Routers are selected per component with core.<component>.router:
+
+    xor      The original routing. XORs hex digits of the key together so
+             it can only address 16 shards. Kept as the default so that an
+             existing deployment routes exactly as it used to.
+    uniform  md5 of the key modulo the number of shards.
+    ring     Consistent-hash ring. Changing the number of shards only moves
+             about 1/shards of the keys.
+
+A dotted path to a ShardRouter subclass can also be given.
+
+While shards are being rebalanced, core.<component>.router_migration holds
+the previous layout ({'router': 'xor', 'shards': 8}). Keys are routed with
+the new layout but the previous one stays available (router.previous) so
+state held by the old owners can still be found and queues of shards that
+no longer exist can be drained.
+"""
+import bisect
+import hashlib
+
+from assemblyline.common.importing import module_attribute_by_name
+
+DEFAULT_ROUTER = 'xor'
+RING_REPLICAS = 160
+
+
+def _hash(key):
+    return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+
+class ShardRouter(object):
+    def __init__(self, shards, key_slice=None, previous=None):
+        self.shards = int(shards)
+        if self.shards < 1:
+            raise ValueError("Invalid number of shards: %s" % shards)
+        self.key_slice = key_slice or slice(None)
+        self.previous = previous
+
+    def __repr__(self):
+        return '%s(%d)' % (self.__class__.__name__, self.shards)
+
+    @property
+    def migrating(self):
+        return self.previous is not None
+
+    def route(self, key):
+        raise NotImplementedError()
+
+    def previous_route(self, key):
+        """ Shard key was routed to before the current rebalance. """
+        if self.previous is None:
+            return self.route(key)
+        return self.previous.route(key)
+
+    def orphaned_shards(self, shard):
+        """ Shards of the previous layout that no longer exist and whose
+        queues shard is responsible for draining. """
+        if self.previous is None:
+            return []
+        return [
+            i for i in xrange(self.shards, self.previous.shards)
+            if i % self.shards == int(shard)
+        ]
+
+
+class XorRouter(ShardRouter):
+    def route(self, key):
+        n = reduce(lambda x, y: x ^ y, [int(y, 16) for y in key[self.key_slice]])
+        return n % self.shards
+
+
+class UniformRouter(ShardRouter):
+    def route(self, key):
+        return _hash(key) % self.shards
+
+
+class RingRouter(ShardRouter):
+    def __init__(self, shards, key_slice=None, previous=None, replicas=RING_REPLICAS):
+        super(RingRouter, self).__init__(shards, key_slice, previous)
+        points = sorted(
+            (_hash('%d-%d' % (shard, replica)), shard)
+            for shard in xrange(self.shards) for replica in xrange(replicas)
+        )
+        self.points = [p for p, _ in points]
+        self.owners = [s for _, s in points]
+
+    def route(self, key):
+        i = bisect.bisect(self.points, _hash(key))
+        return self.owners[i % len(self.owners)]
+
+
+routers = {
+    'ring': RingRouter,
+    'uniform': UniformRouter,
+    'xor': XorRouter,
+}
+
+
+def create_router(name, shards, key_slice=None, migration=None):
+    name = name or DEFAULT_ROUTER
+    cls = routers.get(name, None) or module_attribute_by_name(name)
+
+    previous = None
+    if migration:
+        previous = create_router(migration.get('router', DEFAULT_ROUTER),
+                                 migration.get('shards', shards), key_slice)
+
+    return cls(shards, key_slice, previous)
@@ -106,6 +106,7 @@ parent = {
                                       #   are used to dispatch. All are useful
                                       #   to services when processing a file).
     'ascii': 'fileinfo',              # +-- Dot-escaped first 64 characters.
+    'entropy': 'fileinfo',            # +-- Shannon entropy of the content.
     'hex': 'fileinfo',                # +-- Hex dump of first 64 bytes.
     'magic': 'fileinfo',              # +-- The output from libmagic which was
                                       #     used to determine the tag.
@@ -114,6 +115,7 @@ parent = {
     'sha1': 'fileinfo',               # +-- SHA1
     'sha256': 'fileinfo',             # +-- SHA256
     'size': 'fileinfo',               # +-- File size
+    'ssdeep': 'fileinfo',             # +-- SSDeep fuzzy hash.
     'tag': 'fileinfo',                # +-- The file type or tag.
     'response': False,                # 
     'cache_key': 'response',          # +-- Used to find cached results.
@@ -145,6 +147,16 @@ def copy(v):
 def dice(d, fields):
     return {k:copy(v) for k, v in d.iteritems() if k in fields}
 
+def view(d, fields, copied=()):
+    """Like dice but the values are shared with d, except for the sections
+    in copied which are shallow copied so they can be modified."""
+    v = {k:d[k] for k in fields if k in d}
+    for k in copied:
+        section = v.get(k, None)
+        if isinstance(section, dict):
+            v[k] = section.copy()
+    return v
+
 def get_service_overrides(getter):
     d = {}
     for k in service_overrides:
@@ -202,37 +214,50 @@ def _requests(children, default_classification):
 def _srls(children):
     return [e[1] for e in children if e[1]]
 
+def _field(name):
+    def get(self):
+        return self.raw.get(name, None)
+
+    def set(self, value):
+        self.raw[name] = value
+
+    return property(get, set)
+
+def _section_field(name, section):
+    def get(self):
+        container = self.raw.get(section, None)
+        if container is None:
+            return None
+        return container.get(name, None)
+
+    def set(self, value):
+        container = self.raw.get(section, None)
+        if container is None:
+            self.raw[section] = container = {}
+        container[name] = value
+
+    return property(get, set)
+
 class Task(object):
-    """Task objects are an abstraction layer over a raw (dict)."""
+    """Task objects are an abstraction layer over a raw (dict).
+
+    Every field in parent is a property of the class (see _install_fields).
+    Reading a field never modifies raw. Other attributes are local to the
+    process and never sent with the task. Services can set any attribute and
+    reading one that was never set returns None."""
+    __slots__ = ('raw', 'from_cache', 'save_result_flag', 'stage', '__dict__')
+
     def __init__(self, raw, **kwargs):
         self.raw = raw
         for k, v in kwargs.iteritems():
             if k in parent:
                 setattr(self, k, v)
 
-    def _container(self, name, check_only=False):
-        has_parent = parent.get(name, None)
-
-        if has_parent is None:
-            return self.__dict__
-        
-        raw = self.raw
-        if raw == None:
-            return None
-        
-        container = raw
-        if has_parent:
-            container = raw.get(has_parent, None)
-            if container is None:
-                if check_only:
-                    return None
-                container = {}
-                raw[has_parent] = container
-
-        if not name in container:
-            container[name] = None
-
-        return container
+    def _container(self, name):
+        section = parent[name]
+        if not section:
+            return self.raw
+        return self.raw.get(section, None)
 
     def add_extracted(self, name, text, display_name=None, classification=None, submission_tag=None):
         if name is None:
@@ -262,19 +287,21 @@ class Task(object):
         self.supplementary.append(Child(name, text, display_name, classification))
         return True
 
+    # The ack, response and service request projections share the sections
+    # they don't modify with this task. They are meant to be sent right away.
     def as_dispatcher_ack(self, seconds=600):
-        return Task(dice(self.raw, dispatcher_ack),
+        return Task(view(self.raw, dispatcher_ack, ('response',)),
                     state='acknowledged', seconds=seconds).raw
 
     def as_dispatcher_response(self):
-        return Task(dice(self.raw, dispatcher_response),
+        return Task(view(self.raw, dispatcher_response),
                     state='serviced').raw
 
     def as_submission_record(self):
         return dice(self.raw, submission_record)
 
     def as_service_request(self, name):
-        t = Task(dice(self.raw, service_request))
+        t = Task(view(self.raw, service_request, ('request',)))
         if self.params:
             t.config = self.params.get(name, None)
         return t.raw
@@ -321,7 +348,7 @@ class Task(object):
         return _srls(self.extracted)
 
     def get(self, name):
-        return self.__getattr__(name)
+        return getattr(self, name)
 
     def get_milestone(self, name):
         if not self.milestones:
@@ -367,7 +394,7 @@ class Task(object):
         self.service_context = context
 
     def remove(self, name):
-        d = self._container(name, check_only=True)
+        d = self._container(name)
         if d is None:
             return
         if name in d:
@@ -458,10 +485,10 @@ class Task(object):
         return cls(arg)
 
     def __getattr__(self, name):
-        return self._container(name)[name]
-
-    def __setattr__(self, name, value):
-        self._container(name)[name] = value
+        # Only called for attributes that were never set.
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
 
     def __repr__(self):
         return self.__class__.__name__ + '(' + str(self.raw) + ')'
@@ -473,3 +500,13 @@ class Task(object):
                 "\n'response': " + str(self.response) + \
                 "\n'result': " + str(self.result)
 
+def _install_fields(cls):
+    for name, section in parent.iteritems():
+        if hasattr(cls, name):
+            continue
+        if section:
+            setattr(cls, name, _section_field(name, section))
+        else:
+            setattr(cls, name, _field(name))
+
+_install_fields(Task)
@@ -1,3 +1,5 @@
+import errno
+
 from assemblyline.common.exceptions import ChainException
 
 
@@ -18,6 +20,18 @@ class TransportException(ChainException):
     pass
 
 
+def is_missing_error(ex):
+    """ Whether ex (or one of its causes) says the file doesn't exist. """
+    while ex is not None:
+        if getattr(ex, 'errno', None) == errno.ENOENT:
+            return True
+        # FTP reports missing files with a 550 reply.
+        if str(ex).startswith('550'):
+            return True
+        ex = getattr(ex, 'cause', None)
+    return False
+
+
 class Transport(object):
     """
     FileTransport base class.
@@ -42,6 +56,20 @@ class Transport(object):
         Deletes the file.
         """
         raise TransportException("Not Implemented")
+
+    def delete_many(self, paths):
+        """
+        Deletes the files. Files that are already gone are not errors.
+        Returns the (path, error) of the deletes that failed.
+        """
+        failed = []
+        for path in paths:
+            try:
+                self.delete(path)
+            except Exception as ex: #pylint: disable=W0703
+                if not is_missing_error(ex):
+                    failed.append((path, str(ex)))
+        return failed
     
     def download(self, src_path, dst_path): # pylint:disable=W0613
         """
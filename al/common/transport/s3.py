@@ -69,6 +69,20 @@ class TransportS3(Transport):
         key = self.normalize(path)
         self.client.delete_object(self.bucket, key)
 
+    def delete_many(self, paths):
+        # S3 deletes are idempotent and up to 1000 keys go in one request.
+        failed = []
+        keys = dict((self.normalize(p), p) for p in paths)
+        names = keys.keys()
+        for i in xrange(0, len(names), 1000):
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': k} for k in names[i:i + 1000]], 'Quiet': True}
+            )
+            for error in response.get('Errors', []):
+                failed.append((keys.get(error.get('Key'), error.get('Key')), error.get('Message', '')))
+        return failed
+
     def download(self, src_path, dst_path):
         key = self.normalize(src_path)
         dir_path = os.path.dirname(dst_path)
@@ -6,6 +6,10 @@ Alerter is responsible for monitoring the alert queue and creating alerts.
 """
 import logging
 import signal
+import threading
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from assemblyline.common import net
 from assemblyline.common.isotime import now
@@ -15,6 +19,7 @@ from assemblyline.al.common import log
 config = forge.get_config()
 log.init_logging("alerter")
 
+from assemblyline.al.common import alerting
 from assemblyline.al.common import counter
 from assemblyline.al.common import queue
 
@@ -25,18 +30,24 @@ persistent_settings = {
 }
 
 alertq_name = 'm-alert'
+batch_size = config.core.alerter.get('batch_size', 100)
 commandq_name = 'a-command'
 create_alert = forge.get_create_alert()
 datastore = forge.get_datastore()
 exit_msgs = ['server closed the connection unexpectedly']
 interval = 3 * 60 * 60
+local = threading.local()
 logger = logging.getLogger('assemblyline.alerter')
 max_consecutive_errors = 100
 max_retries = 10
+max_retry_delay = 60
+retryq_name = 'm-alert-retry'
 running = True
+worker_threads = config.core.alerter.get('threads', 8)
 
 alertq = queue.NamedQueue(alertq_name, **persistent_settings)
 commandq = queue.NamedQueue(commandq_name, **persistent_settings)
+retryq = queue.DelayQueue(retryq_name, **persistent_settings)
 
 # Publish counters to the metrics sink.
 counts = counter.AutoExportingCounters(
@@ -46,7 +57,6 @@ counts = counter.AutoExportingCounters(
     channel=forge.get_metrics_sink(),
     auto_log=True,
     auto_flush=True)
-counts.start()
 
 
 # noinspection PyUnusedLocal
@@ -55,14 +65,70 @@ def interrupt(unused1, unused2):  # pylint:disable=W0613
     logger.info("Caught signal. Coming down...")
     running = False
 
-signal.signal(signal.SIGINT, interrupt)
-signal.signal(signal.SIGTERM, interrupt)
+
+def get_datastore():
+    # Each worker thread has its own datastore connection.
+    store = getattr(local, 'datastore', None)
+    if store is None:
+        local.datastore = store = forge.get_datastore()
+    return store
+
+
+def retry(messages, ex):
+    """ Delays messages[0], which failed with ex, and the messages for the
+    same alert that came after it. Returns False if messages[0] is out of
+    retries and was dropped. """
+    message = messages[0]
+    retries = message['retries'] = message.get('retries', 0) + 1
+    if retries > max_retries:
+        logger.exception('Max retries exceeded for: %s', str(message))
+        return False
+
+    # Retries are delayed, with backoff, without holding up other alerts.
+    # The messages are pushed together so they keep their order.
+    retryq.push(min(2 ** (retries - 1), max_retry_delay), *messages)
+    if not isinstance(ex, alerting.AlertNotReadyException) and \
+            'Submission not finalized' not in str(ex):
+        logger.exception('Unhandled exception processing: %s', str(message))
+    return True
+
+
+def create_alerts(messages):
+    """ Create, in order, alerts with the same alert key. Returns the
+    exceptions raised (None for each success). """
+    store = get_datastore()
+    outcomes = []
+    for i, message in enumerate(messages):
+        try:
+            create_alert(counts, store, logger, message)
+            outcomes.append(None)
+        except Exception as ex:  # pylint: disable=W0703
+            outcomes.append(ex)
+            # Later updates to the alert must not be applied before this one.
+            if retry(messages[i:], ex):
+                break
+    return outcomes
+
+
+def next_batch():
+    messages = retryq.pop_ready(batch_size)
+    if not messages:
+        event = queue.select(alertq, commandq, timeout=1)
+        if not event or event[0] != alertq_name:
+            return []
+        messages.append(event[1])
+    messages += alertq.pop_many(batch_size - len(messages))
+
+    messages = [m for m in messages if m]
+    counts.increment('alert.received', len(messages))
+    return messages
 
 
 def process_alerts():
     global running  # pylint: disable=W0603
 
     consecutive_errors = 0
+    pool = ThreadPool(worker_threads)
 
     end_t = now(interval)
     while running:
@@ -71,44 +137,56 @@ def process_alerts():
             running = False
             break
 
-        event = queue.select(alertq, commandq, timeout=1)
-        if not event:
+        messages = next_batch()
+        if not messages:
             continue
 
-        q_name = event[0]
-        message = event[1]
-        if q_name == alertq_name:
-            counts.increment('alert.received')
-            try:
-                create_alert(counts, datastore, logger, message)
-                consecutive_errors = 0
-            except Exception as ex:  # pylint: disable=W0703
-                consecutive_errors += 1
-                retries = message['retries'] = message.get('retries', 0) + 1
-                if retries > max_retries:
-                    logger.exception('Max retries exceeded for: %s',
-                                     str(message))
-                else:
-                    alertq.push(message)
-                    if 'Submission not finalized' not in str(ex):
-                        logger.exception('Unhandled exception processing: %s',
-                                         str(message))
+        groups = OrderedDict()
+        for message in messages:
+            groups.setdefault(alerting.alert_key(message), []).append(message)
 
+        # noinspection PyBroadException
+        try:
+            alerting.prefetch(datastore, messages)
+        except Exception:  # pylint: disable=W0703
+            logger.exception('Problem prefetching alert data:')
+
+        try:
+            results = pool.map(create_alerts, groups.values())
+        finally:
+            alerting.clear_prefetched()
+
+        for outcomes in results:
+            for ex in outcomes:
+                if ex is None:
+                    consecutive_errors = 0
+                    continue
+
+                consecutive_errors += 1
                 for x in exit_msgs:
                     if x in str(ex):
                         consecutive_errors = max_consecutive_errors + 1
                         break
 
-            if consecutive_errors > max_consecutive_errors:
-                break
+        if consecutive_errors > max_consecutive_errors:
+            break
+
+    pool.close()
+    pool.join()
+
 
+# Importing the alerter (the tests do) must not start it.
+if __name__ == '__main__':
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+    counts.start()
 
-logger.info('Starting...')
-# noinspection PyBroadException
-try:
-    process_alerts()
-except:  # pylint:disable=W0702
-    logger.exception('Unhandled exception while processing alerts:')
+    logger.info('Starting...')
+    # noinspection PyBroadException
+    try:
+        process_alerts()
+    except:  # pylint:disable=W0702
+        logger.exception('Unhandled exception while processing alerts:')
 
-logger.info('Stopping...')
-counts.stop()
+    logger.info('Stopping...')
+    counts.stop()
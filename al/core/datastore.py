@@ -1,16 +1,21 @@
 import logging
 
+import Queue
 import re
+import sys
 import threading
 
 import requests
 import time
 
+from collections import Counter
 from copy import copy
 from hashlib import md5
+from multiprocessing.pool import ThreadPool
 from random import choice
 from urllib2 import quote, unquote
 from riak import RiakError
+from assemblyline.common.caching import StripedLRUCache
 from assemblyline.common.charset import safe_str
 from assemblyline.common.chunk import chunked_list
 
@@ -330,26 +335,60 @@ class DataStoreBase(object):
                 sid, errors, results
             )
             return
-        submission['original_classification'] = submission['classification']
+        self._finalize(submission, classification, errors, results, score)
+        self.save_submission(sid, submission)
+
+    def finalize_submissions(self, finalizations):
+        # The 'finalizations' parameter should be a list of
+        # (sid, classification, errors, results, score) tuples.
+        # Returns the sids that could not be saved.
+        submissions = self.get_submissions_dict([f[0] for f in finalizations])
+        failed = []
+        for sid, classification, errors, results, score in finalizations:
+            submission = submissions.get(sid, None)
+            if not submission:
+                log.warn(
+                    'Updating non-existent submission: %s - %s - %s',
+                    sid, errors, results
+                )
+                continue
+            self._finalize(submission, classification, errors, results, score)
+            try:
+                self.save_submission(sid, submission)
+            except RiakError:
+                log.exception("Problem finalizing submission %s", sid)
+                failed.append(sid)
+        return failed
+
+    @staticmethod
+    def _finalize(submission, classification, errors, results, score):
+        # Finalizing can be retried: the first pass already replaced the
+        # original classification and set the completion time.
+        t = Task(submission, max_score=score)
+        finalized = t.state == 'completed'
+        if not finalized:
+            submission['original_classification'] = submission['classification']
         submission['classification'] = classification
         submission['error_count'] = len(errors)
         submission['errors'] = errors
         submission['file_count'] = len(set([x[:64] for x in errors + results]))
         submission['results'] = results
-        t = Task(submission, max_score=score)
         t.state = 'completed'
-        t.completed = now_as_iso()
+        if not finalized or not t.completed:
+            t.completed = now_as_iso()
         for field in [
             'completed_queue', 'generate_alert',
             'notification_queue', 'notification_threshold', 'max_extracted',
             'max_supplementary', 'root_sha256', 'profile',
         ]:
             t.remove(field)
-        self.save_submission(sid, submission)
 
     def get_submission(self, sid):
         raise NotImplementedError()
 
+    def get_submissions_dict(self, key_list):
+        raise NotImplementedError()
+
     @staticmethod
     def pre_save_submission(submission):
         submission = sanitize_submission(submission)
@@ -379,9 +418,18 @@ class RiakStore(DataStoreBase):
     READ_TIMEOUT_MILLISECS = 30000
     MIN_KEY_LEN = 5
     ALLOW_MULTIGET = True
+    ALLOW_MULTIPUT = True
     MAX_SEARCH_DEPTH = 5000
     MAX_ROW_SIZE = 500
     MAX_RETRY = 5
+    MULTIGET_CHUNK_SIZE = 1000
+    MULTIGET_WORKERS = 4
+    STREAM_PREFETCH_PAGES = 10
+    # Filter queries splitting a bucket by key so it can be streamed in
+    # parallel. Together they cover every key, hex keys are evenly spread.
+    STREAM_KEY_PARTITIONS = ['_yz_rk:[* TO 4}', '_yz_rk:[4 TO 8}', '_yz_rk:[8 TO c}', '_yz_rk:[c TO *]']
+    FILE_TREE_NODES = None
+    FILE_TREE_NODES_LOCK = threading.Lock()
     INDEXED_BUCKET_LIST = [
         "alert",
         "error",
@@ -556,64 +604,73 @@ class RiakStore(DataStoreBase):
     def _get_bucket_item(self, bucket, key, strict=False):
         return self._clean_extra_index(self._get_data(bucket.get(key), strict=strict))
 
-    @RiakReconnect(wake_up_riak, log)
-    def _get_bucket_items(self, bucket, key_list, strict=False):
-        temp_keys = copy(key_list)
-        if RiakStore.ALLOW_MULTIGET:
-            done = False
-            retry = 0
-            ret = []
-            while not done:
-                for bucket_item in bucket.multiget(temp_keys):
-                    if not isinstance(bucket_item, tuple):
-                        try:
-                            item_data = self._get_data(bucket_item, strict=strict)
-                        except DataStoreException:
-                            continue
-                        if item_data is not None:
-                            ret.append(self._clean_extra_index(item_data))
-                        temp_keys.remove(bucket_item.key)
-
-                if len(temp_keys) == 0:
-                    done = True
-                else:
-                    retry += 1
+    def _multiget(self, bucket, keys, strict=False):
+        """ {key: data} of keys, retrying the keys that multiget didn't return. """
+        pending = set(keys)
+        out = {}
+        retry = 0
+        while pending:
+            for bucket_item in bucket.multiget(list(pending)):
+                if not isinstance(bucket_item, tuple):
+                    try:
+                        item_data = self._get_data(bucket_item, strict=strict)
+                    except DataStoreException:
+                        continue
+                    if item_data is not None:
+                        out[bucket_item.key] = self._clean_extra_index(item_data)
+                    pending.discard(bucket_item.key)
 
+            if pending:
+                retry += 1
                 if retry >= RiakStore.MAX_RETRY:
                     raise DataStoreException("%s is missing data for the following keys: %s" % (bucket.name.upper(),
-                                                                                                temp_keys))
+                                                                                                list(pending)))
+        return out
 
+    def _stream_bucket_items(self, bucket, key_list, strict=False):
+        """ Yields {key: data} dicts of the items of key_list as they are fetched.
+
+        Keys are fetched in multigets of MULTIGET_CHUNK_SIZE keys by up to
+        MULTIGET_WORKERS threads. Keys without data are left out.
+        """
+        chunks = chunked_list(list(set(key_list)), RiakStore.MULTIGET_CHUNK_SIZE)
+        if not RiakStore.ALLOW_MULTIGET:
+            for keys in chunks:
+                found = {x: self._clean_extra_index(self._get_data(bucket.get(x), strict=strict)) for x in keys}
+                yield {k: v for k, v in found.iteritems() if v is not None}
+            return
+
+        if len(chunks) < 2:
+            for keys in chunks:
+                yield self._multiget(bucket, keys, strict)
+            return
+
+        pool = ThreadPool(min(RiakStore.MULTIGET_WORKERS, len(chunks)))
+        try:
+            for found in pool.imap_unordered(lambda k: self._multiget(bucket, k, strict), chunks):
+                yield found
+        finally:
+            pool.terminate()
+
+    @RiakReconnect(wake_up_riak, log)
+    def _get_bucket_items(self, bucket, key_list, strict=False):
+        if RiakStore.ALLOW_MULTIGET:
+            # A key listed more than once is returned as many times.
+            counts = Counter(key_list)
+            ret = []
+            for found in self._stream_bucket_items(bucket, key_list, strict):
+                for key, data in found.iteritems():
+                    ret.extend([data] * counts[key])
             return ret
         else:
             return [self._clean_extra_index(self._get_data(bucket.get(x), strict=strict)) for x in key_list]
 
     @RiakReconnect(wake_up_riak, log)
     def _get_bucket_items_dict(self, bucket, key_list, strict=False):
-        temp_keys = copy(key_list)
         if RiakStore.ALLOW_MULTIGET:
-            done = False
-            retry = 0
             ret = {}
-            while not done:
-                for bucket_item in bucket.multiget(temp_keys):
-                    if not isinstance(bucket_item, tuple):
-                        try:
-                            item_data = self._get_data(bucket_item, strict=strict)
-                        except DataStoreException:
-                            continue
-                        if item_data is not None:
-                            ret[bucket_item.key] = self._clean_extra_index(item_data)
-                        temp_keys.remove(bucket_item.key)
-
-                if len(temp_keys) == 0:
-                    done = True
-                else:
-                    retry += 1
-
-                if retry >= RiakStore.MAX_RETRY:
-                    raise DataStoreException("%s is missing data for the following keys: %s" % (bucket.name.upper(),
-                                                                                                temp_keys))
-
+            for found in self._stream_bucket_items(bucket, key_list, strict):
+                ret.update(found)
             return ret
         else:
             return {x: self._clean_extra_index(self._get_data(bucket.get(x), strict=strict)) for x in key_list}
@@ -648,7 +705,8 @@ class RiakStore(DataStoreBase):
     def _list_bucket_keys(self, bucket, access_control=None):
         out = []
 
-        for item in self.stream_search(bucket.name, "*", fl="_yz_rk", access_control=access_control):
+        for item in self.stream_search(bucket.name, "*", fl="_yz_rk", access_control=access_control,
+                                       partitions=self.STREAM_KEY_PARTITIONS):
             out.append(item['_yz_rk'])
 
         return list(set(out))
@@ -674,6 +732,23 @@ class RiakStore(DataStoreBase):
         item = bucket.new(key=key, data=data, content_type=APPLICATION_JSON)
         item.store()
 
+    @RiakReconnect(wake_up_riak, log)
+    def _save_bucket_items(self, bucket, items):
+        """ Stores a list of (key, data) with a single multiput.
+        Returns the keys that could not be saved. """
+        for key, _ in items:
+            if " " in key:
+                raise DataStoreException("Your are not allowed to use space in the key. [%s]" % key)
+        objects = [bucket.new(key=key, data=data, content_type=APPLICATION_JSON) for key, data in items]
+
+        if not RiakStore.ALLOW_MULTIPUT:
+            for item in objects:
+                item.store()
+            return []
+
+        # Failures come back as (object, exception) tuples.
+        return [r[0].key for r in self.client.multiput(objects, return_body=False) if isinstance(r, tuple)]
+
     @RiakReconnect(wake_up_riak, log)
     def _search_bucket(self, bucket, query="*:*", start=0, rows=100, sort="_yz_rk asc", fl="*", access_control=""):
         if "score" not in fl:
@@ -1158,34 +1233,17 @@ class RiakStore(DataStoreBase):
         return out
 
     def stream_search(self, bucket, query, df="text", sort="_yz_id asc", fl=None, item_buffer_size=200,
-                      access_control=None, fq=None):
-
-        def _auto_fill(_self, _page_size, _items, _lock, _bucket, _query, _args, _df, _access_control):
-            _max_yield_cache = 50000
+                      access_control=None, fq=None, prefetch=None, partitions=None):
+        """ Yields every document matching query.
 
-            done = False
-            _args = list(_args)
-            while not done:
-                skip = False
-                with lock:
-                    if len(_items) > _max_yield_cache:
-                        skip = True
-
-                if skip:
-                    time.sleep(0.01)
-                    continue
-
-                j = _self.direct_search(_bucket, _query, _args, df=_df, __access_control__=_access_control)
-
-                # Replace cursorMark.
-                _args = _args[:-1]
-                _args.append(('cursorMark', j.get('nextCursorMark', '*')))
-
-                with _lock:
-                    _items.extend(j['response']['docs'])
-
-                done = _page_size - len(j['response']['docs'])
+        Pages of item_buffer_size documents are fetched by a background thread
+        that stays at most prefetch pages ahead of the consumer. Fetch errors
+        are raised to the consumer and closing the generator stops the fetch.
 
+        partitions is a list of filter queries that split the results. Each
+        partition is fetched by its own cursor, in parallel, so the documents
+        are then only sorted within a partition.
+        """
         if item_buffer_size > 500 or item_buffer_size < 50:
             raise SearchException("Variable item_buffer_size must be between 50 and 500.")
 
@@ -1204,26 +1262,65 @@ class RiakStore(DataStoreBase):
                     args.append(("fq", item))
             else:
                 args.append(("fq", fq))
-        args.append(('cursorMark', '*'))
-
-        yield_done = False
-        items = []
-        lock = threading.Lock()
-        sf_t = threading.Thread(target=_auto_fill,
-                                args=[self, item_buffer_size, items, lock, bucket, query, args, df, access_control],
-                                name="stream_search_%s" % md5(bucket + safe_str(query)).hexdigest()[:7])
-        sf_t.setDaemon(True)
-        sf_t.start()
-        while not yield_done:
-            try:
-                with lock:
-                    item = items.pop(0)
 
-                yield item
-            except IndexError:
-                if not sf_t.is_alive() and len(items) == 0:
-                    yield_done = True
-                time.sleep(0.01)
+        pages = Queue.Queue(maxsize=prefetch or self.STREAM_PREFETCH_PAGES)
+        cancelled = threading.Event()
+
+        def _put(page):
+            while not cancelled.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def _fetch(_args):
+            # noinspection PyBroadException
+            try:
+                cursor = '*'
+                while not cancelled.is_set():
+                    j = self.direct_search(bucket, query, _args + [('cursorMark', cursor)], df=df,
+                                           __access_control__=access_control)
+                    docs = j['response']['docs']
+                    if docs and not _put(docs):
+                        return
+
+                    next_cursor = j.get('nextCursorMark', cursor)
+                    if len(docs) < item_buffer_size or next_cursor == cursor:
+                        return
+                    cursor = next_cursor
+            except:  # pylint: disable=W0702
+                _put(sys.exc_info())
+            finally:
+                _put(None)
+
+        name = "stream_search_%s" % md5(bucket + safe_str(query)).hexdigest()[:7]
+        fetchers = []
+        for partition in partitions or [None]:
+            fetch_args = args if partition is None else args + [("fq", partition)]
+            fetcher = threading.Thread(target=_fetch, args=(fetch_args,), name=name)
+            fetcher.setDaemon(True)
+            fetcher.start()
+            fetchers.append(fetcher)
+
+        running = len(fetchers)
+        try:
+            while running:
+                # A blocking get can't be interrupted by SIGINT on python 2.
+                try:
+                    page = pages.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
+                if page is None:
+                    running -= 1
+                elif isinstance(page, tuple):
+                    raise page[0], page[1], page[2]
+                else:
+                    for item in page:
+                        yield item
+        finally:
+            cancelled.set()
 
     ################################################################
     # Helper Functions
@@ -1260,6 +1357,7 @@ class RiakStore(DataStoreBase):
 
         return scores
 
+    @RiakReconnect(wake_up_riak, log)
     @RiakReconnect(wake_up_riak, log)
     def get_tag_list_from_keys(self, keys):
         if len(keys) == 0:
@@ -1773,9 +1871,8 @@ class RiakStore(DataStoreBase):
     def list_file_debug_keys(self):
         return self._list_bucket_debug_keys(self.files)
 
-    def save_or_freshen_file(self, srl, fileinfo, expiry, classification):
-        current_fileinfo = self.get_file(srl) or {}
-
+    @staticmethod
+    def _freshen_fileinfo(current_fileinfo, fileinfo, expiry, classification, iso_now):
         # Remove control fields from file info and update current file info
         for x in ['classification', '__expiry_ts__', 'seen_count', 'seen_first', 'seen_last']:
             fileinfo.pop(x, None)
@@ -1787,7 +1884,6 @@ class RiakStore(DataStoreBase):
         current_fileinfo['__expiry_ts__'] = iso_expiry
 
         # Update seen counters
-        iso_now = now_as_iso()
         seen_count = current_fileinfo.get('seen_count', 0) + 1
         seen_first = current_fileinfo.get('seen_first', iso_now)
         current_fileinfo['seen_count'] = seen_count
@@ -1803,7 +1899,25 @@ class RiakStore(DataStoreBase):
         parts = Classification.get_access_control_parts(classification)
         current_fileinfo.update(parts)
 
-        self.save_file(srl, current_fileinfo)
+        return current_fileinfo
+
+    def save_or_freshen_file(self, srl, fileinfo, expiry, classification):
+        current_fileinfo = self.get_file(srl) or {}
+        self.save_file(srl, self._freshen_fileinfo(current_fileinfo, fileinfo, expiry, classification, now_as_iso()))
+
+    def save_or_freshen_files(self, files):
+        # The 'files' parameter should be a list of (srl, fileinfo, expiry, classification).
+        # Current file infos are fetched with a single multiget and saved with a single multiput.
+        # Returns the srls that could not be saved.
+        current = self._get_bucket_items_dict(self.files, [f[0] for f in files])
+        iso_now = now_as_iso()
+
+        freshened = {}
+        for srl, fileinfo, expiry, classification in files:
+            current_fileinfo = freshened.get(srl, None) or current.get(srl, None) or {}
+            freshened[srl] = self._freshen_fileinfo(current_fileinfo, fileinfo, expiry, classification, iso_now)
+
+        return self._save_bucket_items(self.files, freshened.items())
 
     def save_file(self, srl, fileinfo):
         self._save_bucket_item(self.files, srl, fileinfo)
@@ -1848,6 +1962,9 @@ class RiakStore(DataStoreBase):
     def get_filescores(self, key_list):
         return self._get_bucket_items(self.filescores, key_list)
 
+    def get_filescores_dict(self, key_list):
+        return self._get_bucket_items_dict(self.filescores, key_list)
+
     def list_filescore_keys(self):
         return self._list_bucket_keys(self.filescores)
 
@@ -1862,6 +1979,21 @@ class RiakStore(DataStoreBase):
         filescore['__expiry_ts__'] = expiry
         return self._save_bucket_item(self.filescores, key, filescore)
 
+    def save_filescores(self, filescores):
+        # The 'filescores' parameter should be a dict of key: (expiry, filescore).
+        # Current expiries are fetched with a single multiget and the
+        # filescores are saved with a single multiput.
+        current = self._get_bucket_items_dict(self.filescores, filescores.keys())
+        to_save = []
+        for key, (expiry, filescore) in filescores.iteritems():
+            current_expiry = (current.get(key, None) or {}).get('__expiry_ts__', expiry)
+            if iso_to_epoch(current_expiry) > iso_to_epoch(expiry):
+                continue
+            filescore['__expiry_ts__'] = expiry
+            to_save.append((key, filescore))
+
+        return self._save_bucket_items(self.filescores, to_save)
+
     def search_filescore(self, query="*:*", start=0,
                          rows=100, sort="_yz_rk asc"):
         return self._search_bucket(self.filescores, query, start, rows, sort)
@@ -2456,6 +2588,56 @@ class RiakStore(DataStoreBase):
 
         return True
 
+    @classmethod
+    def _file_tree_nodes(cls):
+        """ The file tree node cache, created on first use so that processes
+        that never build file trees don't pay for it. """
+        if cls.FILE_TREE_NODES is None:
+            with cls.FILE_TREE_NODES_LOCK:
+                if cls.FILE_TREE_NODES is None:
+                    cls.FILE_TREE_NODES = StripedLRUCache(config.datastore.get('file_tree_cache_size', 5000),
+                                                          config.datastore.get('file_tree_cache_ttl', 3600))
+        return cls.FILE_TREE_NODES
+
+    def _get_file_tree_nodes(self, srls, results_by_srl):
+        """ {srl: (extracted children, score)} of srls.
+
+        Nodes are cached by srl and result keys so files embedded in several
+        submissions are only fetched once. The missing ones are fetched with
+        a single multiget.
+        """
+        cache = self._file_tree_nodes()
+        nodes = {}
+        missing = {}
+        for srl in srls:
+            cache_key = (srl, tuple(sorted(results_by_srl.get(srl, []))))
+            node = cache.get(cache_key)
+            if node is None:
+                missing[srl] = cache_key
+            else:
+                nodes[srl] = node
+
+        keys = [k for srl in missing for k in results_by_srl.get(srl, [])]
+        items = self._get_bucket_items_dict(self.results, keys) if keys else {}
+        for srl, cache_key in missing.iteritems():
+            children = []
+            score = 0
+            complete = True
+            for key in cache_key[1]:
+                item = items.get(key, None)
+                if not item:
+                    complete = False
+                    continue
+                children.extend([dict(zip(("name", "srl", "desc"), i))
+                                 for i in item.get('response', {}).get('extracted', [])])
+                score += int(item.get("result", {}).get("score", 0))
+            nodes[srl] = (children, score)
+            # Results not written yet must not hide children for the cache ttl.
+            if complete:
+                cache.add(cache_key, nodes[srl])
+
+        return nodes
+
     def create_file_tree(self, submission):
         results = submission.get('results', [])
         num_files = len(list(set([x[:64] for x in results])))
@@ -2468,20 +2650,37 @@ class RiakStore(DataStoreBase):
                 return cached_tree
 
         tree = {}
+        max_depth = config.core.dispatcher.max.depth
+
+        results_by_srl = {}
+        for key in results:
+            if not key.endswith(".e"):
+                results_by_srl.setdefault(key[:64], []).append(key)
+
+        # Fetch the files one depth level at a time, down to the deepest
+        # level recurse_tree reads the children of.
+        nodes = {}
+        level = set([srl for _, srl in submission['files']])
+        for _ in xrange(max_depth + 2):
+            level = level.difference(nodes)
+            if not level:
+                break
+            found = self._get_file_tree_nodes(level, results_by_srl)
+            nodes.update(found)
+            level = set([c['srl'] for children, _ in found.itervalues() for c in children])
 
-        plan = [
-            (self.get_file_list_from_keys, (results,), "files"),
-            (self.get_files_scores_from_keys, (results,), "scores")
-        ]
+        # Only the direct children of the submitted files are marked as
+        # visited, deeper files are repeated wherever they were extracted.
+        visited = set()
 
-        res = execute_concurrently(plan)
+        def get_children(srl):
+            return nodes.get(srl, ([], 0))[0]
 
-        files = res.get("files", {})
-        scores = res.get("scores", {})
-        tree_cache = []
+        def get_score(srl):
+            return nodes.get(srl, ([], 0))[1]
 
         def recurse_tree(child_p, placeholder, parents_p, lvl=0):
-            if lvl == config.core.dispatcher.max.depth + 1:
+            if lvl == max_depth + 1:
                 # Enforce depth protection while building the tree
                 return
 
@@ -2490,12 +2689,11 @@ class RiakStore(DataStoreBase):
             else:
                 children_list = {}
                 truncated = False
-                child_list = files.get(child_p['srl'], [])
+                child_list = get_children(child_p['srl'])
                 for new_child in child_list:
-                    if new_child['srl'] in tree_cache:
+                    if new_child['srl'] in visited:
                         truncated = True
                         continue
-                    tree_cache.append(child['srl'])
 
                     if new_child['srl'] not in parents_p:
                         recurse_tree(new_child, children_list,
@@ -2505,7 +2703,7 @@ class RiakStore(DataStoreBase):
                     "name": [child_p['name']],
                     "children": children_list,
                     "truncated": truncated,
-                    "score": scores.get(child_p['srl'], 0),
+                    "score": get_score(child_p['srl']),
                 }
 
         for name, srl in submission['files']:
@@ -2514,16 +2712,16 @@ class RiakStore(DataStoreBase):
             else:
                 parents = [srl]
                 children = {}
-                c_list = files.get(srl, [])
+                c_list = get_children(srl)
                 for child in c_list:
-                    tree_cache.append(child['srl'])
+                    visited.add(child['srl'])
                     recurse_tree(child, children, parents)
 
                 tree[srl] = {
                     "name": [name],
                     "children": children,
                     "truncated": False,
-                    "score": scores.get(srl, 0),
+                    "score": get_score(srl),
                 }
 
         tree['__expiry_ts__'] = submission['__expiry_ts__']
@@ -2615,6 +2813,9 @@ class RiakStore(DataStoreBase):
     def get_submissions(self, key_list):
         return self._get_bucket_items(self.submissions, key_list)
 
+    def get_submissions_dict(self, key_list):
+        return self._get_bucket_items_dict(self.submissions, key_list)
+
     def list_submission_keys(self):
         return self._list_bucket_keys(self.submissions)
 
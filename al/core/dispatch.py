@@ -11,16 +11,18 @@ import time
 
 from collections import namedtuple
 from copy import deepcopy
+from heapq import heapify, heappop, heappush
+from itertools import count
 from pprint import pformat
 from assemblyline.common import net
 
 from assemblyline.common.exceptions import get_stacktrace_info
-from assemblyline.common.isotime import now_as_iso
+from assemblyline.common.isotime import iso_to_epoch, now_as_iso
 from assemblyline.common.net import get_hostip, get_hostname, get_mac_address
 from assemblyline.al.common import forge
 from assemblyline.al.common import counter
 from assemblyline.al.common import message
-from assemblyline.al.common.queue import CommsQueue, DispatchQueue, LocalQueue, NamedQueue, reply_queue_name
+from assemblyline.al.common.queue import CommsQueue, DispatchQueue, LocalQueue, NamedQueue, push_all, reply_queue_name
 from assemblyline.al.common.remote_datatypes import ExpiringSet, Hash, ExpiringHash
 from assemblyline.al.common.task import Task
 from assemblyline.al.core.datastore import compress_riak_key
@@ -38,6 +40,9 @@ DONE = len(config.services.stages) + 1
 counts = None # Created when dispatcher starts.
 log = logging.getLogger('assemblyline.dispatch')
 
+# Maximum number of storage messages a writer thread handles per flush.
+writer_batch_size = config.core.dispatcher.get('writer_batch_size', 100)
+
 class DispatchException(Exception):
     pass
 
@@ -47,6 +52,83 @@ Entry = namedtuple('Entry', ['dispatcher', 'task', 'retries', 'parents',
      'outstanding_services'])
 Timeout = namedtuple('Timeout', ['sid', 'srl', 'data', 'time'])
 
+class Timeouts(object):
+    """Timeouts ordered by deadline and indexed by (sid, srl, data).
+
+    Cancelling (or replacing) a timeout only unlinks it from the index. The
+    heap entry is skipped when it reaches the top and the heap is compacted
+    once dead entries outnumber live ones.
+    """
+    __slots__ = ('by_sid', 'heap', 'index', 'sequence')
+
+    def __init__(self):
+        self.by_sid = {}
+        self.heap = []
+        self.index = {}
+        self.sequence = count()
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, sid, srl, data, seconds, now):
+        key = (sid, srl, data)
+        old = self.index.get(key, None)
+        if old:
+            old[2] = None
+        item = [now + seconds, next(self.sequence),
+                Timeout(sid, srl, data, now + seconds), seconds]
+        self.index[key] = item
+        self.by_sid.setdefault(sid, set()).add(key)
+        heappush(self.heap, item)
+
+    def cancel(self, sid, srl, data):
+        key = (sid, srl, data)
+        item = self.index.pop(key, None)
+        if not item:
+            return
+        item[2] = None
+        keys = self.by_sid.get(sid, None)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_sid[sid]
+        self._compact()
+
+    def cancel_sid(self, sid):
+        for key in self.by_sid.pop(sid, ()):
+            item = self.index.pop(key, None)
+            if item:
+                item[2] = None
+        self._compact()
+
+    def contains(self, sid, srl, data):
+        return (sid, srl, data) in self.index
+
+    def expired(self, now):
+        """Yield (timeout, seconds) for each timeout whose time has passed."""
+        heap = self.heap
+        while heap and heap[0][0] < now:
+            _, _, t, seconds = heappop(heap)
+            if t is None:
+                continue
+            key = (t.sid, t.srl, t.data)
+            del self.index[key]
+            keys = self.by_sid.get(t.sid, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_sid[t.sid]
+            yield t, seconds
+
+    def has_sid(self, sid):
+        return sid in self.by_sid
+
+    def _compact(self):
+        if len(self.heap) < 1024 or len(self.heap) < 2 * len(self.index):
+            return
+        self.heap[:] = [x for x in self.heap if x[2] is not None]
+        heapify(self.heap)
+
 def eligible_parent(service_manager, task):
     if not isinstance(task.eligible_parents, list) or not task.service_name:
         return True
@@ -166,6 +248,9 @@ def RemoveEntry(dispatcher, entry, sid, srl, now):
 
         # If there are no outstanding srls, remove this sid as well.
         entries.pop(sid)
+        dispatcher.ack_timeout.cancel_sid(sid)
+        dispatcher.child_timeout.cancel_sid(sid)
+        dispatcher.service_timeout.cancel_sid(sid)
 
         # Update the scan object.
         c12ns = dispatcher.completed.pop(sid).values()
@@ -278,8 +363,9 @@ class Dispatcher(object):
     # as a side effect we lose the ability to add members dynamically).
     __slots__ = ('ack_timeout', 'child_timeout', 'completed', 'control_queue',
                  'debug', 'drain', 'entries', 'errors', 'high', 'ingest_queue',
-                 'last_check', 'lock', 'pop', 'queue_size', 'response_queue',
-                 'results', 'running', 'score', 'service_manager',
+                 'last_check', 'lock', 'orphaned_queues', 'pop', 'queue_size',
+                 'response_queue', 'results', 'router', 'running', 'score',
+                 'service_manager',
                  'service_timeout', 'shard', 'storage_queue',
                  'watchers', 'hostinfo')
     def __init__(self, service_manager, #pylint: disable=R0913
@@ -298,8 +384,8 @@ class Dispatcher(object):
             'host': get_hostname(),
         }
 
-        self.ack_timeout = {}
-        self.child_timeout = {}
+        self.ack_timeout = Timeouts()
+        self.child_timeout = Timeouts()
         self.completed = {}
         self.control_queue = control_queue or \
             forge.get_control_queue('control-queue-' + shard)
@@ -311,6 +397,12 @@ class Dispatcher(object):
         self.last_check = 0
         self.lock = threading.Lock()
         self.pop = pop
+        self.router = forge.get_shard_router('dispatcher')
+        # While shards are rebalanced, submissions left in the ingest queues
+        # of shards that no longer exist are sent to their new shard.
+        self.orphaned_queues = [
+            'ingest-queue-' + str(n) for n in self.router.orphaned_shards(shard)
+        ]
         self.queue_size = {}
         # Reponse queues are named: <hostname>-<pid>-<seconds>-<shard>.
         self.response_queue = '-'.join((socket.gethostname(), str(os.getpid()),
@@ -319,7 +411,7 @@ class Dispatcher(object):
         self.running = False
         self.score = {}
         self.service_manager = service_manager
-        self.service_timeout = {}
+        self.service_timeout = Timeouts()
         self.shard = shard
         self.storage_queue = LocalQueue()
         self.watchers = {}
@@ -368,13 +460,8 @@ class Dispatcher(object):
 
         entry.acknowledged_services[stage][sender] = service_entry
 
-        seconds = task.seconds
-
-        # Add the timeout to the end of its respective list.
-        service_timeout = self.service_timeout
-        lst = service_timeout.get(seconds, [])
-        lst.append(Timeout(sid, srl, sender, now + float(seconds)))
-        service_timeout[seconds] = lst
+        self.ack_timeout.cancel(sid, srl, sender)
+        self.service_timeout.add(sid, srl, sender, float(task.seconds), now)
 
     def check_timeouts(self, now=None):
         if not now:
@@ -391,34 +478,17 @@ class Dispatcher(object):
                 self.process_timeouts('completed_services', now,
                                       'Service timeout',
                                       self.service_timeout)
-                timeouts = self.child_timeout
-                for k, v in timeouts.iteritems():
-                    start = 0
-                    timeouts[k] = []
-                    for t in v:
-                        # Timeouts are added to the end of their list so
-                        # when we reach the first non-timed out timeout,
-                        # we are done.
-                        if t.time >= now:
-                            break
-
-                        # Timeouts remain active (so that we don't have
-                        # to scan for them when removing tasks that have
-                        # completed. So it is possible for a timeout to
-                        # refer to an id that no longer exists.
-                        submission = self.entries.get(t.sid, None)
-                        if submission:
-                            entry = submission.get(t.srl, None)
-                            if entry:
-                                if entry.extracted_children.pop(t.data, None):
-                                    log.info('Child %s of parent %s timed out',
-                                             t.data, t.srl)
-                                UpdateEntry(entry, now)
-
-                        start += 1
-
-                    # Remove processed timeouts.
-                    timeouts[k] = v[start:] + timeouts[k]
+                for t, _ in self.child_timeout.expired(now):
+                    # Timeouts for completed submissions are cancelled but
+                    # an entry may still be gone (filtered out for example).
+                    submission = self.entries.get(t.sid, None)
+                    if submission:
+                        entry = submission.get(t.srl, None)
+                        if entry:
+                            if entry.extracted_children.pop(t.data, None):
+                                log.info('Child %s of parent %s timed out',
+                                         t.data, t.srl)
+                            UpdateEntry(entry, now)
             except Exception as ex: #pylint: disable=W0703
                 trace = get_stacktrace_info(ex)
                 log.error('Problem processing timeouts: %s', trace)
@@ -485,11 +555,7 @@ class Dispatcher(object):
 
         service.proxy.execute(task.priority, task.as_service_request(name))
 
-        # Add the timeout to the end of its respective list.
-        ack_timeout = self.ack_timeout
-        lst = ack_timeout.get(seconds, [])
-        lst.append(Timeout(sid, srl, name, now + seconds))
-        ack_timeout[seconds] = lst
+        self.ack_timeout.add(sid, srl, name, seconds, now)
 
         return True
 
@@ -549,6 +615,8 @@ class Dispatcher(object):
         n = self.high - n
         if not self.drain and n > 0:
             submissions += self.pop(self.ingest_queue, n)
+            if self.orphaned_queues:
+                self.reroute_orphans(n)
         # Process the responses/resubmissions and submissions.
         # ... "for decisions and revisions which a minute will reverse" ;-)
         n = len(submissions)
@@ -557,6 +625,28 @@ class Dispatcher(object):
                 self.process(submission)
         return n
 
+    def reroute_orphans(self, n):
+        dispatch_queue = forge.get_dispatch_queue()
+        for name in self.orphaned_queues:
+            orphans = self.pop(name, n)
+            for raw in orphans:
+                dispatch_queue.submit(Task(raw))
+            if orphans:
+                log.info('Rerouted %d submissions from %s.', len(orphans), name)
+
+    def forward_to_previous_shard(self, task):
+        """ Sends a control message about a sid this dispatcher doesn't know
+        to the dispatcher that owned it before the current rebalance. """
+        if not self.router.migrating or task.sid in self.entries:
+            return False
+        previous = self.router.previous_route(task.sid)
+        # Only the new owner forwards so a message is forwarded at most once.
+        if str(previous) == self.shard or previous >= self.router.shards or \
+                str(self.router.route(task.sid)) != self.shard:
+            return False
+        forge.get_control_queue('control-queue-' + str(previous)).push(task.raw)
+        return True
+
     def process(self, msg):
         func = None
         task = Task.wrap(msg)
@@ -579,28 +669,14 @@ class Dispatcher(object):
     def process_timeouts(self, name, now, msg, timeouts):
         services = self.service_manager.services
 
-        # Timeouts are stored in lists according to the timeout seconds.
-        for k, v in timeouts.items():
-            start = 0
-            timeouts[k] = []
-            for t in v:
-                # Timeouts are added to the end of their list so when we
-                # reach the first non-timed out timeout, we are done.
-                if t.time >= now:
-                    break
-
-                # Timeouts remain active (so that we don't have to scan
-                # for them when removing tasks that have completed. So it
-                # is possible for a timeout to refer to an id that no
-                # longer exists.
-                if self.redispatch(name, t.sid, t.srl,
-                                   services[t.data], msg, now):
-                    timeouts[k].append(Timeout(t.sid, t.srl, t.data, now + k))
-
-                start += 1
-
-            # Remove processed timeouts.
-            timeouts[k] = v[start:] + timeouts[k]
+        # Only timeouts that are due are visited. Timeouts are cancelled
+        # as services and submissions complete but it is still possible
+        # for a timeout to refer to an id that no longer exists.
+        for t, seconds in timeouts.expired(now):
+            if self.redispatch(name, t.sid, t.srl,
+                               services[t.data], msg, now):
+                if not timeouts.contains(t.sid, t.srl, t.data):
+                    timeouts.add(t.sid, t.srl, t.data, seconds, now)
 
     def redispatch(self, name, sid, srl, service, reason, now):
         entry = None
@@ -710,6 +786,9 @@ class Dispatcher(object):
         entry.completed_services[stage][sender] = svc
         self.service_manager.update_last_result_at(sender, now)
 
+        self.ack_timeout.cancel(sid, srl, sender)
+        self.service_timeout.cancel(sid, srl, sender)
+
         entry.acknowledged_services[stage].pop(sender, None)
         entry.dispatched_services[stage].pop(sender, None)
 
@@ -736,12 +815,7 @@ class Dispatcher(object):
 
                     # Setup a child timeout.
                     seconds = config.core.dispatcher.timeouts.child
-
-                    # Add the timeout to the end of its respective list.
-                    child_timeout = self.child_timeout
-                    lst = child_timeout.get(seconds, [])
-                    lst.append(Timeout(sid, srl, child[1], now + seconds))
-                    child_timeout[seconds] = lst
+                    self.child_timeout.add(sid, srl, child[1], seconds, now)
 
         UpdateEntry(entry, now)
 
@@ -812,6 +886,7 @@ class Dispatcher(object):
                 entries[sid][psrl].extracted_children.pop(srl, None)
             except: #pylint: disable=W0702
                 pass
+            self.child_timeout.cancel(sid, psrl, srl)
 
             self.debug("Child of %s/%s submitted: %s", sid, psrl, srl)
             task.depth += 1
@@ -860,6 +935,9 @@ class Dispatcher(object):
         queue = task.watch_queue
         sid = task.sid
 
+        if self.forward_to_previous_shard(task):
+            return
+
         # Make sure this submission exists.
         watchers = self.watchers.get(sid, {})
 
@@ -887,95 +965,145 @@ class Dispatcher(object):
 
         # Send all cache keys to the newly created queue.
         # Afterward they will be sent as they are received.
-        w.push({'status': 'START'})
-        if results:
-            w.push(*[{'status': 'OK', 'cache_key': c} for c in results])
-        if errors:
-            w.push(*[{'status': 'FAIL', 'cache_key': c} for c in errors])
+        w.push_many(
+            [{'status': 'START'}] +
+            [{'status': 'OK', 'cache_key': c} for c in results or []] +
+            [{'status': 'FAIL', 'cache_key': c} for c in errors or []]
+        )
 
     def writer(self):
-        queue = {}
         store = forge.get_datastore()
 
         while self.running:
-            try:
-                msg = self.storage_queue.pop(timeout=1)
-                if not msg:
-                    if self.drain:
-                        break
+            batch = self.storage_queue.pop_many(writer_batch_size, timeout=1)
+            if not batch:
+                if self.drain:
+                    break
+                continue
+
+            start = time.time()
+            self.write(store, batch)
+            counts.increment('dispatch.writer_batches')
+            counts.increment('dispatch.writer_messages', len(batch))
+            counts.increment('dispatch.writer_flush_ms',
+                             int((time.time() - start) * 1000))
+
+        store.close()
+
+    def write(self, store, batch):
+        complete, error, finalize = {}, [], []
+        for msg in batch:
+            kind = msg.get('type', None)
+            if kind == 'complete':
+                # Only the latest expiry for a filescore key can be stored.
+                key = msg['filescore_key']
+                if not key:
                     continue
+                previous = complete.get(key, None)
+                if not previous or iso_to_epoch(msg['expiry']) >= \
+                        iso_to_epoch(previous['expiry']):
+                    complete[key] = msg
+            elif kind == 'error':
+                error.append(msg)
+            elif kind == 'finalize':
+                finalize.append(msg)
+            else:
+                log.warning("Unhandled message type: %s", kind or '<unknown>')
+
+        if complete:
+            self.write_group(complete.values(), self.write_filescores, store)
+        if error:
+            self.write_group(error, self.write_errors, store)
+        if finalize:
+            self.write_group(finalize, self.write_finalized, store)
+
+    def write_group(self, msgs, func, store):
+        # The write functions return the messages that could not be stored.
+        try:
+            failed = func(store, msgs)
+        except riak.RiakError:
+            log.exception("Problem doing %s", msgs[0].get('type', 'unknown'))
+            failed = msgs
+        except Exception: # pylint:disable=W0702
+            # Don't lose the whole batch to one bad message.
+            log.exception('Problem in writer, writing messages one at a time')
+            failed = []
+            for msg in msgs:
+                try:
+                    failed.extend(func(store, [msg]))
+                except riak.RiakError:
+                    log.exception("Problem doing %s", msg.get('type', 'unknown'))
+                    failed.append(msg)
+                except Exception: # pylint:disable=W0702
+                    log.exception('Problem in writer')
+
+        for msg in failed:
+            msg['retries'] = retries = msg.get('retries', 0) + 1
+            if retries > 5:
+                log.error("Max retries exceeded for %s", msg.get('type', 'unknown'))
+                continue
+            self.storage_queue.push(msg)
 
-                response = None
-
-                if msg['type'] == 'complete':
-                    key = msg['filescore_key']
-                    if key:
-                        store.save_filescore(
-                            key, msg['expiry'], {
-                                'psid': msg['psid'],
-                                'sid': msg['sid'],
-                                'score': msg['score'],
-                                'time': msg['now'],
-                            }
-                        )
-
-                elif msg['type'] == 'error': 
-                    name, response = msg['name'], msg['response']
-                    response.cache_key = \
-                        store.save_error(name, None, None, response)
-                    q.send_raw(response.as_dispatcher_response())
-
-                elif msg['type'] == 'finalize':
-                    store.finalize_submission(
-                        msg['sid'], msg['classification'],
-                        msg['errors'], msg['results'], msg['score']
-                    ) 
-
-                    completed_queue = msg['completed_queue']
-                    if completed_queue:
-                        cq = queue.get(completed_queue, None)
-                        if not cq:
-                            cq = NamedQueue(completed_queue)
-                            queue[completed_queue] = cq
-                        cq.push(msg['raw'])
-
-                    # Send complete message to any watchers.
-                    for w in msg['watchers'].itervalues():
-                        w.push({'status': 'STOP'})
-
-                else:
-                    log.warning("Unhandled message type: %s",
-                                msg.get('type', '<unknown>'))
+    @staticmethod
+    def write_errors(store, msgs):
+        failed, responses = [], []
+        for msg in msgs:
+            name, response = msg['name'], msg['response']
+            try:
+                response.cache_key = store.save_error(name, None, None, response)
             except riak.RiakError:
-                msg['retries'] = retries = msg.get('retries', 0) + 1
-                if retries > 5:
-                    log.exception("Max retries exceeded")
-                    continue
-                self.storage_queue.push(msg)
-                log.exception("Problem doing %s", msg.get('type', 'unknown'))
-            except Exception: # pylint:disable=W0702
-                log.exception('Problem in writer')
-                # TODO: Should we sleep for a bit here to avoid flailing?
+                log.exception("Problem saving error for %s", name)
+                failed.append(msg)
+                continue
+            responses.append(Task(response.as_dispatcher_response()))
+        q.send_many(responses)
+        return failed
+
+    @staticmethod
+    def write_filescores(store, msgs):
+        failed = set(store.save_filescores({
+            msg['filescore_key']: (msg['expiry'], {
+                'psid': msg['psid'],
+                'sid': msg['sid'],
+                'score': msg['score'],
+                'time': msg['now'],
+            }) for msg in msgs
+        }))
+        return [msg for msg in msgs if msg['filescore_key'] in failed]
+
+    @staticmethod
+    def write_finalized(store, msgs):
+        failed = set(store.finalize_submissions([
+            (msg['sid'], msg['classification'], msg['errors'],
+             msg['results'], msg['score']) for msg in msgs
+        ]))
+
+        # Send completion messages and tell any watchers we are done.
+        pushes = []
+        for msg in msgs:
+            if msg['sid'] in failed:
+                continue
+            completed_queue = msg['completed_queue']
+            if completed_queue:
+                pushes.append((NamedQueue(completed_queue), msg['raw']))
+            for w in msg['watchers'].itervalues():
+                pushes.append((w, {'status': 'STOP'}))
+        push_all(pushes)
 
-        store.close()
+        return [msg for msg in msgs if msg['sid'] in failed]
 
     def explain_state(self, task):
         log.info('Got explain_state message.')
 
+        if self.forward_to_previous_shard(task):
+            return
+
         nq = NamedQueue(task.watch_queue)
 
         submission = self.entries.get(task.sid, None)
         if submission:
-            has_timeout = False
-            for v in self.ack_timeout.itervalues():
-                for t in v:
-                    if t.sid == task.sid:
-                        has_timeout = True
-
-            for v in self.service_timeout.itervalues():
-                for t in v:
-                    if t.sid == task.sid:
-                        has_timeout = True
+            has_timeout = self.ack_timeout.has_sid(task.sid) or \
+                self.service_timeout.has_sid(task.sid)
 
             if not has_timeout:
                 nq.push({
@@ -996,6 +1124,9 @@ class Dispatcher(object):
         NamedQueue(task.watch_queue).push(self._service_info())
 
     def outstanding_services(self, task):
+        if self.forward_to_previous_shard(task):
+            return
+
         nq = NamedQueue(task.watch_queue)
         outstanding = {}
         submission = self.entries.get(task.sid, None)
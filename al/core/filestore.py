@@ -1,8 +1,13 @@
+import Queue
 import logging
 import os
 import pprint
 import tempfile
+import threading
+import time
 
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse, parse_qs
 from urllib import unquote
 
@@ -114,13 +119,184 @@ def create_transport(url):
     return t
 
 
+class TransportStats(object):
+    """ Latency and error counters for the operations run on one transport. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.max_seconds = defaultdict(float)
+
+    def record(self, op, elapsed, error=False):
+        with self.lock:
+            self.counts[op + '.calls'] += 1
+            if error:
+                self.counts[op + '.errors'] += 1
+            self.seconds[op] += elapsed
+            if elapsed > self.max_seconds[op]:
+                self.max_seconds[op] = elapsed
+
+    def timed_out(self, op):
+        with self.lock:
+            self.counts[op + '.timeouts'] += 1
+
+    def as_dict(self):
+        with self.lock:
+            stats = dict(self.counts)
+            for op, seconds in self.seconds.iteritems():
+                calls = self.counts[op + '.calls']
+                stats[op + '.avg_ms'] = int(seconds * 1000 / calls) if calls else 0
+                stats[op + '.max_ms'] = int(self.max_seconds[op] * 1000)
+            return stats
+
+
 class FileStore(object):
-    def __init__(self, *transport_urls):
+    """ Stores files on one or more transports, nearest first.
+
+    In concurrent mode (filestore.concurrent) reads are hedged: they start
+    on the nearest transport and the next one is tried if no answer came
+    back within filestore.hedge_after seconds. The first good answer wins.
+    Writes go to all transports in parallel and each transport has
+    filestore.timeout seconds to complete.
+
+    Each transport has its own worker thread and at most
+    filestore.max_pending queued calls, so a transport that hangs only holds
+    up its own calls. Once its queue is full, calls on it fail right away.
+    """
+
+    def __init__(self, *transport_urls, **kw):
         self.log = logging.getLogger('assemblyline.transport')
         self.transports = [create_transport(url) for url in transport_urls]
         self.local_transports = [
             t for t in self.transports if isinstance(t, TransportLocal)
         ]
+        self.stats = [TransportStats() for _ in self.transports]
+
+        self.concurrent = kw.get('concurrent', config.filestore.get('concurrent', False))
+        self.hedge_after = kw.get('hedge_after', config.filestore.get('hedge_after', 0.5))
+        self.timeout = kw.get('timeout', config.filestore.get('timeout', 60))
+        self.max_pending = kw.get('max_pending', config.filestore.get('max_pending', 8))
+        self.pools = None
+        if self.concurrent and len(self.transports) > 1:
+            # Transports hold a single connection so calls on the same
+            # transport are serialized. Different transports run in parallel.
+            self.pending = [0] * len(self.transports)
+            self.pending_lock = threading.Lock()
+            self.pools = [ThreadPool(1) for _ in self.transports]
+
+    def _call(self, t, op, func):
+        i = self.transports.index(t)
+        start = time.time()
+        try:
+            result = func(t)
+        except:
+            self.stats[i].record(op, time.time() - start, error=True)
+            raise
+        self.stats[i].record(op, time.time() - start)
+        return result
+
+    def _submit(self, t, op, func, results, state):
+        i = self.transports.index(t)
+        with self.pending_lock:
+            busy = self.pending[i] >= self.max_pending
+            if not busy:
+                self.pending[i] += 1
+        if busy:
+            self.stats[i].record(op, 0, error=True)
+            results.put((t, FileStoreException('%d calls already pending on %s' % (self.max_pending, t)), None))
+            return
+
+        def run():
+            try:
+                value, ex = self._call(t, op, func), None
+            except Exception as e:  # pylint: disable=W0703
+                value, ex = None, e
+            finally:
+                with self.pending_lock:
+                    self.pending[i] -= 1
+            with state['lock']:
+                if state['done']:
+                    if ex is None and state['cleanup']:
+                        state['cleanup'](value)
+                    return
+                results.put((t, ex, value))
+
+        self.pools[i].apply_async(run)
+
+    def _hedged(self, transports, op, func, accept=bool, cleanup=None):
+        """ Run func on the transports, nearest first, hedging to the next
+        transport when the previous ones are slow or fail. Returns the
+        transport and value of the first accepted answer. """
+        results = Queue.Queue()
+        state = {'cleanup': cleanup, 'done': False, 'lock': threading.Lock()}
+        remaining = list(transports)
+        pending = []
+        errors = []
+        try:
+            while remaining or pending:
+                if remaining:
+                    pending.append(remaining.pop(0))
+                    self._submit(pending[-1], op, func, results, state)
+                try:
+                    t, ex, value = results.get(timeout=self.hedge_after if remaining else self.timeout)
+                except Queue.Empty:
+                    if remaining:
+                        continue
+                    for t in pending:
+                        self.stats[self.transports.index(t)].timed_out(op)
+                        errors.append((str(t), 'Timed out after %ss' % self.timeout))
+                    break
+
+                pending.remove(t)
+                if ex is not None:
+                    errors.append((str(t), get_stacktrace_info(ex)))
+                elif accept(value):
+                    return t, value, errors
+                elif cleanup:
+                    cleanup(value)
+        finally:
+            with state['lock']:
+                state['done'] = True
+                # Answers that came in after the winner was picked.
+                while cleanup:
+                    try:
+                        _, ex, value = results.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if ex is None:
+                        cleanup(value)
+
+        return None, None, errors
+
+    def _gather(self, transports, op, func):
+        """ Run func on all the transports in parallel. Returns the
+        (transport, exception, value) of each. """
+        results = Queue.Queue()
+        state = {'cleanup': None, 'done': False, 'lock': threading.Lock()}
+        for t in transports:
+            self._submit(t, op, func, results, state)
+
+        answers = []
+        pending = list(transports)
+        deadline = time.time() + self.timeout
+        try:
+            while pending:
+                try:
+                    t, ex, value = results.get(timeout=max(deadline - time.time(), 0))
+                except Queue.Empty:
+                    break
+                pending.remove(t)
+                answers.append((t, ex, value))
+        finally:
+            with state['lock']:
+                state['done'] = True
+
+        for t in pending:
+            self.stats[self.transports.index(t)].timed_out(op)
+            answers.append((t, FileStoreException('Timed out after %ss' % self.timeout), None))
+
+        return answers
 
     def __enter__(self):
         return self
@@ -130,6 +306,11 @@ class FileStore(object):
         self.close()
 
     def close(self):
+        if self.pools:
+            for pool in self.pools:
+                pool.terminate()
+            self.pools = None
+
         for t in self.transports:
             try:
                 t.close()
@@ -145,14 +326,46 @@ class FileStore(object):
                 trace = get_stacktrace_info(ex)
                 self.log.info('Transport problem: %s', trace)
 
+    def delete_many(self, paths, location='all'):
+        """ Deletes paths with one delete_many call per transport (in parallel
+        in concurrent mode). Files that are already gone are not errors.
+        Returns the set of paths that could not be deleted from at least one
+        transport. """
+        transports = self.slice(location)
+        func = lambda x: x.delete_many(paths)
+        if self.pools and len(transports) > 1:
+            answers = self._gather(transports, 'delete', func)
+        else:
+            answers = []
+            for t in transports:
+                try:
+                    answers.append((t, None, self._call(t, 'delete', func)))
+                except Exception as ex: #pylint: disable=W0703
+                    answers.append((t, ex, None))
+
+        failures = set()
+        for t, ex, failed in answers:
+            if ex is not None:
+                failures.update(paths)
+                self.log.info('Transport problem: %s: %s', t, str(ex))
+            elif failed:
+                failures.update(path for path, _ in failed)
+                self.log.info('Transport problem: %s: could not delete %d files (%s: %s)',
+                              t, len(failed), failed[0][0], failed[0][1])
+        return failures
+
     def download(self, src_path, dest_path, location='any'):
+        transports = self.slice(location)
+        if self.pools and len(transports) > 1:
+            return self._download_hedged(transports, src_path, dest_path)
+
         successful = False
-        transports = []
+        used = []
         download_errors = []
-        for t in self.slice(location):
+        for t in transports:
             try:
-                t.download(src_path, dest_path)
-                transports.append(t)
+                self._call(t, 'download', lambda x: x.download(src_path, dest_path))
+                used.append(t)
                 successful = True
                 break
             except Exception as ex: #pylint: disable=W0703
@@ -160,13 +373,50 @@ class FileStore(object):
 
         if not successful:
             raise FileStoreException('No transport succeeded:\n%s' % pprint.pformat((download_errors)))
-        return transports
+        return used
+
+    def _download_hedged(self, transports, src_path, dest_path):
+        # Each transport downloads to its own file. The winner is moved in place.
+        def download(t):
+            partial_path = '%s.%d.part' % (dest_path, self.transports.index(t))
+            try:
+                t.download(src_path, partial_path)
+            except:
+                remove_quietly(partial_path)
+                raise
+            return partial_path
+
+        t, partial_path, download_errors = self._hedged(transports, 'download', download,
+                                                        cleanup=remove_quietly)
+        if not t:
+            raise FileStoreException('No transport succeeded:\n%s' % pprint.pformat((download_errors)))
+
+        os.rename(partial_path, dest_path)
+        return [t]
 
     def exists(self, path, location='any'):
         transports = []
-        for t in self.slice(location):
+        candidates = self.slice(location)
+        if self.pools and len(candidates) > 1:
+            if location == 'any':
+                t, _, errors = self._hedged(candidates, 'exists', lambda x: x.exists(path))
+                for error in errors:
+                    self.log.warning('Transport problem: %s', error[1])
+                if t:
+                    transports.append(t)
+                return transports
+
+            for t, ex, value in self._gather(candidates, 'exists', lambda x: x.exists(path)):
+                if ex is not None:
+                    self.log.warning('Transport problem: %s', get_stacktrace_info(ex))
+                elif value:
+                    transports.append(t)
+            # Keep the transports in nearest first order.
+            return [t for t in candidates if t in transports]
+
+        for t in candidates:
             try:
-                if t.exists(path):
+                if self._call(t, 'exists', lambda x: x.exists(path)):
                     transports.append(t)
                     if location == 'any':
                         break
@@ -176,10 +426,23 @@ class FileStore(object):
         return transports
 
     def get(self, path, location='any'):
-        for t in self.slice(location):
+        def get(x):
+            if x.exists(path):
+                return x.get(path)
+            return None
+
+        transports = self.slice(location)
+        if self.pools and len(transports) > 1:
+            _, data, errors = self._hedged(transports, 'get', get, accept=lambda v: v is not None)
+            for error in errors:
+                self.log.warning('Transport problem: %s', error[1])
+            return data
+
+        for t in transports:
             try:
-                if t.exists(path):
-                    return t.get(path)
+                data = self._call(t, 'get', get)
+                if data is not None:
+                    return data
             except Exception as ex: #pylint: disable=W0703
                 trace = get_stacktrace_info(ex)
                 self.log.warning('Transport problem: %s', trace)
@@ -206,15 +469,24 @@ class FileStore(object):
         return None
 
     def put(self, src_path, dst_path, location='all'):
-        transports = []
-        for t in self.slice(location):
-            if not t.exists(dst_path):
-                transports.append(t)
-                t.put(src_path, dst_path)
-                if not t.exists(dst_path):
-                    raise FileStoreException('File transfer failed. Remote file does not '
-                                             'exist for %s on %s (%s)' % (dst_path, location, t))
-        return transports
+        def put(x):
+            # The transports check that the file is there after uploading it.
+            if x.exists(dst_path):
+                return False
+            x.put(src_path, dst_path)
+            return True
+
+        transports = self.slice(location)
+        if self.pools and len(transports) > 1:
+            uploaded = []
+            for t, ex, value in self._gather(transports, 'put', put):
+                if ex is not None:
+                    raise ex
+                if value:
+                    uploaded.append(t)
+            return uploaded
+
+        return [t for t in transports if self._call(t, 'put', put)]
 
     def put_batch(self, local_remote_tuples, location='all'):
         failed_tuples = []
@@ -238,5 +510,16 @@ class FileStore(object):
         assert(len(transports) >= 1)
         return transports
 
+    def transport_stats(self):
+        """ Returns the latency and error counters of each transport. """
+        return {str(t): s.as_dict() for t, s in zip(self.transports, self.stats)}
+
     def __str__(self):
         return ', '.join(str(t) for t in self.transports)
+
+
+def remove_quietly(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
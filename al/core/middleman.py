@@ -66,6 +66,7 @@ from random import random
 from assemblyline.common import net
 from threading import RLock, Thread
 
+from assemblyline.common.caching import StripedLRUCache
 from assemblyline.common.charset import dotdump, safe_str
 from assemblyline.common.exceptions import get_stacktrace_info
 from assemblyline.common.isotime import iso_to_epoch, now, now_as_iso
@@ -136,9 +137,9 @@ for opt, arg in opts:
 
 # Globals
 alertq = queue.NamedQueue('m-alert', **persistent)  # df line queue
-cache = {}
-cache_lock = RLock()
+cache_size = config.core.middleman.get('cache_size', 100000)
 chunk_size = 1000
+ingest_batch_size = config.core.middleman.get('ingest_batch_size', chunk_size)
 completeq_name = 'm-complete-' + shard
 date_fmt = '%Y-%m-%dT%H:%M:%SZ'
 default_prefix = config.core.middleman.default_prefix
@@ -213,6 +214,13 @@ except AttributeError:
         ingester_threads
     )
 
+# The local filescore cache. Entries are flagged stale and dropped once
+# expired based on the time the submission completed (see stale/expired).
+cache = StripedLRUCache(
+    cache_size, expire_after_seconds,
+    stats=lambda name: ingester_counts.increment('ingest.local_cache_' + name)
+)
+
 submitter_threads = 1
 try:
     submitter_threads = int(config.core.middleman.submitter_threads)
@@ -303,54 +311,89 @@ def exit_and_log(original):
     return wrapper
 
 
-def _add(key, psid, sid, score, errors, t):
-    cache[key] = {
+def add(key, psid, sid, score, errors, t):
+    if errors:
+        expire_at = t + incomplete_expire_after_seconds
+        stale_at = t + incomplete_stale_after_seconds
+    else:
+        expire_at = t + expire_after_seconds
+        stale_at = t + stale_after_seconds
+
+    cache.add(key, {
         'errors': errors,
         'psid': psid,
         'score': score,
         'sid': sid,
         'time': t,
-    }
-
-
-def add(key, psid, sid, score, errors, t):
-    with cache_lock:
-        _add(key, psid, sid, score, errors, t)
+    }, expire_at=expire_at, stale_at=stale_at)
 
 
 def check(datastore, notice):
     key = stamp_filescore_key(notice)
 
-    with cache_lock:
-        result = cache.get(key, None)
-
-    counter_name = 'ingest.cache_hit_local'
+    # Expired entries never come back from the local cache.
+    result, is_stale = cache.lookup(key)
     if result:
         logger.info('Local cache hit')
-    else:
-        counter_name = 'ingest.cache_hit'
+        return verdict(key, result, is_stale, 'ingest.cache_hit_local')
+
+    result = datastore.get_filescore(key)
+    if not result:
+        ingester_counts.increment('ingest.cache_miss')
+        return None, False, None, key
+
+    logger.info('Remote cache hit')
+    return check_remote(datastore, key, result)
+
+
+def check_many(datastore, notices):
+    """Like check but resolves all cache misses with a single multiget."""
+    keys = [stamp_filescore_key(notice) for notice in notices]
+    verdicts = [None] * len(keys)
 
-        result = datastore.get_filescore(key)
+    remote = []
+    for i, key in enumerate(keys):
+        result, is_stale = cache.lookup(key)
         if result:
-            logger.info('Remote cache hit')
+            verdicts[i] = verdict(key, result, is_stale, 'ingest.cache_hit_local')
         else:
+            remote.append(i)
+
+    if not remote:
+        return verdicts
+
+    found = datastore.get_filescores_dict(list(set([keys[i] for i in remote])))
+    for i in remote:
+        key = keys[i]
+        result = found.get(key, None)
+        if not result:
             ingester_counts.increment('ingest.cache_miss')
-            return None, False, None, key
+            verdicts[i] = None, False, None, key
+        else:
+            verdicts[i] = check_remote(datastore, key, result)
+
+    return verdicts
 
-        add(key, result.get('psid', None), result['sid'], result['score'],
-            result.get('errors', 0), result['time'])
 
+def check_remote(datastore, key, result):
     current_time = now()
     delta = current_time - result.get('time', current_time)
     errors = result.get('errors', 0)
 
     if expired(delta, errors):
         ingester_counts.increment('ingest.cache_expired')
-        with cache_lock:
-            cache.pop(key, None)
-            datastore.delete_filescore(key)
-        return None, False, None, key 
-    elif stale(delta, errors):
+        cache.pop(key, None)
+        datastore.delete_filescore(key)
+        return None, False, None, key
+
+    add(key, result.get('psid', None), result['sid'], result['score'],
+        errors, result['time'])
+
+    return verdict(key, result, stale(delta, errors), 'ingest.cache_hit')
+
+
+def verdict(key, result, is_stale, counter_name):
+    if is_stale:
         ingester_counts.increment('ingest.cache_stale')
         return None, False, result['score'], key
 
@@ -408,19 +451,19 @@ def completed(task):  # df node def
 
         notice = Notice(raw)
  
-        with cache_lock:
-            _add(scan_key, psid, sid, score, errors, now())
+        add(scan_key, psid, sid, score, errors, now())
 
         finalize(psid, sid, score, notice)  # df push calls
 
         def exhaust():
             while True:
-                res = dupq.pop(  # df pull pop
-                    dup_prefix + scan_key, blocking=False
+                res = dupq.pop_many(  # df pull pop
+                    dup_prefix + scan_key, chunk_size
                 )
-                if res is None:
+                if not res:
                     break
-                yield res
+                for dup in res:
+                    yield dup
 
         # You may be tempted to remove the assignment to dups and use the
         # value directly in the for loop below. That would be a mistake.
@@ -491,6 +534,30 @@ def drop_chance(length, maximum):
     return tanh(float(length - maximum) / maximum * 2.0)
 
 
+def freshen_dropped(datastore, raws):
+    """ Freshens the files of dropped notices and sends their notifications.
+    Returns the notices that could not be freshened. """
+    expiry = now_as_iso(86400)
+    files = []
+    for raw in raws:
+        notice = Notice(raw)
+        c12n = notice.get('classification', config.core.middleman.classification)
+        sha256 = notice.get('sha256')
+        files.append((sha256, {'sha256': sha256}, expiry, c12n))
+
+    failed = set(datastore.save_or_freshen_files(files))
+
+    retry = []
+    for raw in raws:
+        notice = Notice(raw)
+        if notice.get('sha256') in failed:
+            retry.append(raw)
+            continue
+        send_notification(notice)
+
+    return retry
+
+
 @exit_and_log
 def dropper():  # df node def
     datastore = forge.get_datastore()
@@ -500,15 +567,21 @@ def dropper():  # df node def
         if not raw:
             continue
 
-        notice = Notice(raw)
-
-        send_notification(notice)
+        # Drain whatever else is waiting so the files are freshened with a
+        # single multiget and multiput instead of a read and write each.
+        raws = [raw] + dropq.pop_many(chunk_size - 1)  # df pull pop
 
-        c12n = notice.get('classification', config.core.middleman.classification)
-        expiry = now_as_iso(86400)
-        sha256 = notice.get('sha256')
+        try:
+            retry = freshen_dropped(datastore, raws)
+        except Exception:  # pylint: disable=W0703
+            logger.exception("Problem freshening %d dropped files:", len(raws))
+            retry = raws
+            time.sleep(1)
 
-        datastore.save_or_freshen_file(sha256, {'sha256': sha256}, expiry, c12n)
+        # The file must not expire while it is still referenced.
+        if retry:
+            logger.warning("Could not freshen %d dropped files, requeuing", len(retry))
+            dropq.push_many(retry)  # df push push
 
     datastore.close()
 
@@ -552,6 +625,33 @@ def finalize(psid, sid, score, notice):  # df node def
 
 
 def ingest(datastore, user_groups, raw):  # df node def
+    notice = prepare(datastore, user_groups, raw)
+    if not notice:
+        return
+
+    pprevious, previous, score = None, False, None
+    if not notice.get('ignore_cache', False):
+        pprevious, previous, score, _ = check(datastore, notice)
+
+    decide(notice, pprevious, previous, score)  # df push calls
+
+
+def ingest_many(datastore, user_groups, raws):  # df node def
+    notices = [prepare(datastore, user_groups, raw) for raw in raws]
+    notices = [notice for notice in notices if notice]
+
+    cached = [n for n in notices if not n.get('ignore_cache', False)]
+    verdicts = dict(zip([id(n) for n in cached], check_many(datastore, cached)))
+
+    for notice in notices:
+        pprevious, previous, score = None, False, None
+        if id(notice) in verdicts:
+            pprevious, previous, score, _ = verdicts[id(notice)]
+
+        decide(notice, pprevious, previous, score)  # df push calls
+
+
+def prepare(datastore, user_groups, raw):
     notice = Notice(raw)
 
     ignore_size = notice.get('ignore_size', False)
@@ -572,7 +672,7 @@ def ingest(datastore, user_groups, raw):  # df node def
         if groups is None:
             ruser = datastore.get_user(user)
             if not ruser:
-                return
+                return None
             groups = ruser.get('groups', [])
             user_groups[user] = groups
         notice.set('groups', groups)
@@ -594,7 +694,7 @@ def ingest(datastore, user_groups, raw):  # df node def
         send_notification(
             notice, failure="Invalid sha256", logfunc=logger.warning
         )
-        return
+        return None
 
     c12n = notice.get('classification', '')
     if not Classification.is_valid(c12n):
@@ -602,7 +702,7 @@ def ingest(datastore, user_groups, raw):  # df node def
             notice, failure="Invalid classification %s" % c12n,
             logfunc=logger.warning
         )
-        return
+        return None
 
     metadata = notice.get('metadata', {})
     if isinstance(metadata, dict):
@@ -626,12 +726,12 @@ def ingest(datastore, user_groups, raw):  # df node def
         )
         dropq.push(notice.raw)  # df push push
         ingester_counts.increment('ingest.skipped')
-        return
+        return None
+
+    return notice
 
-    pprevious, previous, score = None, False, None
-    if not notice.get('ignore_cache', False):
-        pprevious, previous, score, _ = check(datastore, notice)
 
+def decide(notice, pprevious, previous, score):  # df node def
     # Assign priority.
     low_priority = is_low_priority(notice)
 
@@ -689,22 +789,28 @@ def ingester():  # df node def # pylint:disable=R0912
 
             completed(Task(result))  # df push calls
 
-        entry = ingestq.pop(timeout=1)  # df pull pop
-        if not entry:
-            continue
+        entries = ingestq.pop_many(ingest_batch_size)  # df pull pop
+        if not entries:
+            entry = ingestq.pop(timeout=1)  # df pull pop
+            if not entry:
+                continue
+            entries = [entry]
 
-        trafficq.push(entry)  # df push push
+        trafficq.push(*entries)  # df push push
 
-        sha256 = entry.get('sha256', '')
-        if not sha256 or len(sha256) != 64:
-            logger.error("Invalid sha256: %s", entry)
-            continue
+        raws = []
+        for entry in entries:
+            sha256 = entry.get('sha256', '')
+            if not sha256 or len(sha256) != 64:
+                logger.error("Invalid sha256: %s", entry)
+                continue
 
-        entry['md5'] = entry.get('md5', '').lower()
-        entry['sha1'] = entry.get('sha1', '').lower()
-        entry['sha256'] = sha256.lower()
+            entry['md5'] = entry.get('md5', '').lower()
+            entry['sha1'] = entry.get('sha1', '').lower()
+            entry['sha256'] = sha256.lower()
+            raws.append(entry)
 
-        ingest(datastore, user_groups, entry)  # df push calls
+        ingest_many(datastore, user_groups, raws)  # df push calls
 
     datastore.close()
 
@@ -731,7 +837,9 @@ def init():
         if not task.original_selected or not task.root_sha256 or not task.scan_key:
             continue
 
-        if forge.determine_ingest_queue(task.root_sha256) != ingestq_name:
+        # In flight submissions are tracked by the shard that ingested them,
+        # which is the previous owner while shards are being rebalanced.
+        if forge.determine_ingest_queue(task.root_sha256, previous=True) != ingestq_name:
             continue
 
         scan_key = task.scan_key
@@ -913,7 +1021,7 @@ def maintain_inflight():  # df node def
             # Remove the key event_timestamp if it exists.
             raw.pop('event_timestamp', None)
 
-            submissionq.push(raw)  # df push push
+        submissionq.push_many(entries)  # df push push
 
 
 ###############################################################################
@@ -982,12 +1090,32 @@ def process_timeouts():  # df node def
         timeouts = timeouts[index:]
 
 
+def reroute_orphans():
+    # While shards are rebalanced, notices left in the ingest queues of
+    # shards that no longer exist are moved to their new shard.
+    router = forge.get_shard_router('middleman')
+    for n in router.orphaned_shards(shard):
+        name = 'm-ingest-' + str(n)
+        count = 0
+        raw = dupq.pop(name, blocking=False)
+        while raw:
+            dupq.push(forge.determine_ingest_queue(raw.get('sha256', '')), raw)
+            count += 1
+            raw = dupq.pop(name, blocking=False)
+        if count:
+            logger.info("Rerouted %d notices from %s.", count, name)
+
+
 def reinsert(datastore, msg, notice, out, retry_all=True):
     sha256 = notice.get('sha256')
     if not sha256:
         logger.error("Invalid sha256: %s", notice.raw)
 
-    if forge.determine_ingest_queue(sha256) != ingestq_name:
+    queue_name = forge.determine_ingest_queue(sha256)
+    if queue_name != ingestq_name:
+        if forge.determine_ingest_queue(sha256, previous=True) == ingestq_name:
+            # We held this under the previous shard layout. Hand it over.
+            dupq.push(queue_name, notice.raw)
         return
 
     pprevious, previous, score = None, False, None
@@ -1280,13 +1408,14 @@ def timed_out(scan_key):  # df node def
             actual_timeout = True
             logger.error("Submission timed out for %s: %s", scan_key, str(entry))
 
-        dup = dupq.pop(dup_prefix + scan_key, blocking=False)  # df pull pop
-        if dup:
+        dups = dupq.pop_many(dup_prefix + scan_key, chunk_size)  # df pull pop
+        if dups:
             actual_timeout = True
 
-        while dup:
-            logger.error("Submission timed out for %s: %s", scan_key, str(dup))
-            dup = dupq.pop(dup_prefix + scan_key, blocking=False)
+        while dups:
+            for dup in dups:
+                logger.error("Submission timed out for %s: %s", scan_key, str(dup))
+            dups = dupq.pop_many(dup_prefix + scan_key, chunk_size)
 
     if actual_timeout:
         ingester_counts.increment('ingest.timed_out')
@@ -1307,25 +1436,29 @@ whitelister_counts = counter.AutoExportingCounters(
     export_interval_secs=config.system.update_interval,
     channel=forge.get_metrics_sink())
 
-init()
-
-Thread(target=maintain_inflight, name="maintain_inflight").start()
-Thread(target=process_retries, name="process_retries").start()
-Thread(target=send_heartbeats, name="send_heartbeats").start()
-Thread(target=send_traffic, name="send_traffic").start()
-
-# pylint: disable=C0321
-for i in range(dropper_threads):
-    Thread(target=dropper, name="dropper_%s" % i).start()  # df line thread
-# noinspection PyRedeclaration
-for i in range(ingester_threads):
-    Thread(target=ingester, name="ingester_%s" % i).start()  # df line thread
-# noinspection PyRedeclaration
-for i in range(submitter_threads):
-    Thread(target=submitter, name="submitter_%s" % i).start()  # df line thread
-
-while running:
-    process_timeouts()
-    time.sleep(60)
+# Importing middleman (the benchmarks do) must not start it.
+if __name__ == '__main__':
+    init()
+    forge.watch_config_changes()
+
+    Thread(target=maintain_inflight, name="maintain_inflight").start()
+    Thread(target=process_retries, name="process_retries").start()
+    Thread(target=send_heartbeats, name="send_heartbeats").start()
+    Thread(target=send_traffic, name="send_traffic").start()
+
+    # pylint: disable=C0321
+    for i in range(dropper_threads):
+        Thread(target=dropper, name="dropper_%s" % i).start()  # df line thread
+    # noinspection PyRedeclaration
+    for i in range(ingester_threads):
+        Thread(target=ingester, name="ingester_%s" % i).start()  # df line thread
+    # noinspection PyRedeclaration
+    for i in range(submitter_threads):
+        Thread(target=submitter, name="submitter_%s" % i).start()  # df line thread
+
+    while running:
+        process_timeouts()
+        reroute_orphans()
+        time.sleep(60)
 
 # df text }
@@ -92,8 +92,13 @@ class SubmissionWrapper(object):
 
     # noinspection PyBroadException
     @classmethod
-    def identify(cls, transport, storage, sha256, **kw):
-        """ Identify a file. """
+    def identify(cls, transport, storage, sha256, fileinfo=None, **kw):
+        """ Identify a file.
+
+        If the caller already fingerprinted the file (fileinfo) it is reused
+        instead of reading the file again.
+
+        """
         assert_valid_sha256(sha256)
 
         classification = kw['classification']
@@ -115,6 +120,11 @@ class SubmissionWrapper(object):
                         sha256, str(transport))
             return None
 
+        if fileinfo and fileinfo.get('sha256', None) == sha256:
+            fileinfo = fileinfo.copy()
+            storage.save_or_freshen_file(sha256, fileinfo, expiry, classification)
+            return fileinfo
+
         temporary_path = fileinfo = None
         try:
             if not local_path:
@@ -162,10 +172,12 @@ class SubmissionWrapper(object):
 
     # noinspection PyBroadException
     @classmethod
-    def submit(cls, transport, storage, sha256, path, priority, submitter, **kw):
+    def submit(cls, transport, storage, sha256, path, priority, submitter, fileinfo=None, **kw):
         """ Execute a submit.
 
-        Any kw are passed along in the dispatched request.
+        Any kw are passed along in the dispatched request. If the caller
+        already fingerprinted the file (fileinfo) it is reused instead of
+        reading the file again.
 
         """
         assert_valid_sha256(sha256)
@@ -186,6 +198,13 @@ class SubmissionWrapper(object):
         if not transport.exists(sha256):
             raise SubmissionException('File specified is not on server: %s %s.' % (sha256, str(transport)))
 
+        if fileinfo and fileinfo.get('sha256', None) == sha256:
+            fileinfo = fileinfo.copy()
+            if not local_path and os.path.exists(fileinfo.get('path', '')):
+                local_path = fileinfo['path']
+        else:
+            fileinfo = None
+
         root_sha256 = sha256
         temporary_path = massaged_path = None
         try:
@@ -194,10 +213,11 @@ class SubmissionWrapper(object):
                 transport.download(sha256, temporary_path)
                 local_path = temporary_path
 
-            fileinfo = identify.fileinfo(local_path)
-            if fileinfo['sha256'] != sha256:
-                raise CorruptedFileStoreException('SHA256 mismatch between received '
-                                                  'and calculated sha256. %s != %s' % (sha256, fileinfo['sha256']))
+            if not fileinfo:
+                fileinfo = identify.fileinfo(local_path)
+                if fileinfo['sha256'] != sha256:
+                    raise CorruptedFileStoreException('SHA256 mismatch between received '
+                                                      'and calculated sha256. %s != %s' % (sha256, fileinfo['sha256']))
             storage.save_or_freshen_file(sha256, fileinfo, expiry, classification)
 
             decode_file = forge.get_decode_file()
@@ -482,12 +502,15 @@ class SubmissionService(object):
         return SubmissionWrapper.check_exists(self.transport, sha256_list)
 
     def identify(self, sha256, **kw):
+        # Fingerprints are only trusted when computed in-process.
+        kw.pop('fileinfo', None)
         return SubmissionWrapper.identify(self.transport, self.storage, sha256, **kw)
 
     def presubmit(self, sha256, **kw):
         return SubmissionWrapper.presubmit(self.transport, sha256, **kw)
 
     def submit(self, sha256, path, priority, submitter, **kw):
+        kw.pop('fileinfo', None)
         return SubmissionWrapper.submit(self.transport, self.storage, sha256, path, priority, submitter, **kw)
 
     def submit_inline(self, file_paths, **kw):
@@ -514,6 +537,9 @@ class SubmissionClient(object):
         self.transport = forge.get_filestore()
         self.datastore = datastore
         self.is_unix = os.name == "posix"
+        # Fingerprints computed during presubmit, by sha256, so the submit
+        # and identify steps don't have to read the file again.
+        self.fingerprints = {}
         if not self.is_unix:
             from assemblyline_client import Client
             self.client = Client(self.server_url, auth=SUBMISSION_AUTH)
@@ -549,6 +575,7 @@ class SubmissionClient(object):
     def _identify_supplementary_unix(self, submits):
         submit_results = {}
         for key, submit in submits.iteritems():
+            submit['fileinfo'] = self.fingerprints.pop(submit.get('sha256', None), None)
             file_info = SubmissionWrapper.identify(self.transport, self.datastore, **submit)
             if file_info:
                 submit_result = {"status": "succeeded", "fileinfo": file_info}
@@ -569,20 +596,30 @@ class SubmissionClient(object):
         max_size = config.submissions.max.size
 
         # Prepare the batch presubmit.
+        self.fingerprints = {}
         rid_map = {}
         for rid, local_path in enumerate(file_paths):
             rid = str(rid)
             rid_map[rid] = local_path
             try:
                 assert_valid_file(local_path)
-                d = digests.get_digests_for_file(local_path,
-                                                 calculate_entropy=False)
-                if d['size'] > max_size and not ignore_size:
+                # Skip oversized files before reading them.
+                size = os.path.getsize(local_path)
+                if size > max_size and not ignore_size:
                     presubmit_results[rid] = {
                         'succeeded': False,
-                        'error': 'file too large (%d > %d). Skipping' % (d['size'], max_size),
+                        'error': 'file too large (%d > %d). Skipping' % (size, max_size),
                     }
                     continue
+                if self.is_unix:
+                    # The submit happens in-process so fingerprint the file
+                    # fully now, in one pass, and reuse it at submit time.
+                    fingerprint = identify.fileinfo(local_path)
+                    self.fingerprints[fingerprint['sha256']] = fingerprint
+                    d = {k: fingerprint[k] for k in ('path', 'md5', 'sha1', 'sha256', 'size')}
+                else:
+                    d = digests.get_digests_for_file(local_path,
+                                                     calculate_entropy=False)
                 presubmit_requests[rid] = d
                 # Set a default error. Overwritten on success.
                 presubmit_results[rid] = default_error.copy()
@@ -697,6 +734,7 @@ class SubmissionClient(object):
             path = submit.get('path', './path/missing')
             if 'description' not in submit:
                 submit['description'] = "Inspection of file: %s" % path
+            submit['fileinfo'] = self.fingerprints.pop(submit.get('sha256', None), None)
             submit_result = SubmissionWrapper.submit(self.transport, self.datastore, **submit)
             submit_results[key] = submit_result
         return submit_results
@@ -35,8 +35,10 @@ def install(alsi=None):
         'versiontools',
         'ansicolors==1.0.2',
         'chardet==2.2.1',
+        'numpy',
         'requests>=2.0',
         'hiredis<=0.1.4',
+        'msgpack-python',
         'psutil==2.1.1',
         'python-magic==0.4.6',
         'ssdeep==2.9-0.3',
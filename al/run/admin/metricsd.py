@@ -44,7 +44,8 @@ def cleanup_metrics(input_dict):
 class MetricsServer(object):
 
     SRV_METRICS = ['svc.cache_hit', 'svc.cache_miss', 'svc.cache_skipped', 'svc.execute_start', 'svc.execute_done',
-                   'svc.execute_fail_recov', 'svc.execute_fail_nonrecov', 'svc.job_scored', 'svc.job_not_scored']
+                   'svc.execute_fail_recov', 'svc.execute_fail_nonrecov', 'svc.job_scored', 'svc.job_not_scored',
+                   'svc.sample_cache_hit', 'svc.sample_cache_miss']
     INGEST_METRICS = ['ingest.duplicates', 'ingest.bytes_ingested', 'ingest.submissions_ingested', 'ingest.error',
                       'ingest.timed_out', 'ingest.submissions_completed', 'ingest.files_completed',
                       'ingest.bytes_completed', 'ingest.skipped', 'ingest.whitelisted']
@@ -259,8 +259,8 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
         Backup the database content to a set of json files
 
         Usage:
-            backup <destination_folder>
-                   <destination_folder> <bucket_name> [follow] [force] <query>
+            backup <destination_folder> [compress]
+                   <destination_folder> <bucket_name> [follow] [force] [compress] <query>
 
         Parameters:
             <destination_folder> Path to the destination folder [required]
@@ -273,6 +273,8 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
             force                Automatically perform backup without asking for confirmation
                                  [optional, only used in backup by query]
 
+            compress             Gzip the backup files [optional]
+
             <query>              Query that the data need to match
                                  [optional, only used in backup by query]
 
@@ -295,6 +297,11 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
             force = True
             args.remove('force')
 
+        compress = False
+        if 'compress' in args:
+            compress = True
+            args.remove('compress')
+
         if len(args) == 1:
             dest = args[0]
             system_backup = True
@@ -309,7 +316,7 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
             return
 
         if system_backup:
-            backup_manager = DistributedBackup(dest, worker_count=5)
+            backup_manager = DistributedBackup(dest, worker_count=5, compress=compress)
             backup_manager.backup(["blob", "node", "profile", "signature", "user"])
         else:
             data = self.datastore._search_bucket(self.datastore.get_bucket(bucket), query, start=0, rows=1)
@@ -346,7 +353,7 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
                       "Maybe you should write your backups in /tmp ?" % dest
                 return
 
-            backup_manager = DistributedBackup(dest, worker_count=max(1, min(total / 1000, 50)))
+            backup_manager = DistributedBackup(dest, worker_count=max(1, min(total / 1000, 50)), compress=compress)
 
             try:
                 backup_manager.backup([bucket], follow_keys=follow, query=query)
@@ -358,17 +365,26 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
         """
         Restore a backup created by the backup command
 
+        An interrupted restore resumes with the files it did not restore.
+
         Usage:
-            restore <backup_directory>
+            restore <backup_directory> [restart]
 
         Parameters:
             <backup_directory> Path to the backup folder [required]
 
+            restart            Restore every file again instead of resuming [optional]
+
         Examples:
             restore /tmp/backup_folder
         """
         args = self._parse_args(args)
 
+        restart = False
+        if 'restart' in args:
+            restart = True
+            args.remove('restart')
+
         if len(args) not in [1]:
             self._print_error("Wrong number of arguments for restore command.")
             return
@@ -378,12 +394,10 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
             self._print_error("You must specify an input folder.")
             return
 
-        workers = len([x for x in os.listdir(path) if '.part' in x])
-
-        backup_manager = DistributedBackup(path, worker_count=workers)
+        backup_manager = DistributedBackup(path, worker_count=50)
 
         try:
-            backup_manager.restore()
+            backup_manager.restore(restart=restart)
         except KeyboardInterrupt:
             backup_manager.terminate()
             raise
@@ -427,6 +441,7 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
             cur_seed = self.datastore.get_blob('seed')
             self.datastore.save_blob('seed', self.datastore.get_blob('previous_seed'))
             self.datastore.save_blob('previous_seed', cur_seed)
+            forge.notify_config_changed()
             print "Current and previous seed where swapped."
             return
         elif action_type == 'module':
@@ -466,6 +481,8 @@ class ALCommandLineInterface(cmd.Cmd):  # pylint:disable=R0904
             print "Current seed was copied to previous_seed key."
 
         self.datastore.save_blob(target, seed)
+        if target == "seed":
+            forge.notify_config_changed()
         print "Module '%s' was loaded into blob '%s'." % (seed_path, target)
 
     #
@@ -12,16 +12,16 @@ if __name__ == "__main__":
     try:
         arg_worker_type = int(sys.argv[1])
         arg_wid = int(sys.argv[2])
-        arg_working_dir = " ".join(sys.argv[3:])
+        arg_working_dir = sys.argv[3]
         arg_instance_id = sys.argv[4]
+        arg_compress = len(sys.argv) > 5 and sys.argv[5] == "compress"
     except:
         print >> sys.stderr, "Failed to initialised backup worker. You need to provide a worker type, " \
-                             "a worker ID and a working directory."
+                             "a worker ID, a working directory and an instance ID."
         sys.exit(1)
 
     if not os.path.exists(arg_working_dir):
         os.makedirs(arg_working_dir)
 
-    backup_worker = BackupWorker(arg_wid, arg_worker_type, arg_working_dir, arg_instance_id)
+    backup_worker = BackupWorker(arg_wid, arg_worker_type, arg_working_dir, arg_instance_id, arg_compress)
     backup_worker.run()
-
@@ -8,12 +8,14 @@ from threading import Thread
 
 from assemblyline.common.isotime import now_as_iso, now, iso_to_epoch
 from assemblyline.al.common import forge, log as al_log, queue
+from assemblyline.al.common.journal import is_journal, read_journal
 from assemblyline.al.core.datastore import SearchException
 
 DATABASE_NUM = 4
 QUERY = "__expiry_ts__:[* TO NOW-12HOUR]"  # Delay expiry by 12 hours so we expire peak data during offpeak hours
 SLEEP_TIME = 5
 MAX_QUEUE_LENGTH = 100000
+JOURNAL_CHUNK_SIZE = 1000
 
 config = forge.get_config()
 al_log.init_logging('expiry')
@@ -120,23 +122,16 @@ def load_journal(name, delete_queue):
             for listed_file in os.listdir(working_dir):
                 journal_file = os.path.join(working_dir, listed_file)
                 if os.path.isfile(journal_file):
-                    if journal_file.endswith(name):
+                    if is_journal(listed_file, name):
                         cur_time = now()
                         day = "%sT00:00:00Z" % listed_file.split(".")[0]
                         file_time = iso_to_epoch(day)
                         if file_time + expiry_ttl <= cur_time:
-                            with open(journal_file) as to_delete_journal:
-                                count = 0
-                                for line in to_delete_journal:
-                                    if count % 1000 == 0:
-                                        while delete_queue.length() > MAX_QUEUE_LENGTH:
-                                            time.sleep(SLEEP_TIME)
-
-                                    line = line.strip()
-                                    if line:
-                                        delete_queue.push(line)
-
-                                    count += 1
+                            for keys in read_journal(journal_file, JOURNAL_CHUNK_SIZE):
+                                while delete_queue.length() > MAX_QUEUE_LENGTH:
+                                    time.sleep(SLEEP_TIME)
+
+                                delete_queue.push(*keys)
 
                             os.unlink(journal_file)
         except OSError:
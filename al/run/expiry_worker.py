@@ -1,76 +1,146 @@
 #!/usr/bin/env python
 
 import logging
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
+
+from assemblyline.common import net
+from assemblyline.al.common import counter
 from assemblyline.al.common import forge
 from assemblyline.al.common import log as al_log
 from assemblyline.al.common import queue
 config = forge.get_config()
 
 DATABASE_NUM = 4
+BATCH_SIZE = config.core.expiry.get('batch_size', 500)
+DELETE_THREADS = config.core.expiry.get('delete_threads', 16)
+RATE_INTERVAL = 60
 
 al_log.init_logging('expiry_worker')
 log = logging.getLogger('assemblyline.expiry_worker')
 
+BUCKETS = ['submission', 'result', 'file', 'error', 'dynamic', 'alert', 'filescore', 'emptyresult']
 
-# noinspection PyBroadException
-def main():
-    ds = forge.get_datastore()
-    fs = forge.get_filestore()
-    submission_queue = queue.NamedQueue('d-submission', db=DATABASE_NUM)
-    result_queue = queue.NamedQueue('d-result', db=DATABASE_NUM)
-    file_queue = queue.NamedQueue('d-file', db=DATABASE_NUM)
-    error_queue = queue.NamedQueue('d-error', db=DATABASE_NUM)
-    dynamic_queue = queue.NamedQueue('d-dynamic', db=DATABASE_NUM)
-    alert_queue = queue.NamedQueue('d-alert', db=DATABASE_NUM)
-    filescore_queue = queue.NamedQueue('d-filescore', db=DATABASE_NUM)
-    emptyresult_queue = queue.NamedQueue('d-emptyresult', db=DATABASE_NUM)
 
-    log.info("Ready!")
-    queues = [submission_queue, result_queue, file_queue, error_queue, dynamic_queue, alert_queue, filescore_queue,
-              emptyresult_queue]
-    while True:
-        queue_name, key = queue.select(*queues)
+class DeleteRates(object):
+    """ Keeps per bucket delete counts and logs the delete rates. """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.deleted = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, bucket, deleted, failed):
+        self.counts.increment('expiry.%s.deleted' % bucket, deleted)
+        if failed:
+            self.counts.increment('expiry.%s.failed' % bucket, failed)
+        with self.lock:
+            self.deleted[bucket] = self.deleted.get(bucket, 0) + deleted
+
+    def log_rates(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            if elapsed < RATE_INTERVAL:
+                return
+            deleted, self.deleted = self.deleted, {}
+            self.start = time.time()
+
+        for bucket, count in sorted(deleted.iteritems()):
+            log.info("%s: %.1f deletes/sec", bucket, count / elapsed)
+
+
+def get_deleters(ds):
+    return {
+        'submission': ds.delete_submission,
+        'result': ds.delete_result,
+        'error': ds.delete_error,
+        'file': ds.delete_file,
+        'alert': ds.delete_alert,
+        'filescore': ds.delete_filescore,
+        'emptyresult': ds.delete_result,
+    }
+
+
+def pop_batch(queues):
+    """ Take up to BATCH_SIZE keys from the next non-empty queue, waiting
+    for one if they are all empty. """
+    for _ in xrange(len(queues)):
+        queues.append(queues.pop(0))
+        keys = queues[-1].pop_many(BATCH_SIZE)
+        if keys:
+            return queues[-1].name, keys
 
+    event = queue.select(*queues, timeout=1)
+    if not event:
+        return None, []
+    queue_name, key = event
+    return queue_name, [key]
+
+
+# noinspection PyBroadException
+def delete_batch(ds, fs, pool, rates, queue_name, items):
+    bucket_name = queue_name[2:]
+    delete = get_deleters(ds).get(bucket_name, None)
+    if not delete:
+        for key in items:
+            log.warning("Unknown message: %s (%s)" % (key, queue_name))
+        return
+
+    def run(item):
+        key = item
         try:
             rewrite = False
             expiry = None
-            if isinstance(key, tuple) or isinstance(key, list):
-                key, rewrite, expiry = key
+            if isinstance(item, tuple) or isinstance(item, list):
+                key, rewrite, expiry = item
 
             if rewrite:
                 # noinspection PyProtectedMember
-                ds._save_bucket_item(ds.get_bucket(queue_name[2:]), key, {"__expiry_ts__": expiry})
-
-            if queue_name == "d-submission":
-                ds.delete_submission(key)
-                log.debug("Submission %s (DELETED)" % key)
-            elif queue_name == "d-result":
-                ds.delete_result(key)
-                log.debug("Result %s (DELETED)" % key)
-            elif queue_name == "d-error":
-                ds.delete_error(key)
-                log.debug("Error %s (DELETED)" % key)
-            elif queue_name == "d-file":
-                ds.delete_file(key)
-                if config.core.expiry.delete_storage and fs.exists(key, location='far'):
-                    fs.delete(key, location='far')
-                log.debug("File %s (DELETED)" % key)
-            elif queue_name == "d-alert":
-                ds.delete_alert(key)
-                log.debug("Alert %s (DELETED)" % key)
-            elif queue_name == "d-filescore":
-                ds.delete_filescore(key)
-                log.debug("FileScore %s (DELETED)" % key)
-            elif queue_name == "d-emptyresult":
-                ds.delete_result(key)
-                log.debug("EmptyResult %s (DELETED)" % key)
-            else:
-                log.warning("Unknown message: %s (%s)" % (key, queue_name))
+                ds._save_bucket_item(ds.get_bucket(bucket_name), key, {"__expiry_ts__": expiry})
+
+            delete(key)
+            log.debug("%s %s (DELETED)" % (bucket_name, key))
+            return key
         except:
             log.exception("Failed deleting key %s from bucket %s:", key, queue_name)
+            return None
+
+    deleted = [key for key in pool.map(run, items) if key is not None]
+    rates.add(bucket_name, len(deleted), len(items) - len(deleted))
+
+    # The files are gone from the datastore. Remove them from storage in one
+    # call per transport, without checking if they exist first.
+    if bucket_name == 'file' and deleted and config.core.expiry.delete_storage:
+        failed = len(fs.delete_many(deleted, location='far'))
+        rates.add('storage', len(deleted) - failed, failed)
+
 
-        queues = queues[1:] + queues[0:1]
+def main():
+    # The riak client pools its connections and is shared by the delete threads.
+    ds = forge.get_datastore()
+    fs = forge.get_filestore()
+    pool = ThreadPool(DELETE_THREADS)
+    queues = [queue.NamedQueue('d-' + name, db=DATABASE_NUM) for name in BUCKETS]
+
+    counts = counter.AutoExportingCounters(
+        name='expiry_worker',
+        host=net.get_hostip(),
+        export_interval_secs=5,
+        channel=forge.get_metrics_sink(),
+        auto_log=False,
+        auto_flush=True)
+    counts.start()
+    rates = DeleteRates(counts)
+
+    log.info("Ready!")
+    while True:
+        queue_name, items = pop_batch(queues)
+        if items:
+            delete_batch(ds, fs, pool, rates, queue_name, items)
+        rates.log_rates()
 
 if __name__ == '__main__':
     log.info("Expiry worker starting...")
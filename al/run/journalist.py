@@ -1,17 +1,18 @@
 #!/usr/bin/env python
 
 import logging
-import os
 import signal
 
 from assemblyline.al.common import forge
 from assemblyline.al.common import log
 from assemblyline.al.common import queue
+from assemblyline.al.common.journal import JournalWriter
 
 config = forge.get_config()
 
 log.init_logging('journalist')
 
+batch_size = config.core.expiry.journal.get('batch_size', 1000)
 directory = config.core.expiry.journal.directory
 emptyresult_queue = queue.NamedQueue(
     "ds-emptyresult",
@@ -20,10 +21,6 @@ emptyresult_queue = queue.NamedQueue(
     port=config.core.redis.persistent.port,
 )   
 logger = logging.getLogger('assemblyline.journalist')
-max_open_files = 8
-path_and_filehandle = []
-path_to_filehandle = {}
-previous = []
 running = True
 
 
@@ -37,51 +34,46 @@ signal.signal(signal.SIGINT, interrupt)
 signal.signal(signal.SIGTERM, interrupt)
 
 
-def get_filehandle(path):
-    fh = path_to_filehandle.get(path, None)
-    if fh:
-        return fh
-
-    # Make sure directory exists.
-    dirname = os.path.dirname(path)
-    if not os.path.exists(dirname):
-        os.makedirs(dirname)
-
-    path_to_filehandle[path] = fh = open(path, 'ab')
-
-    path_and_filehandle.append((fh, path))
-    if len(path_and_filehandle) > max_open_files:
-        pfh, ppath = path_and_filehandle.pop(0)
-
-        if path_to_filehandle.get(ppath, None) == pfh:
-            path_to_filehandle.pop(ppath)
-
-        logger.info("Closing file %s", ppath)
-        pfh.close()
-
-    return fh
+def group_by_day(msgs):
+    """ {day: [riak_key, ...]} of the tab separated riak_key and created
+    time messages. Malformed messages are logged and skipped. """
+    days = {}
+    for msg in msgs:
+        try:
+            riak_key, created = msg.split("\t")
+        except (AttributeError, ValueError):
+            logger.warning('Skipping malformed message: %r', msg)
+            continue
+        days.setdefault(created[:10], []).append(riak_key)
+    return days
 
 
 def main():
+    writer = JournalWriter(
+        directory, '.emptyresult',
+        max_open_files=config.core.expiry.journal.get('max_open_files', 8),
+        flush_interval=config.core.expiry.journal.get('flush_interval', 1.0),
+        compress=config.core.expiry.journal.get('compress', False),
+    )
+
     while running:
         # noinspection PyBroadException
         try:
-            msg = emptyresult_queue.pop()
-            if not msg:
-                continue
-
-            riak_key, created = msg.split("\t")
+            msgs = emptyresult_queue.pop_many(batch_size)
+            if not msgs:
+                msg = emptyresult_queue.pop(timeout=1)
+                msgs = [msg] if msg else []
 
-            path = os.path.join(directory, created[:10]) + '.emptyresult'
-            fh = get_filehandle(path)
+            for day, keys in group_by_day(msgs).iteritems():
+                writer.write(day, keys)
 
-            fh.write(riak_key + "\n")
-            fh.flush()
+            writer.flush()
 
         except:  # pylint: disable=W0702
             logger.exception('Unhandled exception:')
 
+    writer.close()
+
 
 if __name__ == '__main__':
     main()
-
@@ -11,6 +11,7 @@ from assemblyline.al.core.servicing import ServiceProxyManager
 
 def main(shard):
     log.init_logging('dispatcher')
+    forge.watch_config_changes()
 
     ds = forge.get_datastore()
 
@@ -16,6 +16,7 @@ from assemblyline.al.common.queue import NamedQueue
 from assemblyline.al.common.remote_datatypes import ExpiringSet, ExpiringHash
 from assemblyline.al.common.result import Result, ResultSection
 from assemblyline.al.common.task import Child, Task, get_service_overrides
+from assemblyline.al.service.sample_cache import get_sample_cache
 from assemblyline.al.core.datastore import uncompress_riak_key
 from assemblyline.al.core.filestore import CorruptedFileStoreException
 from assemblyline.common import digests
@@ -160,6 +161,13 @@ class ServiceRequest(object):
 
         self._svc = service
 
+    @property
+    def fileinfo(self):
+        """ The fingerprint (digests, entropy, ssdeep, magic...) computed at
+        submission time. Services should use it rather than hashing the
+        downloaded file again. """
+        return dict(self.task.raw.get('fileinfo', None) or {})
+
     @property
     def result(self):
         return self.task.result
@@ -181,10 +189,19 @@ class ServiceRequest(object):
     def download(self):
         sha256 = os.path.basename(self.srl)
         localpath = self.tempfile(sha256)
+        if self._svc.sample_cache:
+            # Verified once when it entered the cache.
+            return self._svc.sample_cache.fetch(sha256, localpath, self._svc.transport)
+
         self._svc.transport.download(self.srl, localpath)
         if not os.path.exists(localpath):
             raise Exception('Download failed. Not found on local filesystem')
 
+        size = self.task.size
+        if size is not None and os.path.getsize(localpath) != size:
+            raise CorruptedFileStoreException('Size mismatch between SRL and '
+                                              'downloaded file. %s != %s' % (size, os.path.getsize(localpath)))
+
         received_sha256 = digests.get_sha256_for_file(localpath)
         if received_sha256 != sha256:
             raise CorruptedFileStoreException('SHA256 mismatch between SRL and '
@@ -202,6 +219,9 @@ class ServiceRequest(object):
         self.error_text = msg
 
     def get(self):
+        if self._svc.sample_cache:
+            return self._svc.sample_cache.get(self.srl, self._svc.transport)
+
         data = self._svc.transport.get(self.srl)
         received_sha256 = hashlib.sha256(data).hexdigest()
         if received_sha256 != self.srl:
@@ -283,11 +303,14 @@ class ServiceRequestBatch(object):
             try:
                 local_path = os.path.join(download_directory,
                                           os.path.basename(request.srl))
-                self._service.transport.download(request.srl, local_path)
-                received_sha256 = digests.get_sha256_for_file(local_path)
-                if received_sha256 != request.srl:
-                    raise CorruptedFileStoreException('SHA256 mismatch between SRL and '
-                                                      'downloaded file. %s != %s' % (request.srl, received_sha256))
+                if self._service.sample_cache:
+                    self._service.sample_cache.fetch(request.srl, local_path, self._service.transport)
+                else:
+                    self._service.transport.download(request.srl, local_path)
+                    received_sha256 = digests.get_sha256_for_file(local_path)
+                    if received_sha256 != request.srl:
+                        raise CorruptedFileStoreException('SHA256 mismatch between SRL and '
+                                                          'downloaded file. %s != %s' % (request.srl, received_sha256))
                 request.successful = True
                 request.local_path = local_path
             except Exception as ex:  # pylint: disable=W0703
@@ -315,6 +338,8 @@ EXECUTE_FAIL_RECOV = 'svc.execute_fail_recov'
 EXECUTE_FAIL_NONRECOV = 'svc.execute_fail_nonrecov'
 JOB_SCORED = 'svc.job_scored'
 JOB_NOT_SCORED = 'svc.job_not_scored'
+SAMPLE_CACHE_HIT = 'svc.sample_cache_hit'
+SAMPLE_CACHE_MISS = 'svc.sample_cache_miss'
 
 
 class ServiceBase(object):  # pylint:disable=R0922
@@ -364,6 +389,7 @@ class ServiceBase(object):  # pylint:disable=R0922
         self.counters = None
         self.dispatch_queue = None
         self.result_store = None
+        self.sample_cache = None
         self.submit_client = None
         self.transport = None
         self.worker = None
@@ -406,6 +432,8 @@ class ServiceBase(object):  # pylint:disable=R0922
         if not self.counters:
             return Counters()
         current = self.counters.copy()
+        if self.sample_cache:
+            current[SAMPLE_CACHE_HIT], current[SAMPLE_CACHE_MISS] = self.sample_cache.take_counts()
         self.counters = Counters()
         self.counters['name'] = self.SERVICE_NAME
         self.counters['type'] = "service"
@@ -925,7 +953,9 @@ class ServiceBase(object):  # pylint:disable=R0922
         self.counters['name'] = self.SERVICE_NAME
         self.counters['type'] = "service"
         self.counters['host'] = self._ip
+        forge.watch_config_changes()
         self.transport = forge.get_filestore()
+        self.sample_cache = get_sample_cache()
         self.result_store = forge.get_datastore()
         self.submit_client = forge.get_submit_client(self.result_store)
         self.dispatch_queue = forge.get_dispatch_queue()
@@ -1045,7 +1075,10 @@ class BatchServiceBase(ServiceBase):  # pylint:disable=R0921
         for task in tasks:
             try:
                 local_path = os.path.join(dest_dir, os.path.basename(task.srl))
-                self.transport.download(task.srl, local_path)
+                if self.sample_cache:
+                    self.sample_cache.fetch(task.srl, local_path, self.transport)
+                else:
+                    self.transport.download(task.srl, local_path)
                 succeeded[local_path] = task
             except Exception as ex:  # pylint: disable=W0703
                 failed.append((task, ex))
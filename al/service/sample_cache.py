@@ -0,0 +1,249 @@
+""" Node-local, content-addressed cache of the samples services process.
+
+A sample that goes through many services on the same host is only
+downloaded (and its sha256 verified) once. Service workers get a private,
+writable copy of the cached sample in their working directories. The cache is shared by all the
+service worker processes of a host: inserts are serialized per sha256 with
+file locks and the cache is kept under its size budget by evicting the least
+recently used samples.
+
+The cache is off unless services.sample_cache_mb is set.
+
+Walking the cache to size it is only done when the worker's running
+estimate (the size found by its last walk plus what it inserted since) goes
+over budget or the last walk is older than EVICT_INTERVAL, as other workers
+insert too.
+"""
+import errno
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+from assemblyline.al.core.filestore import CorruptedFileStoreException
+from assemblyline.common import digests
+from assemblyline.al.common import forge
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Windows workers don't use the cache.
+
+config = forge.get_config()
+log = logging.getLogger('assemblyline.svc.cache')
+
+DEFAULT_ROOT = os.path.join(tempfile.gettempdir(), 'al', 'sample_cache')
+DEFAULT_SIZE_MB = 0
+EVICT_INTERVAL = 60
+# Evicting down to a fraction of the budget leaves room for a few inserts.
+EVICT_LOW_WATER = 0.9
+
+
+class FileLock(object):
+    def __init__(self, path, blocking=True):
+        self.blocking = blocking
+        self.fh = None
+        self.path = path
+
+    def __enter__(self):
+        self.fh = open(self.path, 'a')
+        flags = fcntl.LOCK_EX
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fh, flags)
+        except IOError as e:
+            self.fh.close()
+            self.fh = None
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        return True
+
+    # noinspection PyUnusedLocal
+    def __exit__(self, ex_type, exc_val, exc_tb):
+        if self.fh:
+            fcntl.flock(self.fh, fcntl.LOCK_UN)
+            self.fh.close()
+            self.fh = None
+
+
+class SampleCache(object):
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock_dir = os.path.join(root, 'locks')
+        self.hits = 0
+        self.misses = 0
+        self.size = None
+        self.last_walk = 0
+        makedirs(self.lock_dir)
+
+    def _path(self, sha256):
+        return os.path.join(self.root, sha256[0], sha256[1], sha256)
+
+    def contains(self, sha256):
+        return os.path.exists(self._path(sha256))
+
+    def fetch(self, sha256, dest_path, transport):
+        """ Puts the sample sha256 at dest_path, downloading it with transport
+        into the cache if needed. Raises CorruptedFileStoreException if the
+        downloaded content doesn't match sha256. """
+        cached = self._path(sha256)
+        if self._handout(cached, dest_path):
+            self.hits += 1
+            return dest_path
+
+        self.misses += 1
+        with self._lock(sha256):
+            # Another worker may have fetched it while we waited for the lock.
+            if not os.path.exists(cached):
+                self._insert(sha256, cached, transport)
+
+            handed_out = self._handout(cached, dest_path)
+
+        self.maybe_evict()
+        if not handed_out:
+            # Only happens if the sample is bigger than the whole cache and
+            # another worker evicted it right away.
+            self._insert(sha256, dest_path, transport, shared=False)
+        return dest_path
+
+    def get(self, sha256, transport):
+        """ Returns the content of the sample sha256. """
+        cached = self._path(sha256)
+        if os.path.exists(cached):
+            self.hits += 1
+            touch(cached)
+            try:
+                with open(cached, 'rb') as fh:
+                    return fh.read()
+            except IOError:
+                pass  # Evicted since.
+
+        self.misses += 1
+        with self._lock(sha256):
+            if not os.path.exists(cached):
+                self._insert(sha256, cached, transport)
+            with open(cached, 'rb') as fh:
+                data = fh.read()
+
+        self.maybe_evict()
+        return data
+
+    def _lock(self, sha256):
+        # Lock files are striped by prefix so there is a bounded number of them.
+        return FileLock(os.path.join(self.lock_dir, sha256[:2]))
+
+    def _insert(self, sha256, cached, transport, shared=True):
+        makedirs(os.path.dirname(cached))
+        partial = '%s.%d.part' % (cached, os.getpid())
+        try:
+            transport.download(sha256, partial)
+            received_sha256 = digests.get_sha256_for_file(partial)
+            if received_sha256 != sha256:
+                raise CorruptedFileStoreException('SHA256 mismatch between SRL and '
+                                                  'downloaded file. %s != %s' % (sha256, received_sha256))
+            if shared:
+                # Guard the cached copy against being modified in place.
+                os.chmod(partial, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            if os.path.exists(cached):
+                os.unlink(cached)
+            os.rename(partial, cached)
+            if shared and self.size is not None:
+                self.size += os.path.getsize(cached)
+        finally:
+            if os.path.exists(partial):
+                os.unlink(partial)
+
+    @staticmethod
+    def _handout(cached, dest_path):
+        # Services may modify their working file so they get their own copy.
+        try:
+            shutil.copyfile(cached, dest_path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        touch(cached)
+        return True
+
+    def take_counts(self):
+        """ Returns and resets the (hits, misses) counts. """
+        counts = self.hits, self.misses
+        self.hits = self.misses = 0
+        return counts
+
+    def maybe_evict(self):
+        if self.size is not None and self.size <= self.max_bytes and \
+                time.time() - self.last_walk < EVICT_INTERVAL:
+            return
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used samples until the cache fits in
+        its size budget. Only one process evicts at a time. """
+        with FileLock(os.path.join(self.lock_dir, '.evict'), blocking=False) as locked:
+            self.last_walk = time.time()
+            if not locked:
+                return
+
+            entries = []
+            total = 0
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                if dirpath == self.root:
+                    dirnames[:] = [d for d in dirnames if d != 'locks']
+                for name in filenames:
+                    if name.endswith('.part'):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    total += st.st_size
+                    entries.append((st.st_mtime, st.st_size, path))
+
+            self.size = total
+            if total <= self.max_bytes:
+                return
+
+            low_water = self.max_bytes * EVICT_LOW_WATER
+            entries.sort()
+            for _, size, path in entries:
+                if total <= low_water:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+
+            self.size = total
+            log.info('Evicted samples from cache. Cache size is now %d bytes.', total)
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def touch(path):
+    # The modification time doubles as the last use time for eviction.
+    try:
+        now = time.time()
+        os.utime(path, (now, now))
+    except OSError:
+        pass
+
+
+def get_sample_cache():
+    size_mb = config.services.get('sample_cache_mb', DEFAULT_SIZE_MB)
+    if not size_mb or not fcntl:
+        return None
+    return SampleCache(config.services.get('sample_cache_dir', DEFAULT_ROOT), size_mb * 1024 * 1024)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.service import sample_cache
+
+
+class MockTransport(object):
+    def __init__(self):
+        self.samples = {}
+        self.downloads = 0
+
+    def add(self, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        self.samples[sha256] = data
+        return sha256
+
+    def download(self, sha256, path):
+        self.downloads += 1
+        with open(path, 'wb') as fh:
+            fh.write(self.samples[sha256])
+
+
+class SampleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = sample_cache.SampleCache(os.path.join(self.directory, 'cache'), max_bytes=1000)
+        self.transport = MockTransport()
+        self.walks = 0
+
+        self.walk = os.walk
+
+        def counting_walk(top, *args, **kwargs):
+            # os.walk recurses through os.walk.
+            if top == self.cache.root:
+                self.walks += 1
+            return self.walk(top, *args, **kwargs)
+
+        os.walk = counting_walk
+
+    def tearDown(self):
+        os.walk = self.walk
+        shutil.rmtree(self.directory)
+
+    def test_fetch_hit_and_miss(self):
+        sha256 = self.transport.add('a' * 100)
+        dest = os.path.join(self.directory, 'first')
+        self.cache.fetch(sha256, dest, self.transport)
+        self.cache.fetch(sha256, os.path.join(self.directory, 'second'), self.transport)
+
+        self.assertEqual(1, self.transport.downloads)
+        self.assertEqual('a' * 100, self.cache.get(sha256, self.transport))
+        self.assertEqual((2, 1), self.cache.take_counts())
+        self.assertEqual((0, 0), self.cache.take_counts())
+
+    def test_services_get_a_writable_copy(self):
+        sha256 = self.transport.add('a' * 100)
+        dest = os.path.join(self.directory, 'sample')
+        self.cache.fetch(sha256, dest, self.transport)
+        with open(dest, 'ab') as fh:
+            fh.write('modified')
+
+        self.assertEqual('a' * 100, self.cache.get(sha256, self.transport))
+
+    def test_off_by_default(self):
+        self.assertEqual(None, sample_cache.get_sample_cache())
+
+    def test_walks_only_over_budget(self):
+        for i in xrange(5):
+            self.cache.get(self.transport.add(chr(ord('a') + i) * 100), self.transport)
+        # The first miss sizes the cache, the next ones fit in the budget.
+        self.assertEqual(1, self.walks)
+        self.assertEqual(500, self.cache.size)
+
+        for i in xrange(5, 12):
+            self.cache.get(self.transport.add(chr(ord('a') + i) * 100), self.transport)
+        self.assertTrue(self.cache.size <= 1000)
+        self.assertEqual(2, self.walks)
+
+    def test_evicts_least_recently_used(self):
+        first = self.transport.add('x' * 600)
+        self.cache.get(first, self.transport)
+        os.utime(self.cache._path(first), (1, 1))
+        second = self.transport.add('y' * 600)
+        self.cache.get(second, self.transport)
+
+        self.assertFalse(self.cache.contains(first))
+        self.assertTrue(self.cache.contains(second))
+        self.assertEqual(600, self.cache.size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,5 @@
+import json
+
 from assemblyline.al.common.transport.local import TransportLocal
 
 
@@ -107,3 +109,86 @@ class MockDispatchCollector(object):
                 self.unsupported.append(response)
         else:
             self.unsupported.append(response)
+
+
+class MockRiakObject(object):
+    """A riak object of a MockRiakBucket."""
+
+    def __init__(self, bucket, key, data=None):
+        self.bucket = bucket
+        self.key = key
+        self.data = data
+
+    @property
+    def exists(self):
+        return self.data is not None
+
+    @property
+    def encoded_data(self):
+        return None if self.data is None else json.dumps(self.data)
+
+    def store(self):
+        self.bucket.items[self.key] = json.loads(json.dumps(self.data))
+
+
+class MockRiakBucket(object):
+    """An in-memory riak bucket.
+
+    Keys in missing are left out of the next missing[key] multigets, as riak
+    does when a node times out."""
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items or {}
+        self.missing = {}
+        self.multigets = []
+
+    def get(self, key):
+        return MockRiakObject(self, key, json.loads(json.dumps(self.items.get(key, None))))
+
+    def multiget(self, keys):
+        self.multigets.append(list(keys))
+        out = []
+        for key in keys:
+            if self.missing.get(key, 0):
+                self.missing[key] -= 1
+                out.append(('mock', self.name, key, Exception('timeout')))
+                continue
+            out.append(self.get(key))
+        return out
+
+    def new(self, key, data, content_type=None):
+        return MockRiakObject(self, key, data)
+
+
+class MockRiakClient(object):
+    """Stores multiput objects except those whose key is in fail."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+
+    def multiput(self, objects, return_body=False):
+        out = []
+        for obj in objects:
+            if obj.key in self.fail:
+                out.append((obj, Exception('timeout')))
+                continue
+            obj.store()
+            out.append(obj)
+        return out
+
+
+RIAK_BUCKETS = ('alert', 'blob', 'emptyresult', 'error', 'file', 'filescore', 'node', 'profile',
+                'result', 'signature', 'submission', 'user', 'workflow')
+
+
+def get_mock_riak_store(client=None, **buckets):
+    """A RiakStore on MockRiakBuckets. Buckets can be given as
+    <property>=MockRiakBucket (files=..., results=...)."""
+    from assemblyline.al.core.datastore import RiakStore
+
+    store = RiakStore.__new__(RiakStore)
+    store.client = client or MockRiakClient()
+    for name in RIAK_BUCKETS:
+        setattr(store, '_%ss' % name, buckets.get(name + 's', None) or MockRiakBucket(name))
+    return store
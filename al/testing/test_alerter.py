@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.core import alerter
+
+
+class RecordingDelayQueue(object):
+
+    def __init__(self):
+        self.pushed = []
+
+    def push(self, delay, *messages):
+        self.pushed.append((delay, [m['id'] for m in messages]))
+
+
+class CreateAlertsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.created = []
+        self.failing = {}
+        self.saved = (alerter.create_alert, alerter.get_datastore, alerter.retryq)
+        alerter.create_alert = self.create_alert
+        alerter.get_datastore = lambda: None
+        alerter.retryq = RecordingDelayQueue()
+
+    def tearDown(self):
+        alerter.create_alert, alerter.get_datastore, alerter.retryq = self.saved
+
+    def create_alert(self, counts, store, logger, message):
+        if message['id'] in self.failing:
+            raise self.failing[message['id']]
+        self.created.append(message['id'])
+
+    def test_the_rest_of_the_group_waits_behind_a_failure(self):
+        self.failing['b'] = alerter.alerting.AlertNotReadyException('not ready')
+        messages = [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}]
+        outcomes = alerter.create_alerts(messages)
+
+        self.assertEqual(['a'], self.created)
+        self.assertEqual([None, self.failing['b']], outcomes)
+        self.assertEqual([(1, ['b', 'c'])], alerter.retryq.pushed)
+        self.assertEqual(1, messages[1]['retries'])
+
+    def test_retry_backoff(self):
+        self.failing['a'] = ValueError('Submission not finalized')
+        alerter.create_alerts([{'id': 'a', 'retries': 3}])
+        alerter.create_alerts([{'id': 'a', 'retries': alerter.max_retries - 1}])
+        self.assertEqual([(8, ['a']), (min(2 ** (alerter.max_retries - 1), alerter.max_retry_delay), ['a'])],
+                         alerter.retryq.pushed)
+
+    def test_out_of_retries(self):
+        self.failing['a'] = ValueError('broken')
+        outcomes = alerter.create_alerts([{'id': 'a', 'retries': alerter.max_retries}, {'id': 'b'}])
+
+        # The message is dropped, the rest of the group goes on.
+        self.assertEqual([], alerter.retryq.pushed)
+        self.assertEqual(['b'], self.created)
+        self.assertEqual(None, outcomes[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.common import backupmanager
+from assemblyline.al.testing import mocks
+
+
+class ChunkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, items, compress=False, chunk_size=3):
+        writer = backupmanager.ChunkWriter(self.directory, 'test', compress, chunk_size)
+        for bucket_name, key, data in items:
+            writer.write(bucket_name, key, data)
+        return backupmanager.write_manifest(self.directory, writer.close(), compress)
+
+    def test_chunks_and_manifest(self):
+        items = [('user', 'u%d' % i, {'i': i}) for i in xrange(7)] + [('node', 'n0', {'i': 0})]
+        for compress in (False, True):
+            manifest = self.write(items, compress)
+            self.assertEqual({'user': 7, 'node': 1}, manifest['buckets'])
+            self.assertEqual([3, 3, 1], [c['count'] for c in manifest['chunks'] if c['bucket'] == 'user'])
+
+            read = []
+            for chunk in manifest['chunks']:
+                self.assertEqual(compress, chunk['name'].endswith('.gz'))
+                read.extend(tuple(i) for i in backupmanager.read_chunk(os.path.join(self.directory, chunk['name'])))
+            self.assertEqual(sorted(items), sorted(read))
+            self.assertFalse([n for n in os.listdir(self.directory) if n.endswith('.tmp')])
+
+    def test_pending_chunks_resume(self):
+        manifest = self.write([('user', 'u%d' % i, {}) for i in xrange(6)] + [('node', 'n0', {})])
+        names = [c['name'] for c in manifest['chunks']]
+
+        backupmanager.mark_restored(self.directory, names[0])
+        pending = backupmanager.pending_chunks(self.directory)
+        self.assertEqual(names[1:], [c['name'] for c in pending])
+        self.assertEqual(['user'], list(set(c['bucket'] for c in
+                                            backupmanager.pending_chunks(self.directory, ['user']))))
+        self.assertEqual(names, [c['name'] for c in backupmanager.pending_chunks(self.directory, restart=True)])
+
+    def test_restore_chunk_failures(self):
+        manifest = self.write([('user', 'u%d' % i, {'i': i}) for i in xrange(3)])
+        path = os.path.join(self.directory, manifest['chunks'][0]['name'])
+        users = mocks.MockRiakBucket('user')
+        client = mocks.MockRiakClient(fail=['u1'])
+        ds = mocks.get_mock_riak_store(client, users=users)
+
+        flushed = set()
+        self.assertEqual(1, backupmanager.restore_chunk(ds, path, flushed=flushed))
+        self.assertEqual(['u0', 'u2'], sorted(users.items.keys()))
+
+        # Items flushed by a previous attempt are skipped.
+        client.fail = set()
+        self.assertEqual(0, backupmanager.restore_chunk(ds, path, flushed=flushed))
+        self.assertEqual(['u0', 'u2'], sorted(users.items.keys()))
+        self.assertEqual(0, backupmanager.restore_chunk(ds, path))
+        self.assertEqual(['u0', 'u1', 'u2'], sorted(users.items.keys()))
+
+    def test_failed_chunks_are_not_marked_restored(self):
+        manifest = self.write([('user', 'u%d' % i, {'i': i}) for i in xrange(6)])
+        client = mocks.MockRiakClient(fail=['u4'])
+        backup = backupmanager.SystemBackup.__new__(backupmanager.SystemBackup)
+        backup.backup_path = self.directory
+        backup.ds = mocks.get_mock_riak_store(client)
+        backup.VALID_BUCKETS = ['user']
+
+        backup.restore(['user'])
+        pending = backupmanager.pending_chunks(self.directory)
+        self.assertEqual([manifest['chunks'][1]['name']], [c['name'] for c in pending])
+
+        client.fail = set()
+        backup.restore(['user'])
+        self.assertEqual([], backupmanager.pending_chunks(self.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import time
+import unittest
+
+from collections import Counter
+
+from assemblyline.common.caching import StripedLRUCache
+
+
+class StripedLRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stats = Counter()
+        self.cache = StripedLRUCache(3, 60, stripes=1, stats=lambda name: self.stats.update([name]))
+
+    def test_least_recently_used_is_evicted(self):
+        for key in 'abc':
+            self.cache.add(key, key.upper())
+        self.assertEqual('A', self.cache.get('a'))
+        self.cache.add('d', 'D')
+
+        self.assertEqual(None, self.cache.get('b'))
+        self.assertEqual('default', self.cache.get('b', 'default'))
+        self.assertEqual(['c', 'a', 'd'], self.cache.keys())
+        self.assertEqual(3, len(self.cache))
+        self.assertEqual(1, self.stats['evicted'])
+
+    def test_re_adding_replaces(self):
+        self.cache.add('a', 1)
+        self.cache.add('a', 2)
+        self.assertEqual(2, self.cache.get('a'))
+        self.assertEqual(1, len(self.cache))
+
+    def test_expiry(self):
+        self.cache.add('past', 1, expire_at=time.time() - 1)
+        self.assertEqual(0, len(self.cache))
+
+        self.cache.add('soon', 1, expire_at=time.time() + 0.05)
+        self.assertEqual((1, False), self.cache.lookup('soon'))
+        time.sleep(0.1)
+        self.assertEqual((None, False), self.cache.lookup('soon'))
+        self.assertEqual(1, self.stats['expired'])
+        self.assertEqual(0, len(self.cache))
+
+    def test_stale(self):
+        self.cache.add('a', 1, stale_at=time.time() - 1)
+        self.assertEqual((1, True), self.cache.lookup('a'))
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual(2, self.stats['stale'])
+
+    def test_stats(self):
+        self.cache.add('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+        self.assertEqual(1, self.stats['hit'])
+        self.assertEqual(1, self.stats['miss'])
+
+    def test_pop(self):
+        self.cache.add('a', 1)
+        self.assertEqual(1, self.cache.pop('a'))
+        self.assertEqual(None, self.cache.pop('a'))
+        self.assertEqual(0, len(self.cache))
+
+    def test_stripes_share_the_size(self):
+        cache = StripedLRUCache(16, 60, stripes=4)
+        self.assertEqual(4, cache.stripe_size)
+        for i in xrange(100):
+            cache.add(i, i)
+        self.assertLessEqual(len(cache), 16)
+        self.assertEqual(range(96, 100), [k for k in range(96, 100) if cache.get(k) == k])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import time
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.common.isotime import iso_to_epoch
+from assemblyline.al.common import forge
+from assemblyline.al.core.datastore import DataStoreException, RiakStore
+from assemblyline.al.testing import mocks
+
+EXPIRY = '2030-01-01T00:00:00.000000Z'
+
+
+class FreshenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c12n = forge.get_config().core.middleman.classification
+        self.files = mocks.MockRiakBucket('file')
+        self.client = mocks.MockRiakClient()
+        self.store = mocks.get_mock_riak_store(self.client, files=self.files)
+
+    def test_freshen_files(self):
+        self.store.save_or_freshen_file('a', {'sha256': 'a'}, '2020-01-01T00:00:00.000000Z', self.c12n)
+        failed = self.store.save_or_freshen_files([
+            ('a', {'sha256': 'a'}, EXPIRY, self.c12n),
+            ('b', {'sha256': 'b'}, EXPIRY, self.c12n),
+            ('b', {'sha256': 'b'}, '2020-01-01T00:00:00.000000Z', self.c12n),
+        ])
+
+        self.assertEqual([], failed)
+        self.assertEqual(1, len(self.files.multigets))
+        self.assertEqual(2, self.files.items['a']['seen_count'])
+        self.assertEqual(2, self.files.items['b']['seen_count'])
+        self.assertEqual(iso_to_epoch(EXPIRY), iso_to_epoch(self.files.items['a']['__expiry_ts__']))
+        self.assertEqual(iso_to_epoch(EXPIRY), iso_to_epoch(self.files.items['b']['__expiry_ts__']))
+
+    def test_failed_freshens_are_returned(self):
+        self.client.fail.add('b')
+        failed = self.store.save_or_freshen_files([
+            ('a', {'sha256': 'a'}, EXPIRY, self.c12n),
+            ('b', {'sha256': 'b'}, EXPIRY, self.c12n),
+        ])
+        self.assertEqual(['b'], failed)
+        self.assertEqual(['a'], self.files.items.keys())
+
+
+class FilescoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.filescores = mocks.MockRiakBucket('filescore')
+        self.client = mocks.MockRiakClient()
+        self.store = mocks.get_mock_riak_store(self.client, filescores=self.filescores)
+
+    def test_older_filescores_are_skipped(self):
+        self.filescores.items['a'] = {'score': 1, '__expiry_ts__': EXPIRY}
+        failed = self.store.save_filescores({
+            'a': ('2020-01-01T00:00:00.000000Z', {'score': 2}),
+            'b': (EXPIRY, {'score': 3}),
+        })
+        self.assertEqual([], failed)
+        self.assertEqual(1, self.filescores.items['a']['score'])
+        self.assertEqual(3, self.filescores.items['b']['score'])
+
+    def test_failed_filescores_are_returned(self):
+        self.client.fail.add('b')
+        failed = self.store.save_filescores({
+            'a': (EXPIRY, {'score': 2}),
+            'b': (EXPIRY, {'score': 3}),
+        })
+        self.assertEqual(['b'], failed)
+
+
+class MockSearch(object):
+    """direct_search over keys, paged by cursorMark. Supports the key range
+    filter queries of STREAM_KEY_PARTITIONS."""
+
+    def __init__(self, keys, fail_after=None):
+        self.keys = sorted(keys)
+        self.fail_after = fail_after
+        self.calls = 0
+
+    @staticmethod
+    def in_range(key, fq):
+        low, high = fq[len('_yz_rk:['):-1].split(' TO ')
+        return (low == '*' or key >= low) and (high == '*' or key < high)
+
+    def __call__(self, bucket, query, args=(), df="text", __access_control__=None):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise DataStoreException('search failed')
+        args = dict(args)
+        rows, cursor = int(args['rows']), args['cursorMark']
+        keys = [k for k in self.keys if 'fq' not in args or self.in_range(k, args['fq'])]
+        start = 0 if cursor == '*' else int(cursor)
+        docs = [{'_yz_rk': k} for k in keys[start:start + rows]]
+        return {'response': {'docs': docs}, 'nextCursorMark': str(start + len(docs))}
+
+
+class StreamSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = ['%04x' % i for i in xrange(0, 65536, 37)]
+        self.store = mocks.get_mock_riak_store()
+
+    def stream(self, search, **kwargs):
+        self.store.direct_search = search
+        return self.store.stream_search('result', 'query', fl='_yz_rk', item_buffer_size=50, **kwargs)
+
+    def test_stream(self):
+        found = [x['_yz_rk'] for x in self.stream(MockSearch(self.keys))]
+        self.assertEqual(self.keys, found)
+
+    def test_partitions(self):
+        search = MockSearch(self.keys)
+        found = [x['_yz_rk'] for x in self.stream(search, partitions=self.store.STREAM_KEY_PARTITIONS)]
+        self.assertEqual(self.keys, sorted(found))
+
+    def test_errors_are_raised(self):
+        results = self.stream(MockSearch(self.keys, fail_after=2))
+        self.assertRaises(DataStoreException, list, results)
+
+    def test_close_stops_fetching(self):
+        search = MockSearch(self.keys)
+        results = self.stream(search, prefetch=1)
+        results.next()
+        results.close()
+        time.sleep(0.5)
+        calls = search.calls
+        time.sleep(0.5)
+        self.assertEqual(calls, search.calls)
+        self.assertTrue(calls < len(self.keys) / 50)
+
+
+def srl(name):
+    return name * 64
+
+
+def extracting(name, score, *children):
+    return {
+        'response': {'extracted': [[c, srl(c), 'extracted'] for c in children]},
+        'result': {'score': score},
+    }
+
+
+class MultigetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = mocks.MockRiakBucket('user', {k: {'name': k} for k in 'abcdefg'})
+        self.store = mocks.get_mock_riak_store(users=self.users)
+
+    def tearDown(self):
+        RiakStore.MULTIGET_CHUNK_SIZE = 1000
+        RiakStore.ALLOW_MULTIGET = True
+
+    def test_only_missing_keys_are_retried(self):
+        self.users.missing = {'b': 2, 'c': 1}
+        found = self.store._multiget(self.users, ['a', 'b', 'c', 'unknown'])
+
+        self.assertEqual({k: {'name': k} for k in 'abc'}, found)
+        self.assertEqual([['a', 'b', 'c', 'unknown'], ['b', 'c'], ['b']],
+                         [sorted(keys) for keys in self.users.multigets])
+
+    def test_too_many_retries(self):
+        self.users.missing = {'b': RiakStore.MAX_RETRY}
+        self.assertRaises(DataStoreException, self.store._multiget, self.users, ['a', 'b'])
+        self.assertEqual(RiakStore.MAX_RETRY, len(self.users.multigets))
+
+    def test_chunks(self):
+        RiakStore.MULTIGET_CHUNK_SIZE = 2
+        self.users.missing = {'e': 1}
+        keys = list('abcdefg') + ['a', 'unknown']
+
+        self.assertEqual({k: {'name': k} for k in 'abcdefg'}, self.store._get_bucket_items_dict(self.users, keys))
+        self.assertTrue(all(len(m) <= 2 for m in self.users.multigets))
+
+        # Keys asked for twice are returned twice.
+        found = self.store._get_bucket_items(self.users, ['a', 'b', 'a'])
+        self.assertEqual(['a', 'a', 'b'], sorted(u['name'] for u in found))
+
+    def test_stream_leaves_out_missing_keys(self):
+        for allow in (True, False):
+            RiakStore.ALLOW_MULTIGET = allow
+            found = {}
+            for items in self.store._stream_bucket_items(self.users, ['a', 'b', 'unknown']):
+                found.update(items)
+            self.assertEqual({'a': {'name': 'a'}, 'b': {'name': 'b'}}, found)
+
+    def test_tag_list(self):
+        results = mocks.MockRiakBucket('result', {
+            'r1': {'result': {'tags': [{'type': 'T', 'value': '1'}]}},
+            'r2': {'result': {'tags': [{'type': 'T', 'value': '2'}]}},
+        })
+        store = mocks.get_mock_riak_store(results=results)
+        tags = store.get_tag_list_from_keys(['r1', 'r2', 'r3.e'])
+        self.assertEqual([('r1', '1'), ('r2', '2')], sorted((t['key'], t['value']) for t in tags))
+
+
+class FileTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        RiakStore.FILE_TREE_NODES = None
+        self.results = mocks.MockRiakBucket('result', {
+            srl('r') + '.svc': extracting('r', 1, 'a', 'b'),
+            srl('a') + '.svc': extracting('a', 10, 'c'),
+            srl('b') + '.svc': extracting('b', 100, 'a', 'c'),
+            srl('c') + '.svc': extracting('c', 1000),
+        })
+        self.store = mocks.get_mock_riak_store(results=self.results)
+
+    def tearDown(self):
+        RiakStore.FILE_TREE_NODES = None
+
+    def submission(self, sid):
+        return {
+            'submission': {'sid': sid, 'max_score': 1000},
+            'files': [('root', srl('r'))],
+            'results': sorted(self.results.items),
+            '__expiry_ts__': EXPIRY,
+        }
+
+    def test_tree(self):
+        tree = self.store.create_file_tree(self.submission('s1'))
+        root = tree[srl('r')]
+        self.assertEqual(1, root['score'])
+        self.assertEqual(set([srl('a'), srl('b')]), set(root['children']))
+
+        # b's copy of a is cut short since a is a direct child of the root
+        # that came before it, c is repeated under every file it was
+        # extracted from.
+        b = root['children'][srl('b')]
+        self.assertTrue(b['truncated'])
+        self.assertEqual([srl('c')], b['children'].keys())
+        self.assertEqual(1000, b['children'][srl('c')]['score'])
+        self.assertEqual([srl('c')], root['children'][srl('a')]['children'].keys())
+
+        # One multiget per depth level.
+        self.assertEqual(3, len(self.results.multigets))
+
+    def test_nodes_are_shared_between_submissions(self):
+        first = self.store.create_file_tree(self.submission('s1'))
+        second = self.store.create_file_tree(self.submission('s2'))
+        self.assertEqual(first, second)
+        self.assertEqual(3, len(self.results.multigets))
+
+    def test_incomplete_nodes_are_not_cached(self):
+        # c's result isn't written yet.
+        submission = self.submission('s1')
+        c = self.results.items.pop(srl('c') + '.svc')
+        tree = self.store.create_file_tree(submission)
+        self.assertEqual(0, tree[srl('r')]['children'][srl('a')]['children'][srl('c')]['score'])
+        self.results.items[srl('c') + '.svc'] = c
+        self.results.multigets = []
+        self.store.create_file_tree(self.submission('s2'))
+        self.assertEqual([[srl('c') + '.svc']], self.results.multigets)
+
+
+if __name__ == '__main__':
+    unittest.main()
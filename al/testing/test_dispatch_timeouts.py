@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.core.dispatch import Timeouts
+
+
+class TimeoutsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.timeouts = Timeouts()
+
+    def expired(self, now):
+        return [(t.sid, t.srl, t.data, seconds) for t, seconds in self.timeouts.expired(now)]
+
+    def test_expired_in_deadline_order(self):
+        self.timeouts.add('s1', 'a', 'svc', 30, 0)
+        self.timeouts.add('s1', 'b', 'svc', 10, 0)
+        self.timeouts.add('s2', 'a', 'svc', 20, 0)
+
+        self.assertEqual([('s1', 'b', 'svc', 10), ('s2', 'a', 'svc', 20)], self.expired(25))
+        self.assertEqual(1, len(self.timeouts))
+        self.assertFalse(self.timeouts.has_sid('s2'))
+        self.assertEqual([('s1', 'a', 'svc', 30)], self.expired(31))
+        self.assertEqual(0, len(self.timeouts))
+        self.assertFalse(self.timeouts.has_sid('s1'))
+
+    def test_replace(self):
+        self.timeouts.add('s1', 'a', 'svc', 10, 0)
+        self.timeouts.add('s1', 'a', 'svc', 60, 5)
+
+        self.assertEqual(1, len(self.timeouts))
+        self.assertEqual([], self.expired(30))
+        self.assertEqual([('s1', 'a', 'svc', 60)], self.expired(70))
+
+    def test_cancel(self):
+        self.timeouts.add('s1', 'a', 'svc', 10, 0)
+        self.timeouts.add('s1', 'b', 'svc', 10, 0)
+        self.timeouts.cancel('s1', 'a', 'svc')
+        self.timeouts.cancel('s1', 'missing', 'svc')
+
+        self.assertFalse(self.timeouts.contains('s1', 'a', 'svc'))
+        self.assertTrue(self.timeouts.contains('s1', 'b', 'svc'))
+        self.assertEqual([('s1', 'b', 'svc', 10)], self.expired(20))
+
+    def test_cancel_sid(self):
+        self.timeouts.add('s1', 'a', 'svc', 10, 0)
+        self.timeouts.add('s1', 'a', 'other', 10, 0)
+        self.timeouts.add('s2', 'a', 'svc', 10, 0)
+        self.timeouts.cancel_sid('s1')
+
+        self.assertFalse(self.timeouts.has_sid('s1'))
+        self.assertEqual([('s2', 'a', 'svc', 10)], self.expired(20))
+
+    def test_compaction(self):
+        for i in xrange(2048):
+            self.timeouts.add('s1', str(i), 'svc', 10, 0)
+        for i in xrange(2000):
+            self.timeouts.cancel('s1', str(i), 'svc')
+
+        self.assertEqual(48, len(self.timeouts))
+        self.assertLess(len(self.timeouts.heap), 1024)
+        self.assertEqual(48, len(self.expired(20)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+import riak
+
+from assemblyline.al.common.queue import LocalQueue
+from assemblyline.al.core import dispatch
+from assemblyline.al.core.datastore import DataStoreBase
+
+
+class MockFinalizeStore(DataStoreBase):
+    """Submissions kept in a dict. Saving the sids in fail raises a RiakError."""
+
+    def __init__(self, submissions, fail=()):
+        self.submissions = submissions
+        self.fail = set(fail)
+        self.saved = []
+
+    def get_submissions_dict(self, key_list):
+        return {k: self.submissions[k] for k in key_list if k in self.submissions}
+
+    def save_submission(self, sid, submission):
+        if sid in self.fail:
+            raise riak.RiakError('insufficient_vnodes')
+        self.saved.append(sid)
+        self.submissions[sid] = submission
+
+
+def submission(sid):
+    return {
+        'classification': 'UNRESTRICTED',
+        'state': 'submitted',
+        'submission': {'sid': sid},
+        'times': {'submitted': '2017-01-01T00:00:00.000000Z'},
+    }
+
+
+def finalize_msg(sid):
+    return {
+        'type': 'finalize', 'sid': sid, 'classification': 'RESTRICTED',
+        'errors': [], 'results': [sid + '.result'], 'score': 10,
+        'completed_queue': None, 'watchers': {}, 'raw': {},
+    }
+
+
+class FinalizeTest(unittest.TestCase):
+
+    def test_failed_sids_are_returned(self):
+        store = MockFinalizeStore({'a': submission('a'), 'b': submission('b')}, fail=['b'])
+        failed = store.finalize_submissions([
+            ('a', 'RESTRICTED', [], [], 0),
+            ('b', 'RESTRICTED', [], [], 0),
+        ])
+        self.assertEqual(['b'], failed)
+        self.assertEqual(['a'], store.saved)
+
+    def test_finalize_is_idempotent(self):
+        store = MockFinalizeStore({'a': submission('a')})
+        store.finalize_submissions([('a', 'RESTRICTED', [], [], 0)])
+        first = dict(store.submissions['a']['times'])
+        store.finalize_submissions([('a', 'RESTRICTED', [], [], 0)])
+
+        finalized = store.submissions['a']
+        self.assertEqual('UNRESTRICTED', finalized['original_classification'])
+        self.assertEqual('RESTRICTED', finalized['classification'])
+        self.assertEqual('completed', finalized['state'])
+        self.assertEqual(first['completed'], finalized['times']['completed'])
+
+
+class WriteGroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = dispatch.Dispatcher.__new__(dispatch.Dispatcher)
+        self.dispatcher.storage_queue = LocalQueue()
+
+    def requeued(self):
+        return self.dispatcher.storage_queue.pop_many(100, timeout=0.01)
+
+    def test_only_failed_finalizations_are_requeued(self):
+        store = MockFinalizeStore({'a': submission('a'), 'b': submission('b')}, fail=['b'])
+        msgs = [finalize_msg('a'), finalize_msg('b')]
+        self.dispatcher.write_group(msgs, self.dispatcher.write_finalized, store)
+
+        requeued = self.requeued()
+        self.assertEqual(['b'], [m['sid'] for m in requeued])
+        self.assertEqual(1, requeued[0]['retries'])
+        self.assertEqual(['a'], store.saved)
+
+    def test_other_errors_fall_back_to_single_writes(self):
+        def write(_, msgs):
+            if len(msgs) > 1:
+                raise ValueError('batch failed')
+            if msgs[0]['sid'] == 'bad':
+                raise ValueError('bad message')
+            if msgs[0]['sid'] == 'busy':
+                raise riak.RiakError('timeout')
+            written.extend(msgs)
+            return []
+
+        written = []
+        msgs = [{'sid': 'a'}, {'sid': 'bad'}, {'sid': 'busy'}, {'sid': 'b'}]
+        self.dispatcher.write_group(msgs, write, None)
+
+        self.assertEqual(['a', 'b'], [m['sid'] for m in written])
+        self.assertEqual(['busy'], [m['sid'] for m in self.requeued()])
+
+    def test_max_retries(self):
+        def write(_, msgs):
+            return msgs
+
+        msg = {'type': 'complete', 'retries': 5}
+        self.dispatcher.write_group([msg], write, None)
+        self.assertEqual([], self.requeued())
+
+    def test_failed_filescores_are_requeued(self):
+        class Store(object):
+            @staticmethod
+            def save_filescores(filescores):
+                return [k for k in filescores if k == 'busy']
+
+        msgs = [{
+            'type': 'complete', 'filescore_key': key, 'expiry': '2017-01-01T00:00:00.000000Z',
+            'psid': None, 'sid': key, 'score': 0, 'now': 0,
+        } for key in ('a', 'busy')]
+        self.dispatcher.write_group(msgs, self.dispatcher.write_filescores, Store())
+        self.assertEqual(['busy'], [m['filescore_key'] for m in self.requeued()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.core.filestore import FileStore
+
+
+class DeleteManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+
+    def tearDown(self):
+        for directory in [self.source] + self.directories:
+            shutil.rmtree(directory)
+
+    def create(self, concurrent):
+        fs = FileStore(*['file://' + d for d in self.directories], concurrent=concurrent)
+        for name in ('a', 'b', 'c'):
+            src = os.path.join(self.source, name)
+            with open(src, 'wb') as f:
+                f.write(name)
+            fs.put(src, name)
+        return fs
+
+    @staticmethod
+    def failing(*names):
+        return lambda paths: [(p, 'denied') for p in paths if p in names]
+
+    def test_failures_are_counted_once_per_path(self):
+        for concurrent in (False, True):
+            fs = self.create(concurrent)
+            # Both transports fail to delete 'b', only the first fails on 'c'.
+            fs.transports[0].delete_many = self.failing('b', 'c')
+            fs.transports[1].delete_many = self.failing('b')
+
+            self.assertEqual(set(['b', 'c']), fs.delete_many(['a', 'b', 'c']))
+            fs.close()
+
+    def test_transport_errors_fail_every_path(self):
+        fs = self.create(False)
+
+        def broken(_):
+            raise IOError('gone')
+
+        fs.transports[1].delete_many = broken
+        self.assertEqual(set(['a', 'b']), fs.delete_many(['a', 'b']))
+        self.assertFalse(fs.exists('a', location='near'))
+
+    def test_delete_many(self):
+        fs = self.create(False)
+        self.assertEqual(set(), fs.delete_many(['a', 'b', 'missing']))
+        self.assertFalse(fs.exists('a'))
+        self.assertTrue(fs.exists('c'))
+
+
+class ConcurrentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directories = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+        self.fs = FileStore(*['file://' + d for d in self.directories],
+                            concurrent=True, hedge_after=0.01, timeout=5, max_pending=2)
+        for directory in self.directories:
+            with open(os.path.join(directory, 'a'), 'wb') as f:
+                f.write('a')
+        self.release = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.fs.close()
+        for directory in self.directories:
+            shutil.rmtree(directory)
+
+    def stall(self, t):
+        exists = t.exists
+
+        def stalled(path):
+            self.release.wait()
+            return exists(path)
+
+        t.exists = stalled
+
+    def test_a_stalled_transport_does_not_hold_up_the_others(self):
+        self.stall(self.fs.transports[0])
+
+        start = time.time()
+        for _ in xrange(10):
+            self.assertEqual('a', self.fs.get('a'))
+        self.assertLess(time.time() - start, 2)
+
+        # Only max_pending calls wait on the stalled transport, the rest failed right away.
+        self.assertEqual(2, self.fs.pending[0])
+        self.assertEqual(8, self.fs.stats[0].as_dict()['get.errors'])
+
+    def test_put_looks_the_file_up_once(self):
+        calls = []
+        for t in self.fs.transports:
+            t.exists = lambda path, exists=t.exists: calls.append(path) or exists(path)
+
+        src = os.path.join(self.directories[0], 'a')
+        self.assertEqual(set(self.fs.transports), set(self.fs.put(src, 'b')))
+        # Once before the upload and once by the transport itself after it.
+        self.assertEqual(4, len(calls))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.run import journalist
+
+
+class GroupByDayTest(unittest.TestCase):
+
+    def test_malformed_messages_are_skipped(self):
+        days = journalist.group_by_day([
+            'a\t2017-01-01T10:00:00.000000Z',
+            'no tab',
+            None,
+            'b\t2017-01-02T10:00:00.000000Z',
+            'c\t2017-01-01T11:00:00.000000Z',
+            'd\te\tf',
+        ])
+        self.assertEqual({'2017-01-01': ['a', 'c'], '2017-01-02': ['b']}, days)
+
+
+if __name__ == '__main__':
+    unittest.main()
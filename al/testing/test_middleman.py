@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import sys
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.testing import mocks
+
+# Middleman parses its command line on import.
+argv, sys.argv = sys.argv, sys.argv[:1]
+try:
+    from assemblyline.al.core import middleman
+finally:
+    sys.argv = argv
+
+class DropQueue(object):
+    """Hands out one batch, then stops middleman on the next pop."""
+
+    def __init__(self, raws):
+        self.raws = raws
+        self.pushed = []
+        self.running_on_push = []
+
+    def pop(self, timeout=None):
+        if self.raws:
+            return self.raws.pop(0)
+        middleman.running = False
+        return None
+
+    def pop_many(self, num):
+        raws, self.raws = self.raws[:num], self.raws[num:]
+        return raws
+
+    def push_many(self, raws):
+        self.running_on_push.append(middleman.running)
+        self.pushed.extend(raws)
+
+
+class BrokenStore(object):
+
+    def save_or_freshen_files(self, files):
+        raise ValueError('riak is down')
+
+    def close(self):
+        pass
+
+
+class DropperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.files = mocks.MockRiakBucket('file')
+        self.client = mocks.MockRiakClient()
+        self.store = mocks.get_mock_riak_store(self.client, files=self.files)
+        self.saved = (middleman.dropq, middleman.forge.get_datastore, middleman.time.sleep)
+        middleman.time.sleep = lambda _: None
+
+    def tearDown(self):
+        middleman.dropq, middleman.forge.get_datastore, middleman.time.sleep = self.saved
+        middleman.running = True
+
+    def test_failed_notices_are_returned(self):
+        self.client.fail.add('b' * 64)
+        raws = [{'sha256': 'a' * 64}, {'sha256': 'b' * 64}]
+        retry = middleman.freshen_dropped(self.store, raws)
+
+        self.assertEqual([{'sha256': 'b' * 64}], retry)
+        self.assertEqual(['a' * 64], self.files.items.keys())
+
+    def test_batch_is_requeued_when_freshening_raises(self):
+        raws = [{'sha256': 'a' * 64}, {'sha256': 'b' * 64}]
+        middleman.dropq = DropQueue(list(raws))
+        middleman.forge.get_datastore = BrokenStore
+        middleman.running = True
+        middleman.dropper()
+
+        self.assertEqual(raws, middleman.dropq.pushed)
+        self.assertEqual([True], middleman.dropq.running_on_push)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import json
+import os
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.common import queue
+
+MESSAGE = {u'sid': u'abc', u'priority': 10, u'tags': [u'x', u'y'], u'request': {u'srl': u'0' * 64}}
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_json(self):
+        data = queue.Codec('json').dumps(MESSAGE)
+        self.assertEqual(MESSAGE, json.loads(data))
+        self.assertEqual(MESSAGE, queue.loads(data))
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, queue.Codec, 'pickle')
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, queue.loads, queue.CODEC_MAGIC + '\x7f' + 'body')
+        self.assertEqual(None, queue.decode(queue.CODEC_MAGIC + '\x7f' + 'body'))
+
+
+@unittest.skipIf(queue.msgpack is None, 'msgpack is not installed')
+class MsgpackCodecTest(unittest.TestCase):
+
+    def test_msgpack(self):
+        data = queue.Codec('msgpack').dumps(MESSAGE)
+        self.assertEqual(queue.CODEC_MAGIC + queue.FORMAT_MSGPACK, data[:2])
+        self.assertEqual(MESSAGE, queue.loads(data))
+
+    def test_strings_are_unicode(self):
+        decoded = queue.loads(queue.Codec('msgpack').dumps({'sid': 'abc'}))
+        self.assertIsInstance(decoded.keys()[0], unicode)
+        self.assertIsInstance(decoded['sid'], unicode)
+
+    def test_compression_threshold(self):
+        codec = queue.Codec('msgpack', compress_threshold=100)
+        small = codec.dumps({u'sid': u'abc'})
+        large = codec.dumps(MESSAGE)
+        self.assertEqual(queue.FORMAT_MSGPACK, small[1])
+        self.assertEqual(queue.FORMAT_MSGPACK_ZLIB, large[1])
+        self.assertEqual(MESSAGE, queue.loads(large))
+
+    def test_readers_accept_both_formats(self):
+        for name in ('json', 'msgpack'):
+            self.assertEqual(MESSAGE, queue.loads(queue.Codec(name).dumps(MESSAGE)))
+
+
+class StripNoneTest(unittest.TestCase):
+
+    def test_strip_none(self):
+        message = {
+            'state': None,
+            'submission': {'sid': 'abc', 'psid': None, 'metadata': {'a': None}},
+            'request': {'srl': 'x', 'path': None, 'custom': None},
+            'result': {'score': None},
+            'errors': [None],
+        }
+        self.assertEqual({
+            'submission': {'sid': 'abc', 'metadata': {'a': None}},
+            'request': {'srl': 'x', 'custom': None},
+            'result': {'score': None},
+            'errors': [None],
+        }, queue.strip_none(message))
+        # The message itself is left alone.
+        self.assertIn('state', message)
+        self.assertIn('path', message['request'])
+
+    def test_other_messages_keep_their_none_values(self):
+        message = {'sid': None, 'data': {'path': None}, 'request': None}
+        self.assertEqual({'sid': None, 'data': {'path': None}}, queue.strip_none(message))
+
+    def test_not_a_dict(self):
+        self.assertEqual(['a', None], queue.strip_none(['a', None]))
+        self.assertEqual(None, queue.strip_none(None))
+
+
+class DelayQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = queue.DelayQueue('test-delay-queue')
+        try:
+            self.queue.c.ping()
+        except queue.redis.ConnectionError:
+            self.skipTest('redis is not available')
+        self.queue.delete()
+
+    def tearDown(self):
+        self.queue.delete()
+
+    def test_messages_wait_for_their_delay(self):
+        self.queue.push(60, {'id': 'later'})
+        self.queue.push(0, {'id': 'a'}, {'id': 'b'})
+        self.assertEqual(3, self.queue.length())
+        self.assertEqual([{'id': 'a'}, {'id': 'b'}], self.queue.pop_ready(10))
+        self.assertEqual([], self.queue.pop_ready(10))
+        self.assertEqual(1, self.queue.length())
+
+    def test_order_is_kept(self):
+        # Messages due at the same time come out in the order they were pushed.
+        messages = [{'id': i, 'data': 'x' * (i % 3)} for i in xrange(queue.push_batch_size + 10)]
+        self.queue.push(0, *messages)
+        self.assertEqual(messages[:5], self.queue.pop_ready(5))
+        self.assertEqual(messages[5:], self.queue.pop_ready(len(messages)))
+
+    def test_same_message_twice(self):
+        self.queue.push(0, {'id': 'a'}, {'id': 'a'})
+        self.assertEqual([{'id': 'a'}, {'id': 'a'}], self.queue.pop_ready(10))
+
+    def test_pop_nothing(self):
+        self.queue.push(0, {'id': 'a'})
+        self.assertEqual([], self.queue.pop_ready(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.core import submission
+
+
+class PresubmitLocalFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.client = submission.SubmissionClient.__new__(submission.SubmissionClient)
+        self.client.is_unix = True
+        self.client.transport = None
+        self.fileinfo = submission.identify.fileinfo
+        self.read = []
+        submission.identify.fileinfo = self.read.append
+
+    def tearDown(self):
+        submission.identify.fileinfo = self.fileinfo
+        shutil.rmtree(self.directory)
+
+    def test_oversized_files_are_not_read(self):
+        path = os.path.join(self.directory, 'big')
+        with open(path, 'wb') as f:
+            f.truncate(submission.config.submissions.max.size + 1)
+
+        results = self.client.presubmit_local_files([path])
+        self.assertFalse(results['0']['succeeded'])
+        self.assertIn('file too large', results['0']['error'])
+        self.assertEqual([], self.read)
+
+
+if __name__ == '__main__':
+    unittest.main()
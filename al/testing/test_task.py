@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+from __future__ import absolute_import
+
+import copy
+import os
+import pickle
+import unittest
+
+os.environ.setdefault('AL_SEED_STATIC', 'assemblyline.al.install.seeds.assemblyline_appliance.seed')
+
+from assemblyline.al.common.task import Task
+
+
+class TaskTest(unittest.TestCase):
+
+    def test_fields(self):
+        task = Task({}, sid='abc', srl='0' * 64)
+        self.assertEqual('abc', task.raw['submission']['sid'])
+        self.assertEqual('0' * 64, task.raw['request']['srl'])
+        self.assertEqual(None, task.priority)
+        self.assertFalse('priority' in task.raw.get('submission', {}))
+
+    def test_local_attributes(self):
+        task = Task({})
+        self.assertEqual(None, task.from_cache)
+        self.assertEqual(None, task.not_a_field)
+
+        task.from_cache = True
+        task.service_specific = 'value'
+        self.assertTrue(task.from_cache)
+        self.assertEqual('value', task.service_specific)
+        self.assertEqual({}, task.raw)
+
+    def test_copy_and_pickle(self):
+        task = Task({'state': 'submitted'})
+        task.service_specific = 'value'
+        for clone in (copy.copy(task), copy.deepcopy(task), pickle.loads(pickle.dumps(task, 2))):
+            self.assertEqual('submitted', clone.state)
+            self.assertEqual('value', clone.service_specific)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -118,6 +118,103 @@ class SizeExpiredCache(object):
             return self.cache.keys()
 
 
+class StripedLRUCache(object):
+    """
+    StripedLRUCache is a thread safe caching object bounded both in size and in time.
+
+    Items are spread over a number of stripes, each with its own lock, so threads working on
+    different keys rarely contend. Each stripe holds at most max_item_count / stripes items and
+    evicts its least recently used item when full.
+
+    Every item has an expiry time (now + timeout unless specified) after which it is dropped and
+    an optional stale time after which it is still returned but flagged as stale by lookup().
+
+    If a stats callable is given it is called with 'hit', 'miss', 'stale', 'expired' or 'evicted'.
+    """
+
+    def __init__(self, max_item_count, timeout, stripes=16, stats=None):
+        self.max_item_count = max_item_count
+        self.timeout = timeout
+        self.stats = stats or (lambda name: None)
+        self.stripe_size = max(1, max_item_count / stripes)
+        self.stripes = [(threading.Lock(), OrderedDict()) for _ in xrange(stripes)]
+
+    def __len__(self):
+        return sum([len(cache) for _, cache in self.stripes])
+
+    def __str__(self):
+        return 'StripedLRUCache(%s/%s)' % (len(self), self.max_item_count)
+
+    def _stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def add(self, key, data, expire_at=None, stale_at=None):
+        current_time = time.time()
+        if expire_at is None:
+            expire_at = current_time + self.timeout
+        if expire_at <= current_time:
+            return
+
+        evicted = 0
+        lock, cache = self._stripe(key)
+        with lock:
+            cache.pop(key, None)
+            cache[key] = (data, stale_at, expire_at)
+            while len(cache) > self.stripe_size:
+                cache.popitem(False)
+                evicted += 1
+
+        for _ in xrange(evicted):
+            self.stats('evicted')
+
+    def get(self, key, default=None):
+        data, _ = self.lookup(key)
+        if data is None:
+            return default
+        return data
+
+    def lookup(self, key):
+        """Return a (data, stale) tuple. data is None if the key is absent or expired."""
+        current_time = time.time()
+        lock, cache = self._stripe(key)
+        with lock:
+            item = cache.pop(key, None)
+            if item is not None and item[2] > current_time:
+                # Reinsert to mark as most recently used.
+                cache[key] = item
+
+        if item is None:
+            self.stats('miss')
+            return None, False
+
+        data, stale_at, expire_at = item
+        if expire_at <= current_time:
+            self.stats('expired')
+            return None, False
+
+        if stale_at is not None and stale_at <= current_time:
+            self.stats('stale')
+            return data, True
+
+        self.stats('hit')
+        return data, False
+
+    def keys(self):
+        out = []
+        for lock, cache in self.stripes:
+            with lock:
+                out.extend(cache.keys())
+        return out
+
+    def pop(self, key, default=None):
+        lock, cache = self._stripe(key)
+        with lock:
+            item = cache.pop(key, None)
+        if item is None:
+            return default
+        return item[0]
+
+
 # Test caches...
 if __name__ == "__main__":
     print "Testing TimeExpiredCache ..."
@@ -136,3 +233,13 @@ if __name__ == "__main__":
     for x in range(10):
         sc.add(x, x)
         print sc, "get(%s) =>" % x, sc.get(x)
+
+    print "\nTesting StripedLRUCache..."
+    lc = StripedLRUCache(4, 2, stripes=2)
+    for x in range(10):
+        lc.add(x, x, stale_at=time.time() + 1)
+        print lc, "lookup(%s) =>" % x, lc.lookup(x)
+    time.sleep(1)
+    print lc, "lookup(9) =>", lc.lookup(9)
+    time.sleep(1)
+    print lc, "lookup(9) =>", lc.lookup(9)
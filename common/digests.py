@@ -1,16 +1,56 @@
 import hashlib
+import mmap
 
 from assemblyline.common import entropy
 from assemblyline.common.charset import safe_str
 
+try:
+    # noinspection PyUnresolvedReferences
+    import ssdeep
+except ImportError:
+    ssdeep = None
+
 DEFAULT_BLOCKSIZE = 65536
 
 
+# noinspection PyBroadException
+def iter_blocks(path, blocksize=DEFAULT_BLOCKSIZE):
+    """ Yield the content of a file 'blocksize' bytes at a time.
+
+        The file is memory-mapped when possible so large files are not
+        read through an intermediate buffer.
+    """
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except:  # pylint: disable=W0702
+            # Empty and special files can't be mapped.
+            mm = None
+
+        if mm is None:
+            data = f.read(blocksize)
+            while data:
+                yield data
+                data = f.read(blocksize)
+            return
+
+        try:
+            for offset in xrange(0, len(mm), blocksize):
+                yield mm[offset:offset + blocksize]
+        finally:
+            mm.close()
+
+
 # noinspection PyBroadException
 def get_digests_for_file(path, blocksize=DEFAULT_BLOCKSIZE,
                          calculate_entropy=True,
-                         on_first_block=lambda b, l: {}):
-    """ Generate digests for file reading only 'blocksize bytes at a time."""
+                         on_first_block=lambda b, l: {},
+                         calculate_ssdeep=False):
+    """ Generate digests for file reading only 'blocksize bytes at a time.
+
+        The md5, sha1, sha256, entropy and (optionally) ssdeep of the file
+        are all computed in a single pass over its content.
+    """
     bc = None
     if calculate_entropy:
         try:
@@ -18,6 +58,10 @@ def get_digests_for_file(path, blocksize=DEFAULT_BLOCKSIZE,
         except:  # pylint: disable=W0702
             calculate_entropy = False
 
+    fuzzy = None
+    if calculate_ssdeep and ssdeep and hasattr(ssdeep, 'Hash'):
+        fuzzy = ssdeep.Hash()
+
     result = {'path': safe_str(path)}
 
     md5 = hashlib.md5()
@@ -25,23 +69,23 @@ def get_digests_for_file(path, blocksize=DEFAULT_BLOCKSIZE,
     sha256 = hashlib.sha256()
     size = 0
 
-    with open(path, 'rb') as f:
-        data = f.read(blocksize)
+    for data in iter_blocks(path, blocksize):
         length = len(data)
 
         if not size:
             result.update(on_first_block(data, length))
 
-        while length > 0:
-            if calculate_entropy:
-                bc.update(data, length)
-            md5.update(data)
-            sha1.update(data)
-            sha256.update(data)
-            size += length
+        if calculate_entropy:
+            bc.update(data, length)
+        if fuzzy:
+            fuzzy.update(data)
+        md5.update(data)
+        sha1.update(data)
+        sha256.update(data)
+        size += length
 
-            data = f.read(blocksize)
-            length = len(data)
+    if not size:
+        result.update(on_first_block('', 0))
 
     if calculate_entropy:
         result['entropy'] = bc.entropy()
@@ -52,32 +96,29 @@ def get_digests_for_file(path, blocksize=DEFAULT_BLOCKSIZE,
     result['sha256'] = sha256.hexdigest()
     result['size'] = size
 
+    if calculate_ssdeep:
+        if fuzzy:
+            result['ssdeep'] = fuzzy.digest()
+        elif ssdeep:
+            # Older ssdeep bindings can't hash incrementally.
+            result['ssdeep'] = ssdeep.hash_from_file(path)
+        else:
+            result['ssdeep'] = ''
+
     return result
 
 
 def get_md5_for_file(path, blocksize=DEFAULT_BLOCKSIZE):
     md5 = hashlib.md5()
-    with open(path, 'rb') as f:
-        data = f.read(blocksize)
-        length = len(data)
+    for data in iter_blocks(path, blocksize):
+        md5.update(data)
 
-        while length > 0:
-            md5.update(data)
-            data = f.read(blocksize)
-            length = len(data)
-
-        return md5.hexdigest()
+    return md5.hexdigest()
 
 
 def get_sha256_for_file(path, blocksize=DEFAULT_BLOCKSIZE):
     sha256 = hashlib.sha256()
-    with open(path, 'rb') as f:
-        data = f.read(blocksize)
-        length = len(data)
-
-        while length > 0:
-            sha256.update(data)
-            data = f.read(blocksize)
-            length = len(data)
+    for data in iter_blocks(path, blocksize):
+        sha256.update(data)
 
-        return sha256.hexdigest()
+    return sha256.hexdigest()
@@ -1,15 +1,85 @@
 import array
 import io
+import mmap
 
 from math import ceil, log
 
+try:
+    # noinspection PyUnresolvedReferences
+    import numpy
+except ImportError:
+    numpy = None
+
 frequency = None
 
 
-def calculate_entropy(contents):
+def _load_frequency():
+    global frequency
+    if frequency is None:
+        import pyximport
+        pyximport.install()  # pylint: disable=C0321
+        from assemblyline.common import frequency  # pylint: disable=E0611,W0621
+    return frequency
+
+
+def _python_counts(data, length):
+    count = array.array('L', [0] * 256)
+
+    # keep a count of all the bytes
+    for byte in data[:length]:
+        count[ord(byte)] += 1
+
+    return count.tolist()
+
+
+def _cython_counts(data, length):
+    counts = _load_frequency().counts(data, length, {})
+    return [counts.get(i, 0) for i in xrange(256)]
+
+
+def _numpy_counts(data, length):
+    """ Returns the byte histogram of data as a numpy array.
+
+        data can be any object exposing a buffer (str, mmap, ...) or a
+        uint8 numpy array, in which case no copy is made.
+    """
+    if not length:
+        return numpy.zeros(256, dtype=numpy.int64)
+    if not isinstance(data, numpy.ndarray):
+        data = numpy.frombuffer(data, dtype=numpy.uint8, count=length)
+    elif len(data) != length:
+        data = data[:length]
+    return numpy.bincount(data, minlength=256)
+
+
+backends = {
+    'cython': _cython_counts,
+    'python': _python_counts,
+}
+if numpy is not None:
+    backends['numpy'] = lambda data, length: _numpy_counts(data, length).tolist()
+
+
+def default_backend(buffered=False):
+    if numpy is not None:
+        return 'numpy'
+    # Without numpy, buffered calculators keep using the compiled counter.
+    return 'cython' if buffered else 'python'
+
+
+def byte_counts(data, length=None, backend=None):
+    """ Returns the number of occurrences of each byte value in data. """
+    if length is None:
+        length = len(data)
+    return backends[backend or default_backend()](data, length)
+
+
+def calculate_entropy(contents, backend=None):
     """ this function calculates the entropy of the file
         It is given by the formula:
             E = -SUM[v in 0..255](p(v) * ln(p(v)))
+
+        contents can also be a memory-mapped file or a uint8 numpy array.
     """
 
     data_length = len(contents)
@@ -17,11 +87,7 @@ def calculate_entropy(contents):
     if data_length == 0:
         return 0
 
-    count = array.array('L', [0] * 256)
-
-    # keep a count of all the bytes
-    for byte in contents:
-        count[ord(byte)] += 1
+    count = byte_counts(contents, data_length, backend)
 
     entropy = float(0)
 
@@ -34,6 +100,15 @@ def calculate_entropy(contents):
     return entropy
 
 
+def _map_file(fin):
+    # noinspection PyBroadException
+    try:
+        return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, EnvironmentError, ValueError, io.UnsupportedOperation):
+        # In-memory file objects and empty files can't be mapped.
+        return None
+
+
 def calculate_partition_entropy(fin, num_partitions=50):
     """Calculate the entropy of a file and its partitions."""
 
@@ -47,20 +122,42 @@ def calculate_partition_entropy(fin, num_partitions=50):
     # Also calculate full file entropy using buffered calculator.
     p_entropies = []
     fullentropy = BufferedCalculator()
-    for _ in range(num_partitions):
-        partition = fin.read(partition_size)
-        p_entropies.append(calculate_entropy(partition))
-        fullentropy.update(partition)
+
+    mapped = _map_file(fin) if numpy is not None and size else None
+    if mapped is None:
+        for _ in range(num_partitions):
+            partition = fin.read(partition_size)
+            p_entropies.append(calculate_entropy(partition))
+            fullentropy.update(partition)
+        return fullentropy.entropy(), p_entropies
+
+    # Partitions are views on the mapped file so large files are never
+    # copied into python strings.
+    try:
+        view = numpy.frombuffer(mapped, dtype=numpy.uint8)
+        for i in range(num_partitions):
+            partition = view[i * partition_size:(i + 1) * partition_size]
+            p_entropies.append(calculate_entropy(partition))
+            fullentropy.update(partition)
+        # Release the views before unmapping.
+        view = partition = None
+    finally:
+        mapped.close()
+
     return fullentropy.entropy(), p_entropies
 
 
 # noinspection PyUnresolvedReferences
 class BufferedCalculator(object):
-    def __init__(self):
-        global frequency
-        import pyximport
-        pyximport.install()  # pylint: disable=C0321
-        from assemblyline.common import frequency  # pylint: disable=E0611
+    def __init__(self, backend=None):
+        self.backend = backend or default_backend(buffered=True)
+        if self.backend == 'cython':
+            _load_frequency()
+            self.counts = None
+        elif self.backend == 'numpy':
+            self.counts = numpy.zeros(256, dtype=numpy.int64)
+        else:
+            self.counts = [0] * 256
 
         self.c = {}
         self.l = 0
@@ -69,6 +166,14 @@ class BufferedCalculator(object):
         if self.l == 0:
             return 0.0
 
+        if self.counts is not None:
+            # Same dict, built in the same order, as the compiled counter
+            # returns so the sum (and the result) is identical.
+            counts = self.counts
+            if self.backend == 'numpy':
+                counts = counts.tolist()
+            self.c = {i: v for i, v in enumerate(counts) if v}
+
         length = float(self.l)
 
         entropy = 0.0
@@ -89,4 +194,9 @@ class BufferedCalculator(object):
             length = len(data)
 
         self.l += length
-        self.c = frequency.counts(data, length, self.c)
+        if self.backend == 'cython':
+            self.c = frequency.counts(data, length, self.c)
+        elif self.backend == 'numpy':
+            self.counts += _numpy_counts(data, length)
+        else:
+            self.counts = [a + b for a, b in zip(self.counts, _python_counts(data, length))]
@@ -346,6 +346,9 @@ magic_lock = None
 file_type = None
 mime_type = None
 
+# libmagic handles are not thread-safe so each thread gets its own pair.
+magic_handles = threading.local()
+
 if platform.system() != 'Windows':
     import magic
 
@@ -357,6 +360,9 @@ if platform.system() != 'Windows':
     mime_type = magic.magic_open(magic.MAGIC_CONTINUE + magic.MAGIC_MIME)
     magic.magic_load(mime_type, constants.RULE_PATH)
 
+    # The importing thread uses the module level handles.
+    magic_handles.handles = (file_type, mime_type)
+
     try:
         # noinspection PyUnresolvedReferences
         import ssdeep  # ssdeep requires apt-get cython and pip install ssdeep
@@ -374,6 +380,37 @@ def subtype(label):
     return 'unknown'
 
 
+class ThreadMagic(tuple):
+    """ A (file_type, mime_type) pair of libmagic handles owned by a thread.
+
+    The handles are closed when the thread (and its locals) go away.
+    """
+    def __new__(cls):
+        ft = magic.magic_open(magic.MAGIC_CONTINUE + magic.MAGIC_RAW)
+        magic.magic_load(ft, constants.RULE_PATH)
+
+        mt = magic.magic_open(magic.MAGIC_CONTINUE + magic.MAGIC_MIME)
+        magic.magic_load(mt, constants.RULE_PATH)
+
+        return super(ThreadMagic, cls).__new__(cls, (ft, mt))
+
+    def __del__(self):
+        for handle in self:
+            magic.magic_close(handle)
+
+
+def get_magic_handles():
+    """ Returns this thread's (file_type, mime_type) libmagic handles. """
+    if not file_type:
+        return None, None
+
+    handles = getattr(magic_handles, 'handles', None)
+    if handles is None:
+        handles = magic_handles.handles = ThreadMagic()
+
+    return handles
+
+
 def ident(buf, length):
     minimum = 1000
     sl_tag = 'unknown'
@@ -390,15 +427,15 @@ def ident(buf, length):
     # noinspection PyBroadException
     try:
         # Loop over the labels returned by libmagic, ...
+        ft, mt = get_magic_handles()
+
         labels = []
-        if file_type:
-            with magic_lock:
-                labels = magic.magic_buffer(file_type, buf).split('\n')
+        if ft:
+            labels = magic.magic_buffer(ft, buf).split('\n')
 
         mimes = []
-        if mime_type:
-            with magic_lock:
-                mimes = magic.magic_buffer(mime_type, buf).split('\n')
+        if mt:
+            mimes = magic.magic_buffer(mt, buf).split('\n')
 
         for label, mime in zip(labels, mimes):
             label = dotdump(label)
@@ -649,13 +686,15 @@ def dos_ident(path):
 def fileinfo(path):
     path = safe_str(path)
 
-    data = get_digests_for_file(path, on_first_block=ident)
+    # Digests, entropy, ssdeep and magic are all taken in one read of the file.
+    data = get_digests_for_file(path, on_first_block=ident,
+                                calculate_ssdeep=bool(ssdeep_from_file))
     if data['mime'].lower() == 'application/cdfv2-corrupt':
         with open(path, 'r') as fh:
             buf = fh.read()
             buflen = len(buf)
             data.update(ident(buf, buflen))
-    data['ssdeep'] = ssdeep_from_file(path) if ssdeep_from_file else ''
+    data.setdefault('ssdeep', '')
 
     if not int(data.get('size', -1)):
         data['tag'] = 'empty'
@@ -672,12 +711,39 @@ def fileinfo(path):
     return data
 
 
+fileinfo_pool = None
+fileinfo_pool_lock = threading.Lock()
+
+
+def fileinfo_many(paths, processes=None):
+    """ Identify many files in parallel using a pool of worker processes.
+
+    The pool is created on first use and reused afterwards. Results are
+    returned in the same order as paths.
+    """
+    global fileinfo_pool
+    paths = [safe_str(p) for p in paths]
+    if len(paths) < 2:
+        return [fileinfo(p) for p in paths]
+
+    with fileinfo_pool_lock:
+        if fileinfo_pool is None:
+            import multiprocessing
+            fileinfo_pool = multiprocessing.Pool(processes)
+        pool = fileinfo_pool
+
+    return pool.map(fileinfo, paths)
+
+
 if __name__ == '__main__':
     from pprint import pprint
 
     # noinspection PyBroadException
     try:
-        pprint(fileinfo(sys.argv[1]))
+        if len(sys.argv) > 2:
+            pprint(fileinfo_many(sys.argv[1:]))
+        else:
+            pprint(fileinfo(sys.argv[1]))
     except:
         name = sys.stdin.readline().strip()
         while name: